@@ -1,11 +1,24 @@
 #!/bin/sh
 set -e
 
-echo "Running migrations..."
-python manage.py migrate --noinput
+# One-time startup tasks. With several web replicas these run once, in the
+# "setup" service, instead of racing each other in every replica.
+if [ "${RUN_STARTUP_TASKS:-true}" = "true" ]; then
+    echo "Running migrations..."
+    python manage.py migrate --noinput
 
-echo "Collecting static files..."
-python manage.py collectstatic --noinput
+    echo "Collecting static files..."
+    python manage.py collectstatic --noinput
+
+    echo "Building PWA assets..."
+    python manage.py build_pwa
+
+    echo "Flushing queued write-behind messages..."
+    python manage.py flush_messages
+
+    echo "Rebuilding missing room activity summaries..."
+    python manage.py rebuild_room_activity
+fi
 
 echo "Starting server..."
 exec "$@"
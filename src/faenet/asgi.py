@@ -13,6 +13,9 @@ origins matching ALLOWED_HOSTS, preventing cross-site WebSocket hijacking.
 
 AuthMiddlewareStack populates scope["user"] from the session cookie, so
 our consumer can identify who is connected without a separate auth flow.
+
+With CHAT_WATCHDOG on, everything is wrapped in WatchdogMiddleware, which
+starts the event-loop lag monitor (chat/watchdog.py) on the first request.
 """
 
 import os
@@ -20,6 +23,7 @@ import os
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "faenet.settings")
@@ -29,6 +33,7 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "faenet.settings")
 django_asgi_app = get_asgi_application()
 
 from faenet.chat.routing import websocket_urlpatterns  # noqa: E402
+from faenet.chat.watchdog import WatchdogMiddleware  # noqa: E402
 
 application = ProtocolTypeRouter(
     {
@@ -38,3 +43,7 @@ application = ProtocolTypeRouter(
         ),
     }
 )
+
+# Opt-in event-loop lag monitor; off, it isn't in the stack at all
+if settings.CHAT_WATCHDOG:
+    application = WatchdogMiddleware(application)
@@ -0,0 +1,219 @@
+"""
+Per-room activity summary in Redis, for the room list.
+
+Each room has a hash, ``room_activity:{room_id}``, with its message count
+and the id, time and author of its latest message. The consumer updates it
+with every message it sends (one script call next to the broadcast), so
+the room list never touches the message table: it is one query for the
+rooms plus one Redis pipeline that reads every room's summary and its
+online count from presence.
+
+Two counts are kept: ``messages`` goes down when messages are deleted and
+is what the room list shows; ``posted`` only ever goes up, so unread counts
+taken against it (unread.py) don't drift when a message someone already
+read is deleted. A rebuild of a summary that still exists keeps the higher
+of the stored ``posted`` and the live count.
+
+A summary missing from Redis is rebuilt from Postgres by whoever needs it
+next (the room list, unread counts), and by the ``rebuild_room_activity``
+command at startup. Until then, messages sent to the room aren't counted
+in Redis at all; the rebuild counts them from the table.
+"""
+
+from datetime import UTC, datetime
+
+from django.db.models import Count, Max
+
+from .db import database_sync_to_async
+from .models import ChatRoom, Message
+from .presence import ONLINE_COUNTS_KEY
+from .redis_pool import get_redis, get_sync_redis
+
+_redis = get_redis()
+
+
+def summary_key(room_id: int) -> str:
+    """Redis key of a room's activity hash."""
+    return f"room_activity:{room_id}"
+
+
+# Count the message and, unless a newer one was recorded first (two senders
+# racing), make it the room's latest. The time is Redis server time, so
+# workers with skewed clocks agree. A missing summary is left for the
+# rebuild rather than started over at 1.
+_RECORD_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], 'posted') == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], 'messages', 1)
+redis.call('HINCRBY', KEYS[1], 'posted', 1)
+local last = tonumber(redis.call('HGET', KEYS[1], 'last_id') or '0')
+if tonumber(ARGV[1]) > last then
+    local now = redis.call('TIME')
+    redis.call('HSET', KEYS[1], 'last_id', ARGV[1], 'last_author', ARGV[2],
+        'last_at', now[1] .. '.' .. string.format('%06d', now[2]))
+end
+return 1
+"""
+
+# Lower the count after a delete, without creating a summary for a room
+# that has none. posted stays as it is.
+_FORGET_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], 'posted') == 1 then
+    redis.call('HINCRBY', KEYS[1], 'messages', -tonumber(ARGV[1]))
+end
+return 1
+"""
+
+# Write a rebuilt summary; with ARGV[1] == '0', only if the room still has
+# none (another worker may have rebuilt it and counted messages since).
+# ARGV[2] is the live message count: posted takes it unless the old value
+# is higher, since read cursors were counted against the old one.
+_WRITE_SCRIPT = """
+local old = redis.call('HGET', KEYS[1], 'posted')
+if ARGV[1] == '0' and old then
+    return 0
+end
+local posted = math.max(tonumber(ARGV[2]), tonumber(old or '0'))
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'posted', posted, unpack(ARGV, 3))
+return 1
+"""
+
+_record = _redis.register_script(_RECORD_SCRIPT)
+
+
+async def record_message(room_id: int, message_id: int, username: str) -> None:
+    """Count a new message and make it the room's latest."""
+    await _record(keys=[summary_key(room_id)], args=[message_id, username])
+
+
+async def summaries(rooms) -> dict[int, dict]:
+    """Return {room_id: {messages, posted, last_id, last_author, last_at,
+    online}} for the given rooms, read in one pipeline.
+
+    ``last_at`` is an aware datetime, or None for a room with no messages.
+    Missing summaries are rebuilt from Postgres first.
+    """
+    rooms = list(rooms)
+    if not rooms:
+        return {}
+    async with _redis.pipeline(transaction=False) as pipe:
+        for room in rooms:
+            pipe.hgetall(summary_key(room.id))
+        pipe.hmget(ONLINE_COUNTS_KEY, [room.slug for room in rooms])
+        *hashes, online = await pipe.execute()
+
+    missing_ids = [room.id for room, data in zip(rooms, hashes) if "posted" not in data]
+    if missing_ids:
+        await rebuild_missing(missing_ids)
+        async with _redis.pipeline(transaction=False) as pipe:
+            for room in rooms:
+                pipe.hgetall(summary_key(room.id))
+            hashes = await pipe.execute()
+
+    result = {}
+    for room, data, online_count in zip(rooms, hashes, online):
+        last_at = data.get("last_at")
+        result[room.id] = {
+            "messages": int(data.get("messages", 0)),
+            "posted": int(data.get("posted", 0)),
+            "last_id": int(data.get("last_id", 0)),
+            "last_author": data.get("last_author", ""),
+            "last_at": (
+                datetime.fromtimestamp(float(last_at), tz=UTC) if last_at else None
+            ),
+            "online": int(online_count or 0),
+        }
+    return result
+
+
+def forget_messages(counts: dict[int, int]) -> None:
+    """Lower rooms' message counts after messages are deleted, given as
+    {room_id: deleted}, in one round-trip (sync, for signal handlers). The
+    latest-message fields are left alone."""
+    client = get_sync_redis()
+    with client.pipeline(transaction=False) as pipe:
+        for room_id, deleted in counts.items():
+            pipe.eval(_FORGET_SCRIPT, 1, summary_key(room_id), deleted)
+        pipe.execute()
+
+
+def delete(*room_ids: int) -> None:
+    """Drop deleted rooms' summaries (sync, for signal handlers)."""
+    if room_ids:
+        get_sync_redis().delete(*(summary_key(room_id) for room_id in room_ids))
+
+
+def rebuild(room_ids=None, replace=True) -> int:
+    """Recompute summaries from Postgres, for ``room_ids`` (including ones
+    with no messages yet) or every room with messages. Returns the number
+    of rooms written.
+
+    One aggregate over the message table plus one query for the latest
+    messages. With ``replace=False``, a room that has gained a summary in
+    the meantime keeps it. Replacing resets ``messages`` to the live count
+    but never lowers ``posted``, which read cursors depend on.
+    """
+    qs = Message.objects.all()
+    if room_ids is not None:
+        qs = qs.filter(room_id__in=room_ids)
+    totals = {
+        row["room_id"]: row
+        for row in qs.values("room_id").annotate(
+            messages=Count("id"), last_id=Max("id")
+        )
+    }
+    latest = {
+        msg.id: msg
+        for msg in Message.objects.filter(
+            id__in=[row["last_id"] for row in totals.values()]
+        ).select_related("user")
+    }
+
+    if room_ids is None:
+        room_ids = list(totals)
+    else:
+        # Skip rooms deleted since (a stale read cursor can name one)
+        room_ids = ChatRoom.objects.filter(id__in=room_ids).values_list("id", flat=True)
+
+    client = get_sync_redis()
+    with client.pipeline(transaction=False) as pipe:
+        for room_id in room_ids:
+            summary = {"messages": 0}
+            if room_id in totals:
+                msg = latest[totals[room_id]["last_id"]]
+                summary = {
+                    "messages": totals[room_id]["messages"],
+                    "last_id": msg.id,
+                    "last_author": msg.user.username,
+                    "last_at": f"{msg.created_at.timestamp():.6f}",
+                }
+            fields = [item for pair in summary.items() for item in pair]
+            pipe.eval(
+                _WRITE_SCRIPT,
+                1,
+                summary_key(room_id),
+                "1" if replace else "0",
+                summary["messages"],
+                *fields,
+            )
+        written = pipe.execute()
+    return sum(written)
+
+
+async def rebuild_missing(room_ids) -> None:
+    """Rebuild the summaries of rooms that have none, e.g. after Redis lost
+    them while the app was running."""
+    await database_sync_to_async(rebuild)(list(room_ids), replace=False)
+
+
+def missing(room_ids) -> list[int]:
+    """Return the ids among ``room_ids`` that have no summary in Redis."""
+    room_ids = list(room_ids)
+    client = get_sync_redis()
+    with client.pipeline(transaction=False) as pipe:
+        for room_id in room_ids:
+            pipe.hexists(summary_key(room_id), "posted")
+        exists = pipe.execute()
+    return [room_id for room_id, found in zip(room_ids, exists) if not found]
@@ -7,6 +7,4 @@ class ChatConfig(AppConfig):
     verbose_name = "Faerie Chat"
 
     def ready(self):
-        from .presence import flush_all_presence
-
-        flush_all_presence()
+        from . import signals  # noqa: F401
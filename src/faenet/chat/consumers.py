@@ -1,10 +1,18 @@
+import asyncio
 import json
+import time
 
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-
-from .models import ChatRoom, Message, Reaction
-from .presence import should_announce, user_joined, user_left
+from django.conf import settings
+from django.db import IntegrityError
+
+from . import activity, frames, idempotency, metrics, recent, unread, writebehind
+from .db import database_sync_to_async
+from .models import Message
+from .presence import get_snapshot, start_heartbeat, user_joined, user_left
+from .ratelimit import RateLimiter
+from .reactions import toggle_reaction
+from .rooms import get_room_id, group_name
 from .utils import is_valid_emoji
 
 
@@ -19,7 +27,6 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def connect(self):
         self.room_slug = self.scope["url_route"]["kwargs"]["slug"]
-        self.room_group_name = f"chat_{self.room_slug}"
         self.user = self.scope["user"]
 
         # Reject anonymous users
@@ -27,56 +34,98 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
+        # Resolve the room once; messages and reactions write by room_id.
+        # Unknown slugs are rejected here instead of failing on first send.
+        self.room_id = await get_room_id(self.room_slug)
+        if self.room_id is None:
+            await self.close()
+            return
+
+        self.room_group_name = group_name(self.room_slug)
+        self.rate_limiter = RateLimiter(self.user.id, self.room_slug)
+        self._throttled_until = 0.0
+        self._batch = []
+        self._batch_task = None
+        self._resumed = False
+
         # Join the room group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         await self.accept()
+        metrics.connection_opened(self.room_slug)
 
-        # Track presence keyed by channel_name (handles multi-tab + stale entries)
-        online_users = user_joined(
+        # This worker's heartbeat keeps its connections' presence entries
+        # fresh; if it dies without disconnecting, they expire and get reaped.
+        start_heartbeat()
+
+        # Track presence keyed by channel_name (handles multi-tab + stale entries).
+        # One round-trip also versions the change and decides whether to announce.
+        online_users, version, changed, announce = await user_joined(
             self.room_slug, self.user.username, self.channel_name
         )
 
-        # Send current online list to the joining user (unicast)
-        await self.send(
-            text_data=json.dumps({"type": "presence_update", "users": online_users})
-        )
+        # Send the full online list to the joining user only (unicast)
+        await self._send_presence_snapshot(online_users, version)
+        await self._send_unread(await unread.all_unread(self.user.id))
 
         # Notify room that user joined (debounced to suppress rapid refresh spam)
-        if should_announce(self.room_slug, self.user.username, "join"):
-            await self.channel_layer.group_send(
+        if announce:
+            await frames.group_send(
+                self.channel_layer,
                 self.room_group_name,
                 {
-                    "type": "system_message",
+                    "type": "system",
                     "message": f"{self.user.username} has entered the chamber",
                 },
             )
 
-        # Broadcast updated presence to all users
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {"type": "presence_update_broadcast", "users": online_users},
-        )
+        # Everyone else only needs a small delta, and only when this was the
+        # user's first connection (opening another tab changes nothing).
+        if changed:
+            await frames.group_send(
+                self.channel_layer,
+                self.room_group_name,
+                {
+                    "type": "presence_delta",
+                    "action": "joined",
+                    "username": self.user.username,
+                    "version": version,
+                },
+            )
 
     async def disconnect(self, close_code):
+        if getattr(self, "_batch_task", None) is not None:
+            self._batch_task.cancel()
         if hasattr(self, "room_group_name") and not self.user.is_anonymous:
+            metrics.connection_closed(self.room_slug)
+
             # Remove this specific connection from presence
-            online_users = user_left(self.room_slug, self.channel_name)
+            version, changed, announce = await user_left(
+                self.room_slug, self.user.username, self.channel_name
+            )
 
             # Notify room that user left (debounced to suppress rapid refresh spam)
-            if should_announce(self.room_slug, self.user.username, "leave"):
-                await self.channel_layer.group_send(
+            if announce:
+                await frames.group_send(
+                    self.channel_layer,
                     self.room_group_name,
                     {
-                        "type": "system_message",
+                        "type": "system",
                         "message": f"{self.user.username} has left the chamber",
                     },
                 )
 
-            # Broadcast updated presence to all users
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {"type": "presence_update_broadcast", "users": online_users},
-            )
+            # Broadcast a delta only once the user's last connection is gone
+            if changed:
+                await frames.group_send(
+                    self.channel_layer,
+                    self.room_group_name,
+                    {
+                        "type": "presence_delta",
+                        "action": "left",
+                        "username": self.user.username,
+                        "version": version,
+                    },
+                )
 
             # Leave the room group
             await self.channel_layer.group_discard(
@@ -87,33 +136,126 @@ class ChatConsumer(AsyncWebsocketConsumer):
         data = json.loads(text_data)
         msg_type = data.get("type", "chat_message")
 
-        if msg_type == "reaction":
-            await self._handle_reaction(data)
-        else:
-            await self._handle_chat_message(data)
+        with metrics.frame(msg_type):
+            if msg_type == "reaction":
+                if await self._allow("reaction"):
+                    await self._handle_reaction(data)
+            elif msg_type == "read":
+                if await self._allow("read"):
+                    await self._mark_read(data.get("message_id"))
+            elif msg_type == "resume":
+                if await self._allow("resume"):
+                    await self._resume(data.get("last_message_id"))
+            elif msg_type == "presence_sync":
+                # Client detected a gap in presence versions and wants a resync
+                if await self._allow("presence_sync"):
+                    await self._send_presence_snapshot(
+                        *await get_snapshot(self.room_slug)
+                    )
+            elif await self._allow("message"):
+                await self._handle_chat_message(data)
+
+    async def _allow(self, kind):
+        """Charge a frame to the rate limiter. Frames over the limit are
+        dropped; the client hears about it once per throttled stretch rather
+        than once per dropped frame."""
+        wait = await self.rate_limiter.check(kind)
+        if not wait:
+            return True
+        now = time.monotonic()
+        if now >= self._throttled_until:
+            self._throttled_until = now + wait
+            await self._send_direct(
+                {
+                    "type": "error",
+                    "code": "rate_limited",
+                    "kind": kind,
+                    "retry_after": round(wait, 3),
+                    "message": "You're going too fast — wait a moment and try again",
+                }
+            )
+        return False
 
     async def _handle_chat_message(self, data):
         message = data.get("message", "").strip()
         if not message:
             return
 
-        reply_to_id = data.get("reply_to")
-        saved = await self.save_message(message, reply_to_id)
+        # Sent from the page's outbox, which resends anything it hasn't had
+        # an ack for: store and broadcast each client id only once
+        client_id = idempotency.parse(data.get("client_id"))
+        if client_id:
+            claimed, message_id = await idempotency.claim(self.user.id, client_id)
+            if not claimed:
+                # If the first attempt is still being stored, its ack follows
+                if message_id:
+                    await self._send_ack(client_id, message_id)
+                return
 
-        broadcast = {
-            "type": "chat_message",
-            "message": message,
-            "username": self.user.username,
-            "message_id": saved["id"],
-        }
+        reply_to_id = data.get("reply_to")
+        started = time.perf_counter()
+        try:
+            if settings.CHAT_WRITE_BEHIND:
+                saved = await self.queue_message(message, reply_to_id, client_id)
+            else:
+                saved = await self.save_message(message, reply_to_id, client_id)
+        except Exception:
+            if client_id:
+                await idempotency.release(self.user.id, client_id)
+            raise
+        metrics.MESSAGE_PERSIST.observe(time.perf_counter() - started)
+
+        if client_id:
+            await idempotency.stored(self.user.id, client_id, saved["id"])
+            if saved["duplicate"]:
+                await self._send_ack(client_id, saved["id"])
+                return
+
+        reply_to = None
         if saved["parent_id"]:
-            broadcast["reply_to"] = {
+            reply_to = {
                 "message_id": saved["parent_id"],
                 "username": saved["parent_username"],
                 "content": saved["parent_content"][:100],
             }
 
-        await self.channel_layer.group_send(self.room_group_name, broadcast)
+        # Buffer before broadcasting, so a client reconnecting in between
+        # finds it in the replay rather than missing it
+        text = frames.encode(
+            frames.chat(saved["id"], self.user.username, message, reply_to)
+        )
+        await recent.add(self.room_id, saved["id"], text)
+        # Counted before anyone can see it, so a reader marking it read
+        # finds it in the room's count
+        await activity.record_message(self.room_id, saved["id"], self.user.username)
+        await frames.group_send_text(self.channel_layer, self.room_group_name, text)
+        if client_id:
+            await self._send_ack(client_id, saved["id"])
+
+    async def _resume(self, last_message_id):
+        """Replay the chat messages a reconnecting client missed."""
+        if self._resumed:
+            return
+        self._resumed = True
+        try:
+            last_message_id = int(last_message_id)
+        except (TypeError, ValueError):
+            return
+        texts, truncated = await recent.missed(
+            self.room_id, last_message_id, self.user.id
+        )
+        await self._flush_batch()
+        await self.send(text_data=frames.replay(texts, truncated))
+
+    async def _mark_read(self, message_id):
+        """Move the user's read cursor for this room; the page sends this
+        when it is scrolled to the newest message."""
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            return
+        count = await unread.mark_read(self.user.id, self.room_id, message_id)
+        await self._send_unread({self.room_id: count})
 
     async def _handle_reaction(self, data):
         message_id = data.get("message_id")
@@ -122,14 +264,27 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if not message_id or not emoji:
             return
 
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            return
+
         if not is_valid_emoji(emoji):
             return
 
         result = await self.toggle_reaction(message_id, emoji)
+        # Reacting to a message write-behind hasn't stored yet
+        if result is None and await self._wait_flushed(message_id):
+            result = await self.toggle_reaction(message_id, emoji)
         if result is None:
             return
 
-        await self.channel_layer.group_send(
+        await recent.set_reaction_count(
+            self.room_id, message_id, emoji, result["count"]
+        )
+
+        await frames.group_send(
+            self.channel_layer,
             self.room_group_name,
             {
                 "type": "reaction_update",
@@ -141,66 +296,126 @@ class ChatConsumer(AsyncWebsocketConsumer):
             },
         )
 
-    async def chat_message(self, event):
-        """Handle chat_message events from the channel layer."""
-        payload = {
-            "type": "chat",
-            "message": event["message"],
-            "username": event["username"],
-            "message_id": event["message_id"],
-        }
-        if "reply_to" in event:
-            payload["reply_to"] = event["reply_to"]
-        await self.send(text_data=json.dumps(payload))
-
-    async def reaction_update(self, event):
-        """Handle reaction_update events from the channel layer."""
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "reaction_update",
-                    "message_id": event["message_id"],
-                    "emoji": event["emoji"],
-                    "action": event["action"],
-                    "username": event["username"],
-                    "count": event["count"],
-                }
-            )
+    async def frame(self, event):
+        """Forward a pre-encoded frame from the channel layer (see frames.py).
+
+        With CHAT_BATCH_WINDOW_MS set, frames arriving within the window are
+        coalesced and sent together as one "batch" frame.
+        """
+        window = settings.CHAT_BATCH_WINDOW_MS
+        if not window:
+            await self.send(text_data=event["text"])
+            return
+        self._batch.append(event["text"])
+        if len(self._batch) >= frames.BATCH_MAX_EVENTS:
+            await self._flush_batch()
+        elif self._batch_task is None:
+            # A separate task: channel layer events for this consumer are
+            # handled one at a time, so sleeping here would stall them.
+            self._batch_task = asyncio.create_task(self._flush_batch_later(window))
+
+    async def _flush_batch_later(self, window_ms):
+        await asyncio.sleep(window_ms / 1000)
+        self._batch_task = None
+        await self._flush_batch()
+
+    async def _flush_batch(self):
+        if self._batch_task is not None:
+            self._batch_task.cancel()
+            self._batch_task = None
+        texts, self._batch = self._batch, []
+        if texts:
+            await self.send(text_data=frames.batch(texts))
+
+    async def _send_direct(self, payload):
+        """Send a frame to this socket only, after anything still batched so
+        the client sees events in order."""
+        await self._flush_batch()
+        await self.send(text_data=frames.encode(payload))
+
+    async def _send_ack(self, client_id, message_id):
+        """Tell the sender its message is stored, so the page drops it from
+        its outbox."""
+        await self._send_direct(
+            {"type": "ack", "client_id": client_id, "message_id": message_id}
         )
 
-    async def presence_update_broadcast(self, event):
-        """Handle presence_update_broadcast events from the channel layer."""
-        await self.send(
-            text_data=json.dumps({"type": "presence_update", "users": event["users"]})
+    async def _send_presence_snapshot(self, users, version):
+        await self._send_direct(
+            {"type": "presence_snapshot", "users": users, "version": version}
         )
 
-    async def system_message(self, event):
-        """Handle system_message events (join/leave notifications)."""
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "system",
-                    "message": event["message"],
-                }
-            )
+    async def _send_unread(self, counts):
+        # JSON object keys are strings
+        await self._send_direct(
+            {"type": "unread", "rooms": {str(k): v for k, v in counts.items()}}
         )
 
     @database_sync_to_async
-    def save_message(self, content, reply_to_id=None):
-        room = ChatRoom.objects.get(slug=self.room_slug)
+    def save_message(self, content, reply_to_id=None, client_id=None):
+        parent = self._get_parent(reply_to_id)
+        try:
+            msg = Message.objects.create(
+                room_id=self.room_id,
+                user=self.user,
+                content=content,
+                parent=parent,
+                client_id=client_id,
+            )
+        except IntegrityError:
+            if client_id is None:
+                raise
+            # A resend whose Redis key is gone; the constraint caught it
+            existing = Message.objects.values_list("id", flat=True).get(
+                user=self.user, client_id=client_id
+            )
+            return self._saved_result(existing, None, duplicate=True)
+        return self._saved_result(msg.id, parent)
+
+    async def queue_message(self, content, reply_to_id=None, client_id=None):
+        """Write-behind variant of save_message: the message gets its id from
+        Redis and is persisted by a background flush (see writebehind.py)."""
         parent = None
         if reply_to_id:
-            try:
-                parent = Message.objects.select_related("user").get(
-                    id=reply_to_id, room=room
-                )
-            except Message.DoesNotExist:
-                pass
-        msg = Message.objects.create(
-            room=room, user=self.user, content=content, parent=parent
+            parent = await database_sync_to_async(self._get_parent)(reply_to_id)
+            # Replying to a message that is itself still queued
+            if parent is None and await self._wait_flushed(reply_to_id):
+                parent = await database_sync_to_async(self._get_parent)(reply_to_id)
+        message_id = await writebehind.enqueue(
+            self.room_id,
+            self.user.id,
+            content,
+            parent.id if parent else None,
+            client_id,
         )
+        return self._saved_result(message_id, parent)
+
+    @staticmethod
+    async def _wait_flushed(message_id):
+        """With write-behind, make sure message_id has reached Postgres.
+        Returns whether it was still queued, i.e. worth looking up again."""
+        if not settings.CHAT_WRITE_BEHIND:
+            return False
+        try:
+            return await writebehind.wait_flushed(int(message_id))
+        except (TypeError, ValueError):
+            return False
+
+    def _get_parent(self, reply_to_id):
+        if not reply_to_id:
+            return None
+        try:
+            return Message.objects.select_related("user").get(
+                id=reply_to_id, room_id=self.room_id
+            )
+        except (Message.DoesNotExist, ValueError):
+            return None
+
+    @staticmethod
+    def _saved_result(message_id, parent, duplicate=False):
         result = {
-            "id": msg.id,
+            "id": message_id,
+            "duplicate": duplicate,
             "parent_id": None,
             "parent_username": None,
             "parent_content": None,
@@ -213,19 +428,4 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     @database_sync_to_async
     def toggle_reaction(self, message_id, emoji):
-        try:
-            room = ChatRoom.objects.get(slug=self.room_slug)
-            message = Message.objects.get(id=message_id, room=room)
-        except (ChatRoom.DoesNotExist, Message.DoesNotExist):
-            return None
-
-        existing = Reaction.objects.filter(message=message, user=self.user, emoji=emoji)
-        if existing.exists():
-            existing.delete()
-            action = "remove"
-        else:
-            Reaction.objects.create(message=message, user=self.user, emoji=emoji)
-            action = "add"
-
-        count = Reaction.objects.filter(message=message, emoji=emoji).count()
-        return {"action": action, "count": count}
+        return toggle_reaction(self.room_id, message_id, self.user.id, emoji)
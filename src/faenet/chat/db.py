@@ -0,0 +1,63 @@
+"""
+Database access from async code.
+
+Import ``database_sync_to_async`` from here rather than from channels.db.
+It is channels' version with two changes:
+
+- Calls run on a pool of CHAT_DB_THREADS threads ("chat-db-N"). asgiref
+  would otherwise run every call from a Daphne process's event loop on one
+  shared thread, so a slow query holds up every other socket's save. Each
+  thread has its own Django connection, borrowed from the psycopg pool
+  (DATABASES OPTIONS["pool"]) for the length of one call. With
+  CHAT_DB_THREADS = 0, calls stay on asgiref's single thread.
+- Each call's wait for a thread is recorded in chat_db_queue_wait_seconds,
+  and the number of calls waiting is exported as chat_db_queue_depth (see
+  metrics.py).
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync
+from channels.db import DatabaseSyncToAsync as _DatabaseSyncToAsync
+from django.conf import settings
+
+from . import metrics
+
+if settings.CHAT_DB_THREADS:
+    _executor = ThreadPoolExecutor(
+        max_workers=settings.CHAT_DB_THREADS, thread_name_prefix="chat-db"
+    )
+else:
+    _executor = SyncToAsync.single_thread_executor
+
+# Read at scrape time, so counting costs the hot path nothing. _work_queue
+# holds the submitted calls no thread has picked up yet.
+metrics.DB_QUEUE_DEPTH.set_function(_executor._work_queue.qsize)
+
+
+class DatabaseSyncToAsync(_DatabaseSyncToAsync):
+    def __init__(self, func, thread_sensitive=None, executor=None, context=None):
+        # Unless the caller says otherwise, use the thread pool when there
+        # is one: no call depends on running on the same thread as another
+        if thread_sensitive is None:
+            thread_sensitive = not settings.CHAT_DB_THREADS
+        if not thread_sensitive and executor is None:
+            executor = _executor
+        super().__init__(
+            func, thread_sensitive=thread_sensitive, executor=executor, context=context
+        )
+
+    async def __call__(self, *args, **kwargs):
+        queued = time.perf_counter()
+        started, result = await super().__call__(*args, **kwargs)
+        metrics.DB_QUEUE_WAIT.observe(started - queued)
+        return result
+
+    def thread_handler(self, loop, *args, **kwargs):
+        # Runs on the DB thread; its return value is what __call__ awaits
+        started = time.perf_counter()
+        return started, super().thread_handler(loop, *args, **kwargs)
+
+
+database_sync_to_async = DatabaseSyncToAsync
@@ -0,0 +1,76 @@
+"""
+WebSocket frames, encoded once per broadcast.
+
+A group_send used to carry a plain dict that every recipient's consumer
+turned into JSON itself, so a room with 2,000 sockets encoded each message
+2,000 times. Now the sender encodes the finished wire frame once (orjson)
+and the channel layer carries that text; each recipient's ``frame`` handler
+forwards it untouched.
+
+With CHAT_BATCH_WINDOW_MS set, a consumer holds the frames that arrive
+within the window and sends them as one {"type": "batch", "events": [...]}
+frame. Batches are assembled by joining the already-encoded texts, so
+nothing is decoded or encoded again.
+"""
+
+import time
+
+import orjson
+
+from . import metrics
+
+# Flush a batch early once it holds this many events
+BATCH_MAX_EVENTS = 100
+
+
+def encode(payload: dict) -> str:
+    """Encode a frame as the JSON text sent to the browser."""
+    # orjson returns bytes; decode once here so recipients can send it as a
+    # text frame without touching it again.
+    return orjson.dumps(payload).decode()
+
+
+def chat(
+    message_id: int, username: str, message: str, reply_to: dict | None = None
+) -> dict:
+    """A "chat" frame. Live broadcasts and the recent-message snapshot both
+    build it here, so the two encode to the same text."""
+    payload = {
+        "type": "chat",
+        "message": message,
+        "username": username,
+        "message_id": message_id,
+    }
+    if reply_to:
+        payload["reply_to"] = reply_to
+    return payload
+
+
+async def group_send(channel_layer, group: str, payload: dict) -> None:
+    """Broadcast a frame to every socket in a group, encoding it once."""
+    await group_send_text(channel_layer, group, encode(payload))
+
+
+async def group_send_text(channel_layer, group: str, text: str) -> None:
+    """Broadcast an already-encoded frame to every socket in a group."""
+    started = time.perf_counter()
+    await channel_layer.group_send(group, {"type": "frame", "text": text})
+    metrics.group_sent(started)
+
+
+def batch(texts: list[str]) -> str:
+    """Combine encoded frames into one batch frame (a single one is sent as-is)."""
+    if len(texts) == 1:
+        return texts[0]
+    return '{"type":"batch","events":[' + ",".join(texts) + "]}"
+
+
+def replay(texts: list[str], truncated: bool) -> str:
+    """Frame carrying the chat frames a reconnecting client missed."""
+    return (
+        '{"type":"replay","truncated":'
+        + ("true" if truncated else "false")
+        + ',"events":['
+        + ",".join(texts)
+        + "]}"
+    )
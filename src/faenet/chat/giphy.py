@@ -0,0 +1,126 @@
+"""
+Giphy proxy with connection reuse, strict timeouts and two cache tiers.
+
+Lookups go: in-process LRU -> Redis (shared by all workers, with TTL) ->
+upstream. Concurrent requests for the same normalized query share one
+in-flight upstream call instead of each opening their own.
+"""
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+
+import httpx
+import redis
+from django.conf import settings
+
+from .redis_pool import get_redis
+
+SEARCH_TTL = 5 * 60
+TRENDING_TTL = 60 * 60
+LRU_SIZE = 256
+
+_redis = get_redis()
+_client: httpx.AsyncClient | None = None
+_lru: OrderedDict[str, tuple[float, list]] = OrderedDict()
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def normalize(query: str) -> str:
+    """Case- and whitespace-insensitive cache key for a search query."""
+    return " ".join(query.lower().split())
+
+
+async def search(query: str) -> list[dict]:
+    """Return GIF results for a query, or trending GIFs for an empty one.
+
+    Raises httpx.HTTPError (including timeouts) if Giphy has to be asked
+    and fails.
+    """
+    q = normalize(query)
+    key = f"giphy:search:{q}" if q else "giphy:trending"
+
+    results = _lru_get(key)
+    if results is not None:
+        return results
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_load(key, q))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: one impatient client disconnecting mustn't cancel the
+    # upstream call everyone else is waiting on
+    return await asyncio.shield(task)
+
+
+async def _load(key: str, q: str) -> list[dict]:
+    ttl = SEARCH_TTL if q else TRENDING_TTL
+    try:
+        cached = await _redis.get(key)
+    except redis.RedisError:
+        cached = None  # the cache is an optimization, never a dependency
+    if cached is not None:
+        results = json.loads(cached)
+        _lru_put(key, results, ttl)
+        return results
+
+    results = await _fetch(q)
+    _lru_put(key, results, ttl)
+    try:
+        await _redis.set(key, json.dumps(results), ex=ttl)
+    except redis.RedisError:
+        pass
+    return results
+
+
+async def _fetch(q: str) -> list[dict]:
+    endpoint = "search" if q else "trending"
+    params = {"api_key": settings.GIPHY_API_KEY, "limit": 20, "rating": "pg-13"}
+    if q:
+        params["q"] = q
+    resp = await _get_client().get(
+        f"{settings.GIPHY_API_URL}/{endpoint}", params=params
+    )
+    resp.raise_for_status()
+    return [
+        {
+            "id": g["id"],
+            "title": g.get("title", ""),
+            "url": g["images"]["original"]["url"],
+            "preview_url": g["images"]["fixed_height_small"]["url"],
+        }
+        for g in resp.json().get("data", [])
+    ]
+
+
+def _get_client() -> httpx.AsyncClient:
+    # Created lazily so it binds to the server's event loop, then reused for
+    # keep-alive connections across requests.
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.GIPHY_TIMEOUT, connect=1.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return _client
+
+
+def _lru_get(key: str):
+    entry = _lru.get(key)
+    if entry is None:
+        return None
+    expires_at, results = entry
+    if expires_at < time.monotonic():
+        del _lru[key]
+        return None
+    _lru.move_to_end(key)
+    return results
+
+
+def _lru_put(key: str, results: list, ttl: int) -> None:
+    _lru[key] = (time.monotonic() + ttl, results)
+    _lru.move_to_end(key)
+    while len(_lru) > LRU_SIZE:
+        _lru.popitem(last=False)
@@ -0,0 +1,112 @@
+from collections import defaultdict
+
+from django.db.models import Exists, OuterRef, Q, Subquery
+
+from .models import Message, Reaction, ReactionCount
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+
+def fetch_messages(room_id: int, before: int | None = None, limit: int = PAGE_SIZE):
+    """Return (messages, has_more): up to ``limit`` messages older than the
+    message with id ``before`` (or the newest ones), oldest first.
+
+    Keyset pagination on (created_at, id): the cursor's created_at is an
+    index range condition on idx_message_room_created, so page 1,000 costs
+    the same as page 1 -- no OFFSET scan. The id comparison only breaks
+    ties between messages created in the same microsecond.
+    """
+    qs = Message.objects.filter(room_id=room_id)
+    if before is not None:
+        cursor = Subquery(
+            Message.objects.filter(id=before, room_id=room_id).values("created_at")
+        )
+        qs = qs.filter(created_at__lte=cursor).filter(
+            Q(created_at__lt=cursor) | Q(id__lt=before)
+        )
+    page = list(
+        qs.select_related("user", "parent", "parent__user")
+        .defer("search_vector", "parent__search_vector")
+        # One extra row tells us whether an older page exists
+        .order_by("-created_at", "-id")[: limit + 1]
+    )
+    has_more = len(page) > limit
+    # Reverse so oldest is first
+    return list(reversed(page[:limit])), has_more
+
+
+def fetch_messages_after(room_id: int, after: int, limit: int = PAGE_SIZE):
+    """Return (messages, truncated): the newest ``limit`` messages newer
+    than the message with id ``after``, oldest first. ``truncated`` is True
+    when more messages lie between ``after`` and the first one returned.
+
+    The mirror image of fetch_messages(), for replaying what a reconnecting
+    client missed; the same keyset on (created_at, id).
+    """
+    cursor = Subquery(
+        Message.objects.filter(id=after, room_id=room_id).values("created_at")
+    )
+    page = list(
+        Message.objects.filter(room_id=room_id, created_at__gte=cursor)
+        .filter(Q(created_at__gt=cursor) | Q(id__gt=after))
+        .select_related("user", "parent", "parent__user")
+        .defer("search_vector", "parent__search_vector")
+        .order_by("-created_at", "-id")[: limit + 1]
+    )
+    return list(reversed(page[:limit])), len(page) > limit
+
+
+def reaction_summaries(message_ids, user_id: int) -> dict[int, list[dict]]:
+    """Return {message_id: [{emoji, count, reacted_by_me}]} in one query.
+
+    Counts come straight from ReactionCount, so a message with 10k
+    reactions costs one row per emoji instead of 10k Reaction instances.
+    reacted_by_me is an EXISTS probe on unique_user_reaction_per_emoji.
+    Emoji are listed in the order they were first used on each message.
+    """
+    rows = (
+        ReactionCount.objects.filter(message_id__in=message_ids, count__gt=0)
+        .annotate(
+            reacted_by_me=Exists(
+                Reaction.objects.filter(
+                    message_id=OuterRef("message_id"),
+                    emoji=OuterRef("emoji"),
+                    user_id=user_id,
+                )
+            )
+        )
+        .order_by("message_id", "id")
+        .values_list("message_id", "emoji", "count", "reacted_by_me")
+    )
+    summaries = defaultdict(list)
+    for message_id, emoji, count, reacted_by_me in rows:
+        summaries[message_id].append(
+            {"emoji": emoji, "count": count, "reacted_by_me": reacted_by_me}
+        )
+    return summaries
+
+
+def attach_reaction_summaries(messages, user_id: int) -> None:
+    """Set ``reaction_list`` on each message from reaction_summaries()."""
+    summaries = reaction_summaries([msg.id for msg in messages], user_id)
+    for msg in messages:
+        msg.reaction_list = summaries.get(msg.id, [])
+
+
+def serialize_message(msg) -> dict:
+    """JSON shape of a message, matching the WebSocket "chat" frame fields."""
+    data = {
+        "message_id": msg.id,
+        "username": msg.user.username,
+        "message": msg.content,
+        "created_at": msg.created_at.isoformat(),
+        "reactions": getattr(msg, "reaction_list", []),
+    }
+    if msg.parent:
+        data["reply_to"] = {
+            "message_id": msg.parent.id,
+            "username": msg.parent.user.username,
+            "content": msg.parent.content[:100],
+        }
+    return data
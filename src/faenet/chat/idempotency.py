@@ -0,0 +1,70 @@
+"""
+Idempotent chat sends.
+
+The room page keeps every message it sends in an IndexedDB outbox, under a
+UUID it generates, until the server acknowledges it with an "ack" frame;
+whatever is still there after a reconnect (or a reload) is sent again. So
+the same message can arrive more than once, and the server must store and
+broadcast it only the first time.
+
+Each accepted (user, client id) is remembered in Redis:
+
+  sent:{user_id}:{client_id}  "" while the first attempt is being stored
+                              (for at most PENDING_TTL, in case its handler
+                              dies), then the message id for CLIENT_ID_TTL
+
+A retry finds the key and is acknowledged with the stored id instead of
+being inserted again. Message has a unique (user, client_id) constraint as
+the backstop, for a retry arriving after the key expired or was lost with
+Redis.
+"""
+
+import uuid
+
+from .redis_pool import get_redis
+
+_redis = get_redis()
+
+CLIENT_ID_TTL = 24 * 60 * 60
+PENDING_TTL = 60
+
+
+def _key(user_id: int, client_id: str) -> str:
+    return f"sent:{user_id}:{client_id}"
+
+
+def parse(value) -> str | None:
+    """Return the client id from an inbound frame in canonical form, or
+    None if it is missing or not a UUID."""
+    if not isinstance(value, str):
+        return None
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        return None
+
+
+async def claim(user_id: int, client_id: str) -> tuple[bool, int | None]:
+    """Claim a client id for a new message, in one round-trip.
+
+    Returns (True, None) for a first attempt, which the caller goes on to
+    store. For a retry it returns (False, message_id) once the first
+    attempt is stored, or (False, None) while it still is being stored.
+    """
+    previous = await _redis.set(
+        _key(user_id, client_id), "", nx=True, ex=PENDING_TTL, get=True
+    )
+    if previous is None:
+        return True, None
+    return False, int(previous) if previous else None
+
+
+async def stored(user_id: int, client_id: str, message_id: int) -> None:
+    """Record the id a claimed client id was stored under."""
+    await _redis.set(_key(user_id, client_id), message_id, ex=CLIENT_ID_TTL)
+
+
+async def release(user_id: int, client_id: str) -> None:
+    """Give up a claim whose message could not be stored, so the client's
+    next retry is treated as a first attempt."""
+    await _redis.delete(_key(user_id, client_id))
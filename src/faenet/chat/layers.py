@@ -0,0 +1,268 @@
+"""
+Channel layer that fans out through one Redis stream per group.
+
+channels_redis' RedisChannelLayer implements group_send as one push per
+member channel, so Redis does O(connections) work per message, and a
+message waiting for a slow consumer is dropped once the channel's capacity
+or expiry is hit. Here:
+
+  group_send  -- one XADD to the group's stream, whatever its size
+  receiving   -- each worker (one per event loop) runs a single XREAD over
+                 the streams of the groups its sockets belong to, then hands
+                 every entry to its local members in-process
+
+so Redis work per message is O(workers that have a member). The stream
+keeps the last ``maxlen`` entries, and each worker reads from its own
+position, so a worker that stalls briefly catches up instead of losing
+events.
+
+Direct sends to a specific channel go to an inbox stream of the worker
+that owns it (the worker id is part of the channel name). Only specific
+channels (``new_channel()`` names) are supported, which is all that
+Channels consumers use.
+
+Enable with CHANNEL_LAYER_BACKEND=streams (see settings.py).
+"""
+
+import asyncio
+import logging
+import uuid
+
+import msgpack
+import redis
+import redis.asyncio
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+
+class RedisStreamChannelLayer(BaseChannelLayer):
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        hosts=None,
+        prefix="streams",
+        maxlen=1000,
+        group_expiry=86400,
+        block_ms=5000,
+        expiry=60,
+        capacity=100,
+        channel_capacity=None,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.url = (hosts or ["redis://localhost:6379/0"])[0]
+        self.prefix = prefix
+        self.maxlen = maxlen
+        self.group_expiry = group_expiry
+        self.block_ms = block_ms
+        # redis.asyncio connections belong to the loop that opened them, so
+        # each event loop using this layer is its own worker
+        self._workers: dict[asyncio.AbstractEventLoop, _Worker] = {}
+
+    def _worker(self) -> "_Worker":
+        loop = asyncio.get_running_loop()
+        worker = self._workers.get(loop)
+        if worker is None:
+            for old in [lp for lp in self._workers if lp.is_closed()]:
+                del self._workers[old]
+            worker = self._workers[loop] = _Worker(self)
+        return worker
+
+    def _group_key(self, group: str) -> str:
+        return f"{self.prefix}:group:{group}"
+
+    def _inbox_key(self, worker_id: str) -> str:
+        return f"{self.prefix}:inbox:{worker_id}"
+
+    # Channel layer API
+
+    async def new_channel(self, prefix="specific"):
+        worker = self._worker()
+        channel = f"{prefix}.{worker.id}!{uuid.uuid4().hex}"
+        worker.queue(channel)
+        worker.start()
+        return channel
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        if "!" not in channel:
+            raise ValueError(
+                "RedisStreamChannelLayer only supports specific channels "
+                "(from new_channel())"
+            )
+        worker = self._worker()
+        owner = channel[: channel.index("!")].rsplit(".", 1)[-1]
+        if owner == worker.id:
+            worker.deliver(channel, message)
+            return
+        await worker.xadd(
+            self._inbox_key(owner),
+            {"c": channel, "m": msgpack.packb(message, use_bin_type=True)},
+            self.expiry,
+        )
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        worker = self._worker()
+        worker.start()
+        try:
+            return await worker.queue(channel).get()
+        except asyncio.CancelledError:
+            # The consumer that owned this channel has stopped
+            worker.drop(channel)
+            raise
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._worker().join(group, channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self._worker().leave(group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        await self._worker().xadd(
+            self._group_key(group),
+            {"m": msgpack.packb(message, use_bin_type=True)},
+            self.group_expiry,
+        )
+
+    async def flush(self):
+        worker = self._worker()
+        await worker.close()
+        del self._workers[asyncio.get_running_loop()]
+        client = redis.asyncio.Redis.from_url(self.url)
+        try:
+            async for key in client.scan_iter(match=f"{self.prefix}:*"):
+                await client.delete(key)
+        finally:
+            await client.aclose()
+
+    async def close(self):
+        worker = self._workers.pop(asyncio.get_running_loop(), None)
+        if worker is not None:
+            await worker.close()
+
+
+class _Worker:
+    """One event loop's share of the layer: its sockets' queues, the groups
+    they are in, and the reader task that feeds them."""
+
+    def __init__(self, layer: RedisStreamChannelLayer):
+        self.layer = layer
+        self.id = uuid.uuid4().hex[:12]
+        self.redis = redis.asyncio.Redis.from_url(layer.url)
+        self.queues: dict[str, asyncio.Queue] = {}
+        self.groups: dict[str, set[str]] = {}
+        # stream key -> last entry id read; the inbox is always read
+        self.inbox = layer._inbox_key(self.id)
+        self.offsets: dict[str, str] = {self.inbox: "0-0"}
+        self.reader: asyncio.Task | None = None
+        self.join_lock = asyncio.Lock()
+
+    def start(self) -> None:
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.get_running_loop().create_task(self._read())
+
+    def queue(self, channel: str) -> asyncio.Queue:
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = asyncio.Queue(
+                maxsize=self.layer.get_capacity(channel)
+            )
+        return queue
+
+    def drop(self, channel: str) -> None:
+        self.queues.pop(channel, None)
+        for group in [g for g, members in self.groups.items() if channel in members]:
+            self.leave(group, channel)
+
+    async def join(self, group: str, channel: str) -> None:
+        # Serialized so a second socket joining a group whose subscription
+        # is still being set up waits for it instead of returning early
+        async with self.join_lock:
+            if group not in self.groups:
+                key = self.layer._group_key(group)
+                # Start right after the newest entry: anything sent once
+                # group_add returns is delivered, nothing older is replayed
+                newest = await self.redis.xrevrange(key, count=1)
+                self.offsets[key] = newest[0][0].decode() if newest else "0-0"
+                self.groups[group] = set()
+                # Wake the reader so it picks up the new stream now rather
+                # than when its current XREAD times out
+                await self.xadd(self.inbox, {"w": ""}, self.layer.expiry)
+                self.start()
+            self.groups[group].add(channel)
+
+    def leave(self, group: str, channel: str) -> None:
+        members = self.groups.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if not members:
+            del self.groups[group]
+            self.offsets.pop(self.layer._group_key(group), None)
+
+    def deliver(self, channel: str, message: dict) -> None:
+        queue = self.queues.get(channel)
+        if queue is None:
+            return  # the consumer is gone
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning("Channel %s is full, dropping message", channel)
+            raise ChannelFull(channel)
+
+    async def xadd(self, key: str, fields: dict, expiry: int) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.xadd(key, fields, maxlen=self.layer.maxlen, approximate=True)
+            pipe.expire(key, expiry)
+            await pipe.execute()
+
+    async def close(self) -> None:
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.redis.aclose()
+
+    async def _read(self) -> None:
+        group_prefix = f"{self.layer.prefix}:group:"
+        while True:
+            try:
+                response = await self.redis.xread(
+                    dict(self.offsets), block=self.layer.block_ms, count=500
+                )
+            except redis.RedisError:
+                logger.exception("Stream channel layer read failed")
+                await asyncio.sleep(1)
+                continue
+            for key, entries in response:
+                key = key.decode()
+                if key not in self.offsets:
+                    continue  # last local member left while we were blocked
+                for entry_id, fields in entries:
+                    self.offsets[key] = entry_id.decode()
+                    payload = fields.get(b"m")
+                    if payload is None:
+                        continue  # wake-up marker
+                    message = msgpack.unpackb(payload, raw=False)
+                    if key == self.inbox:
+                        self._deliver_quietly(fields[b"c"].decode(), message)
+                        continue
+                    group = key[len(group_prefix) :]
+                    for channel in list(self.groups.get(group, ())):
+                        self._deliver_quietly(channel, dict(message))
+
+    def _deliver_quietly(self, channel: str, message: dict) -> None:
+        try:
+            self.deliver(channel, message)
+        except ChannelFull:
+            pass  # logged; one full socket mustn't stall the whole worker
@@ -0,0 +1,86 @@
+import asyncio
+import time
+import uuid
+
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from faenet.chat.layers import RedisStreamChannelLayer
+from faenet.chat.redis_pool import get_sync_redis
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare group fan-out through channels_redis' RedisChannelLayer and "
+        "RedisStreamChannelLayer: --subscribers channels spread over --workers "
+        "layer instances, one group_send per message. Reports delivery rate, "
+        "lost messages and Redis commands per message. Uses its own key "
+        "prefix, so it is safe to run next to a live server."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subscribers", type=int, default=1000)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--messages", type=int, default=200)
+        parser.add_argument("--timeout", type=float, default=30)
+
+    def handle(self, *args, **options):
+        hosts = settings.CHANNEL_LAYERS["default"]["CONFIG"]["hosts"]
+        for label, backend in (
+            ("RedisChannelLayer", RedisChannelLayer),
+            ("RedisStreamChannelLayer", RedisStreamChannelLayer),
+        ):
+            prefix = f"bench-layers-{uuid.uuid4().hex[:8]}"
+            layers = [
+                backend(hosts=hosts, prefix=prefix) for _ in range(options["workers"])
+            ]
+            commands_before = _commands_processed()
+            elapsed, delivered = asyncio.run(self._run(layers, options))
+            commands = _commands_processed() - commands_before
+
+            expected = options["subscribers"] * options["messages"]
+            self.stdout.write(
+                f"{label:<24} {delivered / elapsed:10.0f} deliveries/s  "
+                f"lost {expected - delivered:>7}/{expected}  "
+                f"{commands / options['messages']:8.1f} Redis commands/msg"
+            )
+
+    async def _run(self, layers, options):
+        n, messages = options["subscribers"], options["messages"]
+        group = "bench"
+        channels = []
+        for i in range(n):
+            layer = layers[i % len(layers)]
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+            channels.append((layer, channel))
+
+        received = [0]
+
+        async def receive(layer, channel):
+            for _ in range(messages):
+                await layer.receive(channel)
+                received[0] += 1
+
+        receivers = [asyncio.create_task(receive(*c)) for c in channels]
+        start = time.perf_counter()
+        for i in range(messages):
+            await layers[0].group_send(group, {"type": "frame", "text": str(i)})
+        # Whatever hasn't arrived by the deadline was dropped by the layer
+        await asyncio.wait(receivers, timeout=options["timeout"])
+        elapsed = time.perf_counter() - start
+        for task in receivers:
+            task.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+
+        await layers[0].flush()
+        for layer in layers:
+            # channels_redis calls it close_pools()
+            close = getattr(layer, "close_pools", None) or layer.close
+            await close()
+        return elapsed, received[0]
+
+
+def _commands_processed() -> int:
+    return get_sync_redis().info("stats")["total_commands_processed"]
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import statistics
+import time
+
+from channels.db import database_sync_to_async as plain_database_sync_to_async
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from faenet.chat import frames, metrics
+from faenet.chat.db import database_sync_to_async
+
+GROUP = "bench-metrics"
+TEXT = json.dumps({"message": "Has anyone seen the will-o'-the-wisps tonight?"})
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare inbound chat frame throughput with and without the "
+        "Prometheus instrumentation (chat/metrics.py). Each frame takes the "
+        "consumer's path minus Postgres and Redis: decode, --queries "
+        "stand-in queries on the DB thread, encode, group_send to "
+        "--subscribers sockets on an in-process layer and drain them. "
+        "Plain and instrumented batches alternate and the medians are "
+        "compared, so drift in the thread hop hits both alike."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batches", type=int, default=100)
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--subscribers", type=int, default=10)
+        parser.add_argument("--queries", type=int, default=2)
+
+    def handle(self, *args, **options):
+        plain, instrumented = asyncio.run(self._run(options))
+        self.stdout.write(f"plain         {1_000_000 / plain:10.0f} frames/s")
+        self.stdout.write(f"instrumented  {1_000_000 / instrumented:10.0f} frames/s")
+        self.stdout.write(
+            f"overhead      {instrumented - plain:10.1f} µs/frame "
+            f"({(instrumented / plain - 1) * 100:.1f}%)"
+        )
+
+    async def _run(self, options):
+        """Return the median µs per frame, plain and instrumented."""
+        size = options["batch_size"]
+        layer = InMemoryChannelLayer(capacity=size + 1)
+        channels = [await layer.new_channel() for _ in range(options["subscribers"])]
+        for channel in channels:
+            await layer.group_add(GROUP, channel)
+
+        timings = {False: [], True: []}
+        for _ in range(options["batches"]):
+            for instrumented in (False, True):
+                start = time.perf_counter()
+                for _ in range(size):
+                    await self._frame(instrumented, layer, channels, options)
+                elapsed = time.perf_counter() - start
+                timings[instrumented].append(elapsed / size * 1_000_000)
+        return statistics.median(timings[False]), statistics.median(timings[True])
+
+    async def _frame(self, instrumented, layer, channels, options):
+        data = json.loads(TEXT)
+        if not instrumented:
+            await self._handle(data, plain_database_sync_to_async, _execute, options)
+            await layer.group_send(GROUP, {"type": "frame", "text": self._text(data)})
+        else:
+            with metrics.frame(data.get("type", "chat_message")):
+                await self._handle(
+                    data, database_sync_to_async, _counted_execute, options
+                )
+                await frames.group_send_text(layer, GROUP, self._text(data))
+        for channel in channels:
+            await layer.receive(channel)
+
+    async def _handle(self, data, to_async, execute, options):
+        def save():
+            for _ in range(options["queries"]):
+                execute()
+            return 1
+
+        # Same thread both ways (db.py would pick its pool), so only the
+        # instrumentation differs
+        await to_async(save, thread_sensitive=True)()
+
+    def _text(self, data):
+        return frames.encode(frames.chat(1, "titania", data["message"]))
+
+
+def _execute(*args):
+    return None
+
+
+def _counted_execute():
+    # What the execute wrapper from signals.py adds to each query
+    return metrics.count_query(_execute, "", None, False, {})
@@ -0,0 +1,120 @@
+import asyncio
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from faenet.chat import presence
+from faenet.chat.redis_pool import get_sync_redis
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure event-loop lag while many WebSocket connects hit the presence "
+        "store at once (async pipelined client vs. the old blocking calls)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=1000)
+        parser.add_argument(
+            "--room",
+            default="bench-presence",
+            help="Slug prefix; each run uses a fresh room under it",
+        )
+
+    def handle(self, *args, **options):
+        n = options["connections"]
+
+        for label, join in (
+            ("blocking redis.Redis", self._blocking_join),
+            ("redis.asyncio pipeline", self._async_join),
+        ):
+            # A room no live worker has sockets in, removed afterwards with
+            # every key the joins touched. Left behind, its members would
+            # sit in presence_seen until a live server's reaper broadcast
+            # "left" deltas for users that never existed.
+            slug = f"{options['room']}-{uuid.uuid4().hex[:8]}"
+            members = []
+            try:
+                lags, elapsed = asyncio.run(self._run(join, slug, n, members))
+            finally:
+                _cleanup(slug, members)
+            self.stdout.write(
+                f"{label:<24} {n} joins in {elapsed * 1000:8.1f} ms | loop lag "
+                f"p50={statistics.median(lags):6.2f} ms "
+                f"p99={_percentile(lags, 99):6.2f} ms "
+                f"max={max(lags):6.2f} ms"
+            )
+
+    async def _run(self, join, slug, n, members):
+        lags = []
+        done = asyncio.Event()
+        for i in range(n):
+            members.append((f"user{i % 50}", f"bench.{uuid.uuid4().hex}"))
+
+        async def probe():
+            # A 1 ms ticker: any extra delay is time the loop spent blocked.
+            while not done.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append((time.perf_counter() - start) * 1000 - 1)
+
+        probe_task = asyncio.create_task(probe())
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(join(slug, username, channel) for username, channel in members)
+        )
+        elapsed = time.perf_counter() - start
+        done.set()
+        await probe_task
+        return lags or [0.0], elapsed
+
+    async def _async_join(self, slug, username, channel_name):
+        await presence.user_joined(slug, username, channel_name, cooldown=1)
+
+    async def _blocking_join(self, slug, username, channel_name):
+        # The pre-asyncio code path: three sequential blocking round-trips
+        # executed directly on the event loop.
+        client = _blocking_client()
+        client.hset(f"presence:{slug}", channel_name, username)
+        client.set(f"announce:{slug}:{username}:join", "1", nx=True, ex=1)
+        client.hvals(f"presence:{slug}")
+
+
+_sync_client = None
+
+
+def _blocking_client():
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = get_sync_redis()
+    return _sync_client
+
+
+def _cleanup(slug, members):
+    """Remove every trace of a benchmark room from Redis."""
+    client = _blocking_client()
+    usernames = {username for username, _ in members}
+    seen = [presence._member(slug, channel, username) for username, channel in members]
+    with client.pipeline(transaction=False) as pipe:
+        pipe.delete(
+            presence._key(slug),
+            presence._users_key(slug),
+            presence._version_key(slug),
+            *(
+                presence._announce_key(slug, username, action)
+                for username in usernames
+                for action in ("join", "leave")
+            ),
+        )
+        pipe.hdel(presence.ONLINE_COUNTS_KEY, slug)
+        for i in range(0, len(seen), presence._BATCH):
+            pipe.zrem(presence._SEEN_KEY, *seen[i : i + presence._BATCH])
+        pipe.execute()
+    presence._local.difference_update(seen)
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
@@ -0,0 +1,65 @@
+import asyncio
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from faenet.chat.ratelimit import LEASE_MAX, RateLimiter
+from faenet.chat.redis_pool import get_sync_redis
+
+BUDGET_US = 100
+
+# Generous limits so every frame is allowed and takes the full path
+UNLIMITED = (1_000_000, 1_000_000)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure rate limiter overhead per inbound frame: the in-process "
+        "connection bucket alone, and connection + user + room (one Redis "
+        f"Lua call per lease of up to {LEASE_MAX} tokens). The budget is "
+        f"{BUDGET_US} µs per frame at p50; p99 is the frame that renews the "
+        "lease, i.e. one Redis round-trip."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--frames", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        n = options["frames"]
+        run = uuid.uuid4().hex[:8]
+        for label, limits in (
+            ("connection bucket only", {"connection": UNLIMITED}),
+            (
+                "connection + user + room",
+                {"connection": UNLIMITED, "user": UNLIMITED, "room": UNLIMITED},
+            ),
+        ):
+            with override_settings(CHAT_RATE_LIMITS={"message": limits}):
+                timings = asyncio.run(self._run(n, f"bench-ratelimit-{run}"))
+            p50 = statistics.median(timings)
+            p99 = sorted(timings)[int(len(timings) * 0.99)]
+            verdict = (
+                self.style.SUCCESS("within budget")
+                if p50 <= BUDGET_US
+                else self.style.WARNING("over budget")
+            )
+            self.stdout.write(
+                f"{label:<26} p50={p50:8.1f} µs  p99={p99:8.1f} µs  [{verdict}]"
+            )
+
+        get_sync_redis().delete(
+            "ratelimit:message:user:0", f"ratelimit:message:room:bench-ratelimit-{run}"
+        )
+
+    async def _run(self, n, room):
+        limiter = RateLimiter(0, room)
+        await limiter.check("message")  # load the script, open the connection
+        timings = []
+        for _ in range(n):
+            start = time.perf_counter()
+            await limiter.check("message")
+            timings.append((time.perf_counter() - start) * 1_000_000)
+        return timings
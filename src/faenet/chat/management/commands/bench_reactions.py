@@ -0,0 +1,80 @@
+import time
+from collections import Counter, defaultdict
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Prefetch
+from django.test.utils import CaptureQueriesContext
+
+from faenet.chat.history import reaction_summaries
+from faenet.chat.models import ChatRoom, Message, Reaction, ReactionCount
+
+EMOJI = ["❤️", "😂", "👍", "🔥", "👀", "🎉"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare reaction summary cost for a message with many reactions: "
+        "prefetch + Python loop vs. the ReactionCount aggregate. "
+        "Runs inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reactions", type=int, default=10_000)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            message, viewer = self._seed(options["reactions"])
+            for label, fn in (
+                ("prefetch + python loop", self._legacy),
+                ("ReactionCount aggregate", self._aggregate),
+            ):
+                self._time(label, fn, message, viewer, options["repeat"])
+            transaction.set_rollback(True)
+
+    def _seed(self, n):
+        User = get_user_model()
+        room = ChatRoom.objects.create(name=f"bench-reactions-{time.time_ns()}")
+        users = User.objects.bulk_create(
+            User(username=f"bench-reactor-{room.id}-{i}") for i in range(n)
+        )
+        message = Message.objects.create(room=room, user=users[0], content="viral")
+        # bulk_create skips the counter signals, so fill ReactionCount here
+        reactions = Reaction.objects.bulk_create(
+            Reaction(message=message, user=u, emoji=EMOJI[i % len(EMOJI)])
+            for i, u in enumerate(users)
+        )
+        counts = Counter(r.emoji for r in reactions)
+        ReactionCount.objects.bulk_create(
+            ReactionCount(message=message, emoji=e, count=c) for e, c in counts.items()
+        )
+        self.stdout.write(f"Seeded {n} reactions on one message")
+        return message, users[0]
+
+    def _time(self, label, fn, message, viewer, repeat):
+        with CaptureQueriesContext(connection) as ctx:
+            fn(message, viewer)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn(message, viewer)
+        per_call = (time.perf_counter() - start) / repeat * 1000
+        self.stdout.write(
+            f"{label:<24} {per_call:8.2f} ms/page  {len(ctx.captured_queries)} queries"
+        )
+
+    def _legacy(self, message, viewer):
+        # The room_detail code path before summaries moved into SQL
+        msgs = Message.objects.filter(id=message.id).prefetch_related(
+            Prefetch("reactions", queryset=Reaction.objects.select_related("user"))
+        )
+        for msg in msgs:
+            emoji_data = defaultdict(lambda: {"count": 0, "reacted_by_me": False})
+            for r in msg.reactions.all():
+                emoji_data[r.emoji]["count"] += 1
+                if r.user.username == viewer.username:
+                    emoji_data[r.emoji]["reacted_by_me"] = True
+
+    def _aggregate(self, message, viewer):
+        reaction_summaries([message.id], viewer.id)
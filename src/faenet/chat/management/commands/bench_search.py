@@ -0,0 +1,180 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from faenet.chat.models import ChatRoom, Message
+from faenet.chat.search import search_messages
+
+BUDGET_MS = 100
+SEED_BATCH = 250_000
+
+_SYLLABLES = [
+    "fae", "ri", "glim", "mer", "thorn", "moss", "wil", "low", "dew", "brook",
+    "lun", "ar", "shade", "fen", "whis", "per", "oak", "elf", "gla", "mour",
+    "bram", "ble", "spri", "te", "ny", "sil", "ver", "mist", "hol", "ly",
+]  # fmt: skip
+
+_INSERT_SQL = """
+INSERT INTO {message} (room_id, user_id, content, created_at)
+SELECT (%(rooms)s::bigint[])[1 + g %% %(room_count)s],
+       %(user_id)s,
+       (SELECT string_agg(
+                   (%(words)s::text[])[
+                       1 + floor(power(random(), 3) * %(word_count)s)::int
+                   ],
+                   ' '
+               )
+        FROM generate_series(1, 3 + g %% 13)),
+       now() - make_interval(secs => %(target)s - g)
+FROM generate_series(%(first)s, %(last)s) AS g
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark message search (chat/search.py). Seeds --messages "
+        "synthetic messages into bench-search rooms (once; reruns top up), "
+        "then times ranked word search in one room and across rooms, the "
+        f"first two pages, and substring search. The budget is {BUDGET_MS} ms "
+        "p95."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=5_000_000)
+        parser.add_argument("--rooms", type=int, default=20)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument(
+            "--drop", action="store_true", help="Delete the bench rooms and exit"
+        )
+
+    def handle(self, *args, **options):
+        if options["drop"]:
+            rooms = ChatRoom.objects.filter(slug__startswith="bench-search-")
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {Message._meta.db_table} WHERE room_id = ANY(%s)",
+                    [list(rooms.values_list("id", flat=True))],
+                )
+            rooms.delete()
+            self.stdout.write("Dropped the bench-search rooms")
+            return
+
+        rng = random.Random(42)
+        words = sorted(
+            {
+                "".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4)))
+                for _ in range(6000)
+            }
+        )
+        rng.shuffle(words)  # frequency rank must not follow spelling
+        rooms = self._seed(options, words)
+
+        # Word i is drawn with probability ~ i^(-2/3): words[:10] are very
+        # common, words[100:200] middling, words[3000:] rare
+        cases = {
+            "common word": lambda: rng.choice(words[:10]),
+            "mid word": lambda: rng.choice(words[100:200]),
+            "rare word": lambda: rng.choice(words[3000:]),
+            "two words": lambda: f"{rng.choice(words[:50])} {rng.choice(words[:200])}",
+            "phrase": lambda: f'"{rng.choice(words[:30])} {rng.choice(words[:30])}"',
+        }
+        for label, make_text in cases.items():
+            texts = [make_text() for _ in range(options["queries"])]
+            self._report(
+                f"{label}, one room",
+                [
+                    lambda t=t: search_messages(t, room_id=rng.choice(rooms))
+                    for t in texts
+                ],
+            )
+            self._report(
+                f"{label}, all rooms", [lambda t=t: search_messages(t) for t in texts]
+            )
+
+        texts = [rng.choice(words[:50]) for _ in range(options["queries"])]
+        self._report(
+            "pages 1 + 2, one room", [self._second_page(t, rooms, rng) for t in texts]
+        )
+        fragments = [rng.choice(words[:500])[1:4] for _ in range(options["queries"])]
+        self._report(
+            "substring, one room",
+            [
+                lambda f=f: search_messages(
+                    f, room_id=rng.choice(rooms), substring=True
+                )
+                for f in fragments
+            ],
+        )
+
+    def _seed(self, options, words):
+        user, _ = get_user_model().objects.get_or_create(username="bench-search")
+        rooms = [
+            ChatRoom.objects.get_or_create(
+                slug=f"bench-search-{i}",
+                defaults={"name": f"Bench search {i}", "created_by": user},
+            )[0].id
+            for i in range(options["rooms"])
+        ]
+        have = Message.objects.filter(room_id__in=rooms).count()
+        target = options["messages"]
+        if have >= target:
+            self.stdout.write(f"Using {have} existing bench messages")
+            return rooms
+
+        sql = _INSERT_SQL.format(message=Message._meta.db_table)
+        start = time.perf_counter()
+        for first in range(have + 1, target + 1, SEED_BATCH):
+            last = min(first + SEED_BATCH - 1, target)
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    sql,
+                    {
+                        "rooms": rooms,
+                        "room_count": len(rooms),
+                        "user_id": user.id,
+                        "words": words,
+                        "word_count": len(words),
+                        "first": first,
+                        "last": last,
+                        "target": target,
+                    },
+                )
+            self.stdout.write(f"  seeded {last}/{target}")
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Message._meta.db_table}")
+        self.stdout.write(
+            f"Seeded {target - have} messages in {time.perf_counter() - start:.0f} s"
+        )
+        return rooms
+
+    def _second_page(self, text, rooms, rng):
+        room_id = rng.choice(rooms)
+
+        def run():
+            _, cursor = search_messages(text, room_id=room_id)
+            if cursor:
+                search_messages(text, room_id=room_id, cursor=cursor)
+
+        return run
+
+    def _report(self, label, runs):
+        timings = []
+        for run in runs:
+            start = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        p50 = statistics.median(timings)
+        p95 = timings[int(len(timings) * 0.95)]
+        verdict = (
+            self.style.SUCCESS("within budget")
+            if p95 <= BUDGET_MS
+            else self.style.WARNING("over budget")
+        )
+        self.stdout.write(
+            f"{label:<28} p50={p50:7.1f} ms  p95={p95:7.1f} ms  [{verdict}]"
+        )
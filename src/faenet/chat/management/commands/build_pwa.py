@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from faenet.chat.pwa import assets, webroot
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the PWA assets (service worker, manifest, icons) under "
+        "STATIC_ROOT/webroot/, laid out by URL, for nginx to serve. Run after "
+        "collectstatic; the entrypoint does both."
+    )
+
+    def handle(self, *args, **options):
+        root = webroot()
+        for path, asset in assets().items():
+            target = root / path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # Only rewrite changed files, so nginx's Last-Modified/ETag (from
+            # the file's mtime) survive restarts and replicas
+            if target.exists() and target.read_bytes() == asset.body:
+                continue
+            target.write_bytes(asset.body)
+            self.stdout.write(f"  wrote {path} {asset.etag}")
+        self.stdout.write(f"PWA assets in {root}")
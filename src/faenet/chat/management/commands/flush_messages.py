@@ -0,0 +1,19 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from faenet.chat import writebehind
+
+
+class Command(BaseCommand):
+    help = (
+        "Persist any chat messages still queued by write-behind mode "
+        "(crash recovery; safe to run at every startup)"
+    )
+
+    def handle(self, *args, **options):
+        flushed = asyncio.run(writebehind.flush())
+        if flushed:
+            self.stdout.write(self.style.SUCCESS(f"Flushed {flushed} queued messages"))
+        else:
+            self.stdout.write("No queued messages")
@@ -0,0 +1,396 @@
+import asyncio
+import json
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict, deque
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from faenet.chat import metrics, writebehind
+from faenet.chat.models import ChatRoom
+from faenet.chat.redis_pool import get_sync_redis
+from faenet.chat.routing import websocket_urlpatterns
+
+PREFIX = "loadtest"
+EMOJI = ["❤️", "😂", "👍", "🔥", "👀", "🎉"]
+
+IN_MEMORY_LAYER = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "CONFIG": {"capacity": 1000},
+    }
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the chat stack in-process: open --clients authenticated "
+        "WebSocket connections through the real consumer (no server or "
+        "browser), spread over --rooms rooms, then drive chat messages, "
+        "reactions and reconnects at the given rates for --duration seconds. "
+        "Reports fan-out latency (send to receipt by each member of the "
+        "room), throughput, and DB queries and Redis commands per message. "
+        "Needs Redis and the database. --layer memory swaps in channels' "
+        "in-process layer, whose receive scans every channel: fine for a few "
+        "hundred clients, quadratic beyond. The loadtest-* users and rooms, "
+        "with everything posted in them, are deleted afterwards unless --keep "
+        "is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=1000)
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--duration", type=float, default=30)
+        parser.add_argument(
+            "--message-rate", type=float, default=50, help="Messages/s, all rooms"
+        )
+        parser.add_argument(
+            "--reaction-rate", type=float, default=10, help="Reactions/s"
+        )
+        parser.add_argument("--join-rate", type=float, default=5, help="Reconnects/s")
+        parser.add_argument(
+            "--layer",
+            choices=["memory", "settings"],
+            default="settings",
+            help="The layer configured in settings, or channels' in-process one",
+        )
+        parser.add_argument(
+            "--rate-limits",
+            action="store_true",
+            help="Keep CHAT_RATE_LIMITS (off by default, they'd cap the load)",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Leave the loadtest-* users, rooms and messages in place",
+        )
+
+    def handle(self, *args, **options):
+        if options["clients"] < options["rooms"]:
+            raise CommandError("--clients must be at least --rooms")
+        users = self._users(options["clients"])
+        rooms = self._rooms(options["rooms"])
+
+        overrides = {}
+        if not options["rate_limits"]:
+            overrides["CHAT_RATE_LIMITS"] = {}
+        if options["layer"] == "memory":
+            overrides["CHANNEL_LAYERS"] = IN_MEMORY_LAYER
+        try:
+            with override_settings(**overrides):
+                run = asyncio.run(self._run(users, rooms, options))
+        finally:
+            if not options["keep"]:
+                self._cleanup()
+        self._report(run)
+
+    def _users(self, n):
+        User = get_user_model()
+        names = [f"{PREFIX}-{i}" for i in range(n)]
+        User.objects.bulk_create(
+            [User(username=name) for name in names], ignore_conflicts=True
+        )
+        users = {u.username: u for u in User.objects.filter(username__in=names)}
+        return [users[name] for name in names]
+
+    def _rooms(self, n):
+        return [
+            ChatRoom.objects.get_or_create(
+                slug=f"{PREFIX}-{i}", defaults={"name": f"Load test {i}"}
+            )[0].slug
+            for i in range(n)
+        ]
+
+    def _cleanup(self):
+        # Rooms first: their messages and reactions cascade with them
+        User = get_user_model()
+        rooms = ChatRoom.objects.filter(slug__startswith=f"{PREFIX}-").delete()[0]
+        users = User.objects.filter(username__startswith=f"{PREFIX}-").delete()[0]
+        self.stdout.write(f"Cleaned up {rooms + users} loadtest rows (--keep to leave)")
+
+    async def _run(self, users, rooms, options):
+        app = URLRouter(websocket_urlpatterns)
+        stats = _Stats()
+        clients = [
+            _Client(app, user, rooms[i % len(rooms)], stats)
+            for i, user in enumerate(users)
+        ]
+
+        start = time.perf_counter()
+        gate = asyncio.Semaphore(100)
+
+        async def connect(client):
+            async with gate:
+                await client.connect()
+
+        await asyncio.gather(*(connect(c) for c in clients))
+        stats.connect_seconds = time.perf_counter() - start
+        self.stdout.write(f"Connected {len(clients)} clients, running load")
+
+        # Connections aren't persistent, so every database_sync_to_async
+        # call connects (or borrows from the pool) and fires the signal
+        counter = _QueryCounter()
+        connection_created.connect(counter.install)
+        commands_before = _commands_processed()
+        persist_before = _buckets(metrics.MESSAGE_PERSIST)
+        stats.reset()
+        counter.active = True
+
+        drivers = [
+            asyncio.create_task(
+                _every(options["message_rate"], _send_message, clients, stats)
+            ),
+            asyncio.create_task(
+                _every(options["reaction_rate"], _send_reaction, clients, stats)
+            ),
+            asyncio.create_task(_every(options["join_rate"], _rejoin, clients, stats)),
+        ]
+        await asyncio.sleep(options["duration"])
+        for task in drivers:
+            task.cancel()
+        await asyncio.gather(*drivers, return_exceptions=True)
+        stats.elapsed = time.perf_counter() - stats.started
+        await asyncio.sleep(2)  # let in-flight fan-out land
+
+        stats.redis_commands = _commands_processed() - commands_before
+        stats.persist = _quantiles(
+            persist_before, _buckets(metrics.MESSAGE_PERSIST), (0.5, 0.99)
+        )
+        counter.active = False
+        connection_created.disconnect(counter.install)
+        stats.queries = counter.count
+        await asyncio.gather(*stats.rejoining, return_exceptions=True)
+        await asyncio.gather(*(c.disconnect() for c in clients if c.connected))
+        if settings.CHAT_WRITE_BEHIND and not options["keep"]:
+            # Else the flusher would insert into rooms the cleanup deleted
+            await writebehind.flush()
+        return stats
+
+    def _report(self, stats):
+        sent = max(stats.sent, 1)
+        latencies = sorted(stats.latencies) or [0.0]
+        self.stdout.write(
+            f"Connected in {stats.connect_seconds:.1f} s; "
+            f"sent {stats.sent} messages, {stats.reactions} reactions, "
+            f"{stats.rejoins} reconnects in {stats.elapsed:.1f} s"
+        )
+        self.stdout.write(
+            f"  throughput       {stats.sent / stats.elapsed:10.1f} messages/s  "
+            f"{len(stats.latencies) / stats.elapsed:10.1f} deliveries/s"
+        )
+        self.stdout.write(
+            f"  delivered        {len(stats.latencies)}/{stats.expected} "
+            f"({stats.lost} lost)"
+        )
+        self.stdout.write(
+            f"  fan-out latency  p50={statistics.median(latencies):8.2f} ms  "
+            f"p99={latencies[int(len(latencies) * 0.99)]:8.2f} ms  "
+            f"max={latencies[-1]:8.2f} ms"
+        )
+        self.stdout.write(
+            f"  persist latency  p50={stats.persist[0] * 1000:8.2f} ms  "
+            f"p99={stats.persist[1] * 1000:8.2f} ms  "
+            f"(CHAT_DB_THREADS={settings.CHAT_DB_THREADS}, "
+            f"CHAT_DB_POOL_SIZE={settings.CHAT_DB_POOL_SIZE})"
+        )
+        self.stdout.write(
+            f"  per message      {stats.queries / sent:6.2f} DB queries  "
+            f"{stats.redis_commands / sent:8.1f} Redis commands"
+        )
+        self.stdout.write(
+            "  (queries and Redis commands include reactions, reconnects and "
+            "background tasks, divided by messages sent)"
+        )
+
+
+class _Stats:
+    def __init__(self):
+        self.connect_seconds = 0.0
+        self.redis_commands = 0
+        self.rejoining = set()
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        self.sent = self.reactions = self.rejoins = 0
+        self.expected = 0
+        self.latencies = []
+        self.queries = 0
+        self.persist = (0.0, 0.0)
+        # Recent message ids per room, for reactions to target
+        self.message_ids = defaultdict(lambda: deque(maxlen=50))
+
+    @property
+    def lost(self):
+        return self.expected - len(self.latencies)
+
+    def frame(self, client, data):
+        if data.get("type") != "chat":
+            return
+        self.message_ids[client.slug].append(data["message_id"])
+        fields = data["message"].split(" ")
+        if fields[0] == PREFIX and len(fields) == 3:
+            self.latencies.append((time.perf_counter() - float(fields[2])) * 1000)
+
+
+class _Client:
+    def __init__(self, app, user, slug, stats):
+        self.app = app
+        self.user = user
+        self.slug = slug
+        self.stats = stats
+        self.communicator = None
+        self.reader = None
+        self.connected = False
+
+    async def connect(self):
+        self.communicator = WebsocketCommunicator(self.app, f"/ws/chat/{self.slug}/")
+        self.communicator.scope["user"] = self.user
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise CommandError(f"{self.user.username} could not connect")
+        self.reader = asyncio.create_task(self._read())
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+        self.reader.cancel()
+        await self.communicator.disconnect()
+
+    async def send(self, payload):
+        await self.communicator.send_to(text_data=json.dumps(payload))
+
+    async def _read(self):
+        while True:
+            # Never time out: a receive_from timeout cancels the consumer
+            text = await self.communicator.receive_from(timeout=24 * 3600)
+            data = json.loads(text)
+            if data["type"] in ("batch", "replay"):
+                for event in data["events"]:
+                    self.stats.frame(self, event)
+            else:
+                self.stats.frame(self, data)
+
+
+async def _every(rate, action, clients, stats):
+    """Call ``action`` ``rate`` times a second, catching up if it falls behind."""
+    if rate <= 0:
+        return
+    interval = 1 / rate
+    next_at = time.perf_counter()
+    while True:
+        await action(clients, stats)
+        next_at += interval
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def _pick(clients):
+    while True:
+        client = random.choice(clients)
+        if client.connected:
+            return client
+
+
+async def _send_message(clients, stats):
+    client = _pick(clients)
+    stats.sent += 1
+    stats.expected += sum(1 for c in clients if c.connected and c.slug == client.slug)
+    await client.send({"message": f"{PREFIX} {stats.sent} {time.perf_counter():.6f}"})
+
+
+async def _send_reaction(clients, stats):
+    client = _pick(clients)
+    ids = stats.message_ids[client.slug]
+    if not ids:
+        return
+    stats.reactions += 1
+    await client.send(
+        {
+            "type": "reaction",
+            "message_id": random.choice(ids),
+            "emoji": random.choice(EMOJI),
+        }
+    )
+
+
+async def _rejoin(clients, stats):
+    client = _pick(clients)
+    stats.rejoins += 1
+
+    async def rejoin():
+        await client.disconnect()
+        await client.connect()
+
+    # Don't hold up the schedule while the consumer tears down and sets up
+    task = asyncio.create_task(rejoin())
+    stats.rejoining.add(task)
+    task.add_done_callback(stats.rejoining.discard)
+
+
+class _QueryCounter:
+    """Execute wrapper counting queries on every connection it is installed
+    on, from whichever DB thread (see chat/db.py)."""
+
+    def __init__(self):
+        self.count = 0
+        self.active = False
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.active:
+            with self._lock:
+                self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def _buckets(histogram) -> list[tuple[float, float]]:
+    """(upper bound, cumulative count) of each bucket of an unlabelled
+    histogram."""
+    (family,) = histogram.collect()
+    return [
+        (float(sample.labels["le"]), sample.value)
+        for sample in family.samples
+        if sample.name.endswith("_bucket")
+    ]
+
+
+def _quantiles(before, after, qs) -> list[float]:
+    """Estimate quantiles of the observations made between two bucket
+    snapshots, interpolating within buckets like histogram_quantile()."""
+    counts = [(bound, a - b) for (bound, a), (_, b) in zip(after, before)]
+    total = counts[-1][1]
+    result = []
+    for q in qs:
+        rank = q * total
+        lower, below = 0.0, 0.0
+        for bound, cumulative in counts:
+            if cumulative >= rank and total:
+                if bound == float("inf"):
+                    result.append(lower)  # past the last finite bucket
+                else:
+                    share = (rank - below) / ((cumulative - below) or 1)
+                    result.append(lower + (bound - lower) * share)
+                break
+            lower, below = bound, cumulative
+        else:
+            result.append(0.0)
+    return result
+
+
+def _commands_processed() -> int:
+    return get_sync_redis().info("stats")["total_commands_processed"]
@@ -0,0 +1,226 @@
+import asyncio
+import json
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import (
+    BACKEND_SESSION_KEY,
+    HASH_SESSION_KEY,
+    SESSION_KEY,
+    get_user_model,
+)
+from django.core.management.base import BaseCommand, CommandError
+from websockets.asyncio.client import connect
+from websockets.exceptions import WebSocketException
+
+from faenet.chat import presence
+from faenet.chat.models import ChatRoom
+
+USER_PREFIX = "presence-check"
+
+
+class Command(BaseCommand):
+    help = (
+        "Check presence across the web replicas behind nginx: open --clients "
+        "real WebSocket connections through --url, which nginx spreads over "
+        "the scaled web service, and verify that every user shows up online, "
+        "that the sockets landed on --replicas server processes, that "
+        "'joined' and 'left' deltas reach a socket on another replica, and "
+        "that dropping the sockets (cleanly, or by cutting the TCP "
+        "connection) empties the room. Run it from a container on the "
+        "compose network after `docker compose up --scale web=N`."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="ws://nginx", help="nginx base URL")
+        parser.add_argument("--replicas", type=int, default=4)
+        parser.add_argument("--clients", type=int, default=40)
+        parser.add_argument("--room", help="Room slug (default: first room)")
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=10.0,
+            help="Seconds to wait for each step to settle",
+        )
+
+    def handle(self, *args, **options):
+        if options["clients"] < 2 * options["replicas"]:
+            raise CommandError("--clients must be at least twice --replicas")
+        room = self._room(options["room"])
+        User = get_user_model()
+        usernames = [f"{USER_PREFIX}-{i}" for i in range(options["clients"])]
+        users = [User.objects.get_or_create(username=u)[0] for u in usernames]
+        sessions = {u.username: self._login(u) for u in users}
+        try:
+            ok = asyncio.run(self._check(room.slug, sessions, options))
+        finally:
+            engine = import_module(settings.SESSION_ENGINE)
+            for session_key in sessions.values():
+                engine.SessionStore(session_key).delete()
+            User.objects.filter(username__startswith=f"{USER_PREFIX}-").delete()
+        if not ok:
+            raise CommandError("Presence check failed")
+        self.stdout.write(self.style.SUCCESS("Presence check passed"))
+
+    def _room(self, slug):
+        rooms = ChatRoom.objects.order_by("id")
+        room = rooms.filter(slug=slug).first() if slug else rooms.first()
+        if room is None:
+            raise CommandError("No such room; run seed_rooms first")
+        return room
+
+    def _login(self, user):
+        """Create a session for user, as logging in would; returns its key."""
+        store = import_module(settings.SESSION_ENGINE).SessionStore()
+        store[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        store[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        store.create()
+        return store.session_key
+
+    async def _check(self, slug, sessions, options):
+        timeout = options["timeout"]
+        everyone = set(sessions)
+        clients = []
+        try:
+            for username, session_key in sessions.items():
+                clients.append(
+                    await _Client.open(options["url"], slug, username, session_key)
+                )
+            self.stdout.write(f"Opened {len(clients)} sockets via {options['url']}")
+
+            online = await self._settle(slug, everyone, timeout)
+            ok = self._report("all connected", online, everyone)
+
+            # The part before "!" of a channel name identifies the server
+            # process that holds the socket
+            connections = await presence.get_connections(slug)
+            processes = {}
+            for channel, username in connections.items():
+                if username in everyone:
+                    server = channel.split("!")[0]
+                    processes[server] = processes.get(server, 0) + 1
+            spread = sorted(processes.values(), reverse=True)
+            found = len(processes) == options["replicas"]
+            ok &= found
+            self._line(
+                f"sockets per server process: {spread}, expected "
+                f"{options['replicas']} processes",
+                found,
+            )
+
+            # The first socket sits on one replica; the others joined on all
+            # of them, so seeing their deltas means fan-out crosses replicas
+            first, rest = clients[0], clients[1:]
+            expected = {c.username for c in rest}
+            await self._until(lambda: first.joined >= expected, timeout)
+            ok &= self._count("'joined' deltas at first socket", first.joined, expected)
+            snapshots = sum(c.snapshots > 0 for c in clients)
+            ok &= snapshots == len(clients)
+            self._line(
+                f"presence snapshots: {snapshots}/{len(clients)}",
+                snapshots == len(clients),
+            )
+
+            # Drop the second half: every other one without a close frame,
+            # the way a phone losing signal would
+            keep, drop = clients[: len(clients) // 2], clients[len(clients) // 2 :]
+            for i, client in enumerate(drop):
+                await (client.abort() if i % 2 else client.close())
+            remaining = {c.username for c in keep}
+            online = await self._settle(slug, remaining, timeout)
+            ok &= self._report("after dropping half", online, remaining)
+            dropped = {c.username for c in drop}
+            await self._until(lambda: first.left >= dropped, timeout)
+            ok &= self._count("'left' deltas at first socket", first.left, dropped)
+
+            for client in keep:
+                await client.close()
+            online = await self._settle(slug, set(), timeout)
+            ok &= self._report("after closing the rest", online, set())
+        finally:
+            for client in clients:
+                await client.abort()
+        return ok
+
+    async def _settle(self, slug, expected, timeout):
+        """Poll presence until it matches expected or the timeout passes."""
+        deadline = time.monotonic() + timeout
+        online = await self._online(slug)
+        while online != expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+            online = await self._online(slug)
+        return online
+
+    async def _until(self, condition, timeout):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+
+    async def _online(self, slug):
+        users, _ = await presence.get_snapshot(slug)
+        return {u for u in users if u.startswith(USER_PREFIX)}
+
+    def _line(self, text, ok):
+        status = self.style.SUCCESS("ok") if ok else self.style.ERROR("MISMATCH")
+        self.stdout.write(f"  {text} [{status}]")
+
+    def _count(self, label, seen, expected):
+        ok = expected <= seen
+        self._line(f"{label}: {len(seen & expected)}/{len(expected)}", ok)
+        return ok
+
+    def _report(self, label, online, expected):
+        ok = online == expected
+        self._line(f"{label}: {len(online)} online, expected {len(expected)}", ok)
+        if not ok:
+            self.stdout.write(f"    missing: {sorted(expected - online)}")
+            self.stdout.write(f"    stale:   {sorted(online - expected)}")
+        return ok
+
+
+class _Client:
+    """One real WebSocket, recording the presence frames it receives."""
+
+    def __init__(self, username, ws):
+        self.username = username
+        self.ws = ws
+        self.snapshots = 0
+        self.joined = set()
+        self.left = set()
+        self._reader = asyncio.create_task(self._read())
+
+    @classmethod
+    async def open(cls, base_url, slug, username, session_key):
+        host = next((h for h in settings.ALLOWED_HOSTS if h != "*"), "localhost")
+        try:
+            ws = await connect(
+                f"{base_url}/ws/chat/{slug}/",
+                additional_headers={
+                    "Cookie": f"{settings.SESSION_COOKIE_NAME}={session_key}"
+                },
+                origin=f"http://{host.lstrip('.')}",
+            )
+        except (OSError, WebSocketException) as exc:
+            raise CommandError(f"{username} could not connect: {exc}") from exc
+        return cls(username, ws)
+
+    async def close(self):
+        self._reader.cancel()
+        await self.ws.close()
+
+    async def abort(self):
+        self._reader.cancel()
+        self.ws.transport.abort()
+
+    async def _read(self):
+        async for text in self.ws:
+            frame = json.loads(text)
+            events = frame["events"] if frame["type"] == "batch" else [frame]
+            for event in events:
+                if event["type"] == "presence_snapshot":
+                    self.snapshots += 1
+                elif event["type"] == "presence_delta":
+                    target = self.joined if event["action"] == "joined" else self.left
+                    target.add(event["username"])
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import signal
+import subprocess
+import sys
+import time
+from itertools import chain
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from faenet.chat import presence
+from faenet.chat.models import ChatRoom
+from faenet.chat.rooms import group_name
+from faenet.chat.routing import websocket_urlpatterns
+
+USER_PREFIX = "presence-reap"
+
+
+class Command(BaseCommand):
+    help = (
+        "Check that a crashed worker's presence is reaped: spawn --workers "
+        "local processes that each hold --clients in-process WebSocket "
+        "connections to a room (no server or nginx involved), SIGKILL one of "
+        "them, and verify its users are reaped (with 'left' deltas) while "
+        "everyone else stays online. Needs the real Redis and database; run "
+        "it inside a web container. For presence across real replicas, see "
+        "presence_check."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--clients", type=int, default=10)
+        parser.add_argument("--room", help="Room slug (default: first room)")
+        # Internal: run as one of the spawned workers
+        parser.add_argument("--serve", nargs="+", help="Usernames to connect")
+
+    def handle(self, *args, **options):
+        room = self._room(options["room"])
+        if options["serve"]:
+            asyncio.run(self._serve(room.slug, options["serve"]))
+            return
+
+        workers = options["workers"]
+        if workers < 2:
+            raise CommandError("--workers must be at least 2")
+        groups = [
+            [f"{USER_PREFIX}-{w}-{i}" for i in range(options["clients"])]
+            for w in range(workers)
+        ]
+        User = get_user_model()
+        for username in chain.from_iterable(groups):
+            User.objects.get_or_create(username=username)
+
+        try:
+            ok = asyncio.run(self._check(room.slug, groups))
+        finally:
+            User.objects.filter(username__startswith=f"{USER_PREFIX}-").delete()
+        if not ok:
+            raise CommandError("Presence check failed")
+        self.stdout.write(self.style.SUCCESS("Presence check passed"))
+
+    def _room(self, slug):
+        rooms = ChatRoom.objects.order_by("id")
+        room = rooms.filter(slug=slug).first() if slug else rooms.first()
+        if room is None:
+            raise CommandError("No such room; run seed_rooms first")
+        return room
+
+    async def _check(self, slug, groups):
+        layer = get_channel_layer()
+        listener = await layer.new_channel()
+        await layer.group_add(group_name(slug), listener)
+        left = set()
+        collector = asyncio.create_task(self._collect_left(layer, listener, left))
+
+        procs = [self._spawn(slug, usernames) for usernames in groups]
+        try:
+            for proc in procs:
+                await asyncio.to_thread(proc.stdout.readline)
+            everyone = set(chain.from_iterable(groups))
+            ok = self._report(
+                f"{len(procs)} workers connected", await self._online(slug), everyone
+            )
+
+            victim, survivors = procs[0], procs[1:]
+            victim.send_signal(signal.SIGKILL)
+            self.stdout.write(
+                f"Killed worker pid {victim.pid}; waiting for its connections to expire"
+            )
+            deadline = time.monotonic() + (
+                settings.CHAT_PRESENCE_TTL
+                + 2 * settings.CHAT_PRESENCE_HEARTBEAT_INTERVAL
+            )
+            expected = everyone - set(groups[0])
+            online = await self._online(slug)
+            while online != expected and time.monotonic() < deadline:
+                await asyncio.sleep(1)
+                online = await self._online(slug)
+            ok &= self._report("after crash", online, expected)
+
+            await asyncio.sleep(1)  # let the last deltas arrive
+            missing = set(groups[0]) - left
+            ok &= not missing
+            self.stdout.write(
+                f"  'left' deltas for killed worker: {len(set(groups[0]) & left)}"
+                f"/{len(groups[0])}"
+            )
+
+            for proc in survivors:
+                proc.stdin.close()
+            for proc in survivors:
+                await asyncio.to_thread(proc.wait)
+            ok &= self._report("after clean shutdown", await self._online(slug), set())
+        finally:
+            collector.cancel()
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+            await layer.group_discard(group_name(slug), listener)
+        return ok
+
+    def _spawn(self, slug, usernames):
+        return subprocess.Popen(
+            [sys.executable, sys.argv[0], "presence_reap_check", "--room", slug]
+            + ["--serve", *usernames],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+
+    async def _serve(self, slug, usernames):
+        """Hold one connection per username until stdin closes."""
+        app = URLRouter(websocket_urlpatterns)
+        users = {
+            u.username: u
+            async for u in get_user_model().objects.filter(username__in=usernames)
+        }
+        communicators = []
+        for username in usernames:
+            communicator = WebsocketCommunicator(app, f"/ws/chat/{slug}/")
+            communicator.scope["user"] = users[username]
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise CommandError(f"{username} could not connect")
+            communicators.append(communicator)
+        self.stdout.write("ready")
+        self.stdout.flush()
+
+        await asyncio.to_thread(sys.stdin.read)
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    async def _online(self, slug):
+        users, _ = await presence.get_snapshot(slug)
+        return {u for u in users if u.startswith(USER_PREFIX)}
+
+    async def _collect_left(self, layer, listener, left):
+        # Read continuously: the room's join chatter would otherwise fill the
+        # listener's channel and the layer would drop the deltas we want.
+        while True:
+            event = await layer.receive(listener)
+            frame = json.loads(event["text"])
+            if frame["type"] == "presence_delta" and frame["action"] == "left":
+                left.add(frame["username"])
+
+    def _report(self, label, online, expected):
+        ok = online == expected
+        status = self.style.SUCCESS("ok") if ok else self.style.ERROR("MISMATCH")
+        self.stdout.write(
+            f"  {label}: {len(online)} online, expected {len(expected)} [{status}]"
+        )
+        if not ok:
+            self.stdout.write(f"    missing: {sorted(expected - online)}")
+            self.stdout.write(f"    stale:   {sorted(online - expected)}")
+        return ok
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from faenet.chat import activity
+from faenet.chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the room list's activity summaries in Redis from Postgres. "
+        "By default only rooms whose summary is missing (safe to run at every "
+        "startup); --all recomputes every room, keeping each room's posted "
+        "count if it is higher than the live one (read cursors rely on it)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true")
+
+    def handle(self, *args, **options):
+        room_ids = None
+        if not options["all"]:
+            room_ids = activity.missing(ChatRoom.objects.values_list("id", flat=True))
+            if not room_ids:
+                self.stdout.write("Room activity summaries are up to date")
+                return
+        rebuilt = activity.rebuild(room_ids)
+        self.stdout.write(
+            self.style.SUCCESS(f"Rebuilt activity summaries for {rebuilt} rooms")
+        )
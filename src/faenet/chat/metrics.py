@@ -0,0 +1,168 @@
+"""
+Prometheus metrics for the chat hot paths, served at /metrics.
+
+Each web process keeps its own registry (prometheus_client's default), so
+with several replicas Prometheus scrapes every replica directly on
+web:8000 -- Docker's DNS returns one address per replica -- and nginx
+refuses /metrics from outside.
+
+What is measured:
+
+  chat_connections                   open sockets per room
+  chat_receive_to_broadcast_seconds  inbound frame to its broadcast being
+                                     handed to the channel layer
+  chat_group_send_seconds            channel layer group_send calls
+  chat_db_queue_wait_seconds         database_sync_to_async calls waiting
+                                     for a DB thread, and how many are
+  chat_db_queue_depth                waiting right now (see db.py)
+  chat_message_persist_seconds       storing (or queueing, with
+                                     write-behind) one chat message
+  chat_frame_db_queries              DB queries made while handling one
+                                     inbound frame
+  chat_presence_redis_roundtrips     Redis round-trips made by presence.py
+  chat_event_loop_lag_seconds        how late the loop runs a timer, and
+  chat_event_loop_blocked            stalls past a threshold (both only
+                                     with CHAT_WATCHDOG, see watchdog.py)
+
+Every observation is a dict lookup and a locked add; ``manage.py
+bench_metrics`` compares instrumented and plain frame throughput.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.http import HttpResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+# Inbound frame types, as labels. Anything else is handled as a chat
+# message by the consumer and counted as one, so clients can't mint labels.
+FRAME_KINDS = ("message", "reaction", "read", "resume", "presence_sync")
+
+_LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)  # fmt: skip
+
+CONNECTIONS = Gauge("chat_connections", "Open WebSocket connections", ["room"])
+RECEIVE_TO_BROADCAST = Histogram(
+    "chat_receive_to_broadcast_seconds",
+    "Inbound frame arriving to its broadcast reaching the channel layer",
+    ["kind"],
+    buckets=_LATENCY_BUCKETS,
+)
+GROUP_SEND = Histogram(
+    "chat_group_send_seconds",
+    "Channel layer group_send latency",
+    buckets=_LATENCY_BUCKETS,
+)
+DB_QUEUE_WAIT = Histogram(
+    "chat_db_queue_wait_seconds",
+    "Time a database_sync_to_async call waits before its thread runs it",
+    buckets=_LATENCY_BUCKETS,
+)
+DB_QUEUE_DEPTH = Gauge(
+    "chat_db_queue_depth",
+    "database_sync_to_async calls waiting for a DB thread",
+)
+MESSAGE_PERSIST = Histogram(
+    "chat_message_persist_seconds",
+    "Storing a chat message, or queueing it with write-behind",
+    buckets=_LATENCY_BUCKETS,
+)
+FRAME_DB_QUERIES = Histogram(
+    "chat_frame_db_queries",
+    "DB queries made while handling one inbound frame",
+    ["kind"],
+    buckets=(0, 1, 2, 3, 5, 8, 13),
+)
+PRESENCE_ROUNDTRIPS = Counter(
+    "chat_presence_redis_roundtrips",
+    "Redis round-trips made by presence.py",
+    ["op"],
+)
+LOOP_LAG = Histogram(
+    "chat_event_loop_lag_seconds",
+    "How late the event loop woke a sleeping timer",
+    buckets=_LATENCY_BUCKETS,
+)
+LOOP_BLOCKED = Counter(
+    "chat_event_loop_blocked",
+    "Event loop stalls longer than CHAT_WATCHDOG_THRESHOLD_MS",
+)
+
+# Labelled children are looked up once: .labels() takes a lock per call
+_broadcast = {kind: RECEIVE_TO_BROADCAST.labels(kind) for kind in FRAME_KINDS}
+_queries = {kind: FRAME_DB_QUERIES.labels(kind) for kind in FRAME_KINDS}
+_roundtrips = {}
+
+
+class _Frame:
+    __slots__ = ("kind", "received", "queries")
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.received = time.perf_counter()
+        self.queries = 0
+
+
+# The inbound frame being handled. Context variables follow the handling
+# into database_sync_to_async threads (asgiref copies the context), which
+# is how queries made there are counted against the frame.
+_current: ContextVar[_Frame | None] = ContextVar("chat_frame", default=None)
+
+
+@contextmanager
+def frame(kind: str):
+    """Measure the handling of one inbound frame of the given kind."""
+    current = _Frame(kind if kind in FRAME_KINDS else "message")
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        _queries[current.kind].observe(current.queries)
+
+
+def group_sent(started: float) -> None:
+    """Record a group_send that began at ``started`` (perf_counter) and, if
+    it was made while handling an inbound frame, that frame's latency."""
+    now = time.perf_counter()
+    GROUP_SEND.observe(now - started)
+    current = _current.get()
+    if current is not None:
+        _broadcast[current.kind].observe(now - current.received)
+
+
+def count_query(execute, sql, params, many, context):
+    """Database execute wrapper counting queries against the current frame
+    (installed on every connection, see signals.py)."""
+    current = _current.get()
+    if current is not None:
+        current.queries += 1
+    return execute(sql, params, many, context)
+
+
+def presence_roundtrip(op: str, n: int = 1) -> None:
+    child = _roundtrips.get(op)
+    if child is None:
+        child = _roundtrips[op] = PRESENCE_ROUNDTRIPS.labels(op)
+    child.inc(n)
+
+
+def connection_opened(room: str) -> None:
+    CONNECTIONS.labels(room).inc()
+
+
+def connection_closed(room: str) -> None:
+    CONNECTIONS.labels(room).dec()
+
+
+def metrics(request):
+    """Prometheus scrape endpoint. nginx denies it to the outside world."""
+    return HttpResponse(generate_latest(), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,53 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0003_add_message_room_created_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReactionCount",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("emoji", models.CharField(max_length=8)),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "message",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="reaction_counts",
+                        to="chat.message",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("message", "emoji"),
+                        name="unique_reaction_count_per_emoji",
+                    ),
+                ],
+            },
+        ),
+        # Backfill counters from the existing reactions
+        migrations.RunSQL(
+            sql="""
+                INSERT INTO chat_reactioncount (message_id, emoji, count)
+                SELECT message_id, emoji, COUNT(*)
+                FROM chat_reaction
+                GROUP BY message_id, emoji
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
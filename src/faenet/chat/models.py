@@ -1,5 +1,8 @@
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.db import models
+from django.db.models.functions import Upper
 from django.utils.text import slugify
 
 
@@ -27,6 +30,35 @@ class ChatRoom(models.Model):
         super().save(*args, **kwargs)
 
 
+# Text search configuration of Message.search_vector. Queries must use the
+# same one for the GIN index to apply; changing it needs a migration.
+SEARCH_CONFIG = "english"
+
+
+class StoredGeneratedField(models.GeneratedField):
+    """A stored GeneratedField that inserts don't read back.
+
+    Django puts every GeneratedField in an INSERT's RETURNING clause, which
+    for a tsvector means shipping the whole vector back per message. Left
+    out, the attribute is simply deferred. Deconstructs as a plain
+    GeneratedField, so migrations don't see the difference.
+    """
+
+    db_returning = False
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        return name, "django.db.models.GeneratedField", args, kwargs
+
+
+class MessageManager(models.Manager):
+    """Leaves search_vector out of every query unless asked for; only
+    search needs it, and only in the WHERE clause."""
+
+    def get_queryset(self):
+        return super().get_queryset().defer("search_vector")
+
+
 class Message(models.Model):
     room = models.ForeignKey(
         ChatRoom, on_delete=models.CASCADE, related_name="messages"
@@ -45,14 +77,39 @@ class Message(models.Model):
         related_name="replies",
     )
     created_at = models.DateTimeField(auto_now_add=True)
+    # Idempotency key the sending page generated, so a resend from its
+    # outbox is never stored twice (see idempotency.py)
+    client_id = models.UUIDField(null=True, blank=True, editable=False)
+    # Maintained by Postgres on every insert/update, including write-behind's
+    # raw INSERTs (see search.py)
+    search_vector = StoredGeneratedField(
+        expression=SearchVector("content", config=SEARCH_CONFIG),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    objects = MessageManager()
 
     class Meta:
         ordering = ["created_at"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "client_id"],
+                condition=models.Q(client_id__isnull=False),
+                name="unique_message_client_id",
+            ),
+        ]
         indexes = [
             models.Index(
                 fields=["room", "-created_at"],
                 name="idx_message_room_created",
             ),
+            GinIndex(fields=["search_vector"], name="idx_message_search"),
+            # Substring search: icontains compiles to UPPER(content) LIKE
+            GinIndex(
+                OpClass(Upper("content"), name="gin_trgm_ops"),
+                name="idx_message_content_trgm",
+            ),
         ]
 
     def __str__(self):
@@ -84,3 +141,63 @@ class Reaction(models.Model):
 
     def __str__(self):
         return f"{self.user.username} {self.emoji} on {self.message_id}"
+
+
+class ReactionCount(models.Model):
+    """Denormalized reaction total per (message, emoji).
+
+    Kept in step with Reaction by the consumer's single-statement toggle
+    (see reactions.py) and by signals for ORM writes (admin, cascades), so
+    reading a count never needs COUNT(*) over Reaction.
+    """
+
+    message = models.ForeignKey(
+        Message, on_delete=models.CASCADE, related_name="reaction_counts"
+    )
+    emoji = models.CharField(max_length=8)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["message", "emoji"],
+                name="unique_reaction_count_per_emoji",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.emoji} x{self.count} on {self.message_id}"
+
+
+class ReadCursor(models.Model):
+    """How far a user has read in a room.
+
+    The live copy is in Redis (see unread.py) and is written here in
+    batches. ``read_count`` is the room's posted count at the cursor, so
+    unread = the room's posted count now minus read_count, without
+    counting rows.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="read_cursors",
+    )
+    room = models.ForeignKey(
+        ChatRoom, on_delete=models.CASCADE, related_name="read_cursors"
+    )
+    # Not a foreign key: the message may still be queued by write-behind,
+    # or deleted later without moving the cursor
+    last_read_message_id = models.BigIntegerField(default=0)
+    read_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "room"], name="unique_read_cursor_per_room"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read {self.room_id} to {self.last_read_message_id}"
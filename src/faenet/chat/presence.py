@@ -1,56 +1,341 @@
-import os
+"""
+Room presence in Redis, safe to share between any number of workers.
 
-import redis
+Every connection has an entry in one global sorted set, ``presence_seen``,
+scored by the Redis server time it was last seen. Each worker refreshes the
+entries of the connections it holds every heartbeat; a connection whose
+worker crashed (or was SIGKILLed, or lost its node) simply stops being
+refreshed. Any live worker's reaper then finds it with one ZRANGEBYSCORE --
+O(log n) in the number of connections, no keyspace SCAN -- removes it from
+the room and broadcasts the resulting "left" delta. Starting a worker costs
+nothing and touches nothing that belongs to other workers.
+"""
 
-_redis_url = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
-_redis = redis.Redis.from_url(_redis_url, decode_responses=True)
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import frames, metrics
+from .redis_pool import get_redis
+from .rooms import group_name
+
+logger = logging.getLogger(__name__)
+
+_redis = get_redis()
+
+ANNOUNCE_COOLDOWN = 120
+
+_SEEN_KEY = "presence_seen"
+
+# Hash of slug -> number of distinct users online, kept by the join and
+# leave scripts so the room list can read every room's count in one HMGET
+ONLINE_COUNTS_KEY = "presence_online"
+
+# How many expired connections one reaper pass removes, and how many entries
+# one refresh call covers, so neither holds Redis for long.
+_BATCH = 500
+
+# Members of presence_seen held by this process
+_local: set[str] = set()
+_heartbeat: asyncio.Task | None = None
 
 
 def _key(slug: str) -> str:
     return f"presence:{slug}"
 
 
-def user_joined(slug: str, username: str, channel_name: str) -> list[str]:
+def _users_key(slug: str) -> str:
+    # username -> number of connections, so a join or leave knows whether it
+    # was the user's first or last without scanning every connection, and a
+    # snapshot is one entry per user rather than per tab
+    return f"presence_users:{slug}"
+
+
+def _version_key(slug: str) -> str:
+    # Never expires or gets deleted, so clients can always compare deltas
+    # against it, even after a room empties out.
+    return f"presence_version:{slug}"
+
+
+def _announce_key(slug: str, username: str, action: str) -> str:
+    return f"announce:{slug}:{username}:{action}"
+
+
+def _member(slug: str, channel_name: str, username: str) -> str:
+    # Slugs, channel names and usernames never contain spaces
+    return f"{slug} {channel_name} {username}"
+
+
+# Rebuild a room's per-user counts from its connections if they are missing
+# (a room last joined before they existed); an empty room costs nothing.
+_USERS_FROM_CONNECTIONS = """
+if redis.call('EXISTS', KEYS[6]) == 0 then
+    for _, name in ipairs(redis.call('HVALS', KEYS[1])) do
+        redis.call('HINCRBY', KEYS[6], name, 1)
+    end
+end
+"""
+
+# Join: add the connection to the room and stamp it in presence_seen, bump
+# the room's presence version and online count only if this is the user's
+# first connection, and decide whether to announce -- atomically, in one
+# round-trip. O(1) apart from the list of users returned.
+# Returns {usernames, version, first_connection, announce}.
+_JOIN_SCRIPT = (
+    _USERS_FROM_CONNECTIONS
+    + """
+redis.call('ZADD', KEYS[4], redis.call('TIME')[1], ARGV[4])
+local changed = 0
+if redis.call('HSET', KEYS[1], ARGV[1], ARGV[2]) == 1
+        and redis.call('HINCRBY', KEYS[6], ARGV[2], 1) == 1 then
+    changed = 1
+end
+local version
+if changed == 1 then
+    version = redis.call('INCR', KEYS[2])
+    redis.call('HINCRBY', KEYS[5], ARGV[5], 1)
+else
+    version = tonumber(redis.call('GET', KEYS[2]) or '0')
+end
+local announce = redis.call('SET', KEYS[3], '1', 'NX', 'EX', ARGV[3]) and 1 or 0
+return {redis.call('HKEYS', KEYS[6]), version, changed, announce}
+"""
+)
+
+# Leave: drop the connection and bump the version (and lower the online
+# count) only if it was the user's last one. Idempotent, so a reaper racing
+# a late disconnect is harmless.
+# With ARGV[5] set (the reaper), only removes the connection if it still
+# hasn't been seen for that many seconds, so a refresh that lands between
+# the reaper's read and this call wins. Returns {version, last_connection,
+# announce}.
+_LEAVE_SCRIPT = (
+    """
+if ARGV[5] ~= '' then
+    local seen = redis.call('ZSCORE', KEYS[4], ARGV[4])
+    local now = tonumber(redis.call('TIME')[1])
+    if seen and tonumber(seen) > now - tonumber(ARGV[5]) then
+        return {tonumber(redis.call('GET', KEYS[2]) or '0'), 0, 0}
+    end
+end
+"""
+    + _USERS_FROM_CONNECTIONS
+    + """
+redis.call('ZREM', KEYS[4], ARGV[4])
+local changed = 0
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 1
+        and redis.call('HINCRBY', KEYS[6], ARGV[2], -1) <= 0 then
+    redis.call('HDEL', KEYS[6], ARGV[2])
+    changed = 1
+end
+local version
+if changed == 1 then
+    version = redis.call('INCR', KEYS[2])
+    if redis.call('HINCRBY', KEYS[5], ARGV[6], -1) <= 0 then
+        redis.call('HDEL', KEYS[5], ARGV[6])
+    end
+else
+    version = tonumber(redis.call('GET', KEYS[2]) or '0')
+end
+local announce = redis.call('SET', KEYS[3], '1', 'NX', 'EX', ARGV[3]) and 1 or 0
+return {version, changed, announce}
+"""
+)
+
+# Refresh: re-stamp each still-present connection with the server time and
+# return the ones that are gone (reaped while this worker was unreachable).
+_REFRESH_SCRIPT = """
+local now = redis.call('TIME')[1]
+local missing = {}
+for _, member in ipairs(ARGV) do
+    if redis.call('ZSCORE', KEYS[1], member) then
+        redis.call('ZADD', KEYS[1], now, member)
+    else
+        table.insert(missing, member)
+    end
+end
+return missing
+"""
+
+_join = _redis.register_script(_JOIN_SCRIPT)
+_leave = _redis.register_script(_LEAVE_SCRIPT)
+_refresh = _redis.register_script(_REFRESH_SCRIPT)
+
+
+async def user_joined(
+    slug: str, username: str, channel_name: str, cooldown: int = ANNOUNCE_COOLDOWN
+) -> tuple[list[str], int, bool, bool]:
     """Track a connection joining a room. Keyed by channel_name for accuracy.
 
     Each WebSocket connection gets its own entry (field=channel_name,
-    value=username). This handles multi-tab correctly and avoids count
-    drift from container restarts where disconnect() never fires.
+    value=username). This handles multi-tab correctly, and the entry is
+    kept alive by this worker's heartbeat so it expires if the worker dies
+    before disconnect() fires.
+
+    Runs as a single Lua script, so a join costs one round-trip. Returns
+    (online_users, version, changed, should_announce) where ``changed`` is
+    True when this is the user's first connection to the room, i.e. when
+    the rest of the room needs a "joined" delta stamped with ``version``.
     """
-    _redis.hset(_key(slug), channel_name, username)
-    return get_online_users(slug)
+    member = _member(slug, channel_name, username)
+    metrics.presence_roundtrip("join")
+    usernames, version, changed, announce = await _join(
+        keys=[
+            _key(slug),
+            _version_key(slug),
+            _announce_key(slug, username, "join"),
+            _SEEN_KEY,
+            ONLINE_COUNTS_KEY,
+            _users_key(slug),
+        ],
+        args=[channel_name, username, cooldown, member, slug],
+    )
+    _local.add(member)
+    return sorted(usernames), version, bool(changed), bool(announce)
+
+
+async def user_left(
+    slug: str, username: str, channel_name: str, cooldown: int = ANNOUNCE_COOLDOWN
+) -> tuple[int, bool, bool]:
+    """Remove a specific connection from a room's presence.
+
+    Returns (version, changed, should_announce); ``changed`` is True when
+    the user's last connection to the room went away.
+    """
+    member = _member(slug, channel_name, username)
+    _local.discard(member)
+    return await _remove(member, cooldown)
+
+
+async def _remove(member: str, cooldown: int, expired_after: int | None = None):
+    slug, channel_name, username = member.split(" ", 2)
+    metrics.presence_roundtrip("leave")
+    version, changed, announce = await _leave(
+        keys=[
+            _key(slug),
+            _version_key(slug),
+            _announce_key(slug, username, "leave"),
+            _SEEN_KEY,
+            ONLINE_COUNTS_KEY,
+            _users_key(slug),
+        ],
+        args=[
+            channel_name,
+            username,
+            cooldown,
+            member,
+            "" if expired_after is None else expired_after,
+            slug,
+        ],
+    )
+    return version, bool(changed), bool(announce)
+
+
+async def get_snapshot(slug: str) -> tuple[list[str], int]:
+    """Return (online_users, version) read atomically, for (re)syncing a client."""
+    metrics.presence_roundtrip("snapshot")
+    async with _redis.pipeline(transaction=True) as pipe:
+        pipe.hkeys(_users_key(slug))
+        pipe.get(_version_key(slug))
+        usernames, version = await pipe.execute()
+    return sorted(usernames), int(version or 0)
 
 
-def user_left(slug: str, channel_name: str) -> list[str]:
-    """Remove a specific connection from a room's presence."""
-    _redis.hdel(_key(slug), channel_name)
-    return get_online_users(slug)
+async def get_connections(slug: str) -> dict[str, str]:
+    """Return every connection in a room as {channel_name: username}."""
+    return await _redis.hgetall(_key(slug))
 
 
-def get_online_users(slug: str) -> list[str]:
+async def get_online_users(slug: str) -> list[str]:
     """Return sorted list of unique usernames currently online in a room."""
-    usernames = _redis.hvals(_key(slug))
-    return sorted(set(usernames))
+    metrics.presence_roundtrip("online")
+    return sorted(await _redis.hkeys(_users_key(slug)))
 
 
-def should_announce(slug: str, username: str, action: str, cooldown: int = 120) -> bool:
-    """Return True if this join/leave announcement should be broadcast.
+def start_heartbeat() -> None:
+    """Start this process's heartbeat loop if it isn't running yet.
 
-    Uses a Redis key with TTL to suppress duplicate announcements for the
-    same user+action within the cooldown period.
+    Called from consumer connect() rather than at import or app-ready time,
+    so it runs on the server's event loop and management commands that
+    never hold connections don't start one.
     """
-    key = f"announce:{slug}:{username}:{action}"
-    # SET NX returns True only if the key didn't exist (first announcement)
-    return bool(_redis.set(key, "1", nx=True, ex=cooldown))
+    global _heartbeat
+    if _heartbeat is None or _heartbeat.done():
+        _heartbeat = asyncio.get_running_loop().create_task(_heartbeat_loop())
 
 
-def flush_all_presence() -> None:
-    """Clear all presence data. Called on server startup to remove stale
-    entries from previous process that exited without clean disconnects."""
-    cursor = 0
+async def _heartbeat_loop() -> None:
     while True:
-        cursor, keys = _redis.scan(cursor, match="presence:*", count=100)
-        if keys:
-            _redis.delete(*keys)
-        if cursor == 0:
+        await asyncio.sleep(settings.CHAT_PRESENCE_HEARTBEAT_INTERVAL)
+        try:
+            await refresh_local()
+            await reap_expired()
+        except Exception:
+            # A Redis blip must not kill the loop; the TTL is a few beats
+            # long, so one missed beat doesn't get connections reaped.
+            logger.exception("Presence heartbeat failed")
+
+
+async def refresh_local() -> None:
+    """Mark every connection held by this process as seen now.
+
+    Connections that were reaped anyway (this worker couldn't reach Redis
+    for longer than the TTL) are joined again, so the room sees them come
+    back instead of them staying connected but invisible.
+    """
+    members = list(_local)
+    for i in range(0, len(members), _BATCH):
+        metrics.presence_roundtrip("refresh")
+        missing = await _refresh(keys=[_SEEN_KEY], args=members[i : i + _BATCH])
+        for member in missing:
+            if member not in _local:
+                continue  # disconnected meanwhile
+            slug, channel_name, username = member.split(" ", 2)
+            _, version, changed, _ = await user_joined(slug, username, channel_name)
+            if changed:
+                await _broadcast(slug, "joined", username, version)
+
+
+async def reap_expired() -> int:
+    """Remove every connection not seen for CHAT_PRESENCE_TTL seconds,
+    broadcasting a "left" delta for each user that went offline.
+
+    Any number of workers may run this concurrently: the leave script is
+    idempotent and re-checks expiry, so each delta is still only sent once
+    and a connection refreshed in the meantime is kept. Returns the number
+    of expired entries found.
+    """
+    ttl = settings.CHAT_PRESENCE_TTL
+    found = 0
+    while True:
+        metrics.presence_roundtrip("reap", 2)
+        now, _ = await _redis.time()
+        expired = await _redis.zrangebyscore(
+            _SEEN_KEY, "-inf", now - ttl, start=0, num=_BATCH
+        )
+        for member in expired:
+            version, changed, _ = await _remove(member, ANNOUNCE_COOLDOWN, ttl)
+            found += 1
+            if changed:
+                slug, _, username = member.split(" ", 2)
+                await _broadcast(slug, "left", username, version)
+        if len(expired) < _BATCH:
             break
+    if found:
+        logger.info("Reaped %d expired presence connections", found)
+    return found
+
+
+async def _broadcast(slug: str, action: str, username: str, version: int) -> None:
+    await frames.group_send(
+        get_channel_layer(),
+        group_name(slug),
+        {
+            "type": "presence_delta",
+            "action": action,
+            "username": username,
+            "version": version,
+        },
+    )
@@ -1,35 +1,45 @@
-from django.http import HttpResponse, JsonResponse
+"""
+PWA assets: the service worker, the manifest and the icons.
+
+They never change while the code doesn't, so they are built once per
+process (``assets()``) and served with an ETag, answering conditional GETs
+with 304. The service worker's CACHE_NAME is derived from a hash of every
+asset, so any change to them -- a new CDN URL, a new icon -- renames the
+cache and the new worker's activate handler drops the old one.
+
+``manage.py build_pwa`` writes the same files under
+STATIC_ROOT/webroot/, laid out by URL, and nginx serves them from there
+(sw.js and manifest.json revalidated on every load, icons cached for a
+day); the views below answer only when the app is reached without nginx.
+"""
 
+import hashlib
+import json
+from functools import cache
+from typing import NamedTuple
 
-def manifest(request):
-    """Serve the PWA manifest as JSON."""
-    data = {
-        "name": "Faerie Chat",
-        "short_name": "FaeChat",
-        "description": "Real-time chat chambers for the fae realm",
-        "start_url": "/",
-        "display": "standalone",
-        "background_color": "#0a0a0f",
-        "theme_color": "#7c3aed",
-        "orientation": "any",
-        "icons": [
-            {
-                "src": f"/pwa/icon-{size}.svg",
-                "sizes": f"{size}x{size}",
-                "type": "image/svg+xml",
-                "purpose": "any maskable",
-            }
-            for size in (192, 512)
-        ],
-    }
-    return JsonResponse(data, content_type="application/manifest+json")
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
 
+ICON_SIZES = (192, 512)
 
-def service_worker(request):
-    """Serve the service worker JS inline."""
-    js = """
+# Browsers check for a new service worker on navigation; no-cache makes that
+# check a cheap conditional GET instead of a download
+_REVALIDATE = "no-cache"
+_ICON_CACHE = "public, max-age=86400"
+
+
+class Asset(NamedTuple):
+    body: bytes
+    content_type: str
+    cache_control: str
+    etag: str
+
+
+_SERVICE_WORKER = """
 // Faerie Chat Service Worker
-const CACHE_NAME = 'faechat-v1';
+const CACHE_NAME = '__CACHE_NAME__';
 
 const CDN_URLS = [
     'https://cdn.tailwindcss.com',
@@ -88,7 +98,9 @@ self.addEventListener('fetch', function(event) {
         return;
     }
 
-    // Network-first for HTML pages
+    // Network-first for HTML pages. A room page served from here offline
+    // adds the messages it cached in IndexedDB since, and queues sends in
+    // its outbox until the socket is back (see room_detail.html)
     if (event.request.headers.get('accept') && event.request.headers.get('accept').includes('text/html')) {
         event.respondWith(
             fetch(event.request).then(function(response) {
@@ -133,11 +145,32 @@ self.addEventListener('notificationclick', function(event) {
     );
 });
 """
-    return HttpResponse(js.strip(), content_type="application/javascript")
 
 
-def pwa_icon(request, size):
-    """Generate an SVG icon for the PWA manifest."""
+def _manifest() -> bytes:
+    data = {
+        "name": "Faerie Chat",
+        "short_name": "FaeChat",
+        "description": "Real-time chat chambers for the fae realm",
+        "start_url": "/",
+        "display": "standalone",
+        "background_color": "#0a0a0f",
+        "theme_color": "#7c3aed",
+        "orientation": "any",
+        "icons": [
+            {
+                "src": f"/pwa/icon-{size}.svg",
+                "sizes": f"{size}x{size}",
+                "type": "image/svg+xml",
+                "purpose": "any maskable",
+            }
+            for size in ICON_SIZES
+        ],
+    }
+    return json.dumps(data).encode()
+
+
+def _icon(size: int) -> bytes:
     svg = f"""<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" viewBox="0 0 {size} {size}">
   <defs>
     <linearGradient id="bg" x1="0%" y1="0%" x2="100%" y2="100%">
@@ -150,4 +183,63 @@ def pwa_icon(request, size):
         font-family="serif" font-weight="700" font-size="{size * 0.5}"
         fill="white" opacity="0.95">F</text>
 </svg>"""
-    return HttpResponse(svg.strip(), content_type="image/svg+xml")
+    return svg.strip().encode()
+
+
+def _asset(body: bytes, content_type: str, cache_control: str) -> Asset:
+    etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+    return Asset(body, content_type, cache_control, etag)
+
+
+@cache
+def assets() -> dict[str, Asset]:
+    """Return {URL path: Asset} for every PWA asset, built once."""
+    manifest = _manifest()
+    icons = {size: _icon(size) for size in ICON_SIZES}
+    template = _SERVICE_WORKER.strip()
+
+    digest = hashlib.sha256(template.encode() + manifest)
+    for body in icons.values():
+        digest.update(body)
+    cache_name = f"faechat-{digest.hexdigest()[:12]}"
+    worker = template.replace("__CACHE_NAME__", cache_name)
+
+    result = {
+        "sw.js": _asset(worker.encode(), "application/javascript", _REVALIDATE),
+        "manifest.json": _asset(manifest, "application/manifest+json", _REVALIDATE),
+    }
+    for size, body in icons.items():
+        result[f"pwa/icon-{size}.svg"] = _asset(body, "image/svg+xml", _ICON_CACHE)
+    return result
+
+
+def webroot():
+    """Directory build_pwa writes the assets to, laid out by URL path, and
+    nginx serves them from."""
+    return settings.STATIC_ROOT / "webroot"
+
+
+def _serve(request, path: str) -> HttpResponse:
+    asset = assets()[path]
+    response = HttpResponse(asset.body, content_type=asset.content_type)
+    response["ETag"] = asset.etag
+    response["Cache-Control"] = asset.cache_control
+    # A 304 carries over the ETag and Cache-Control headers
+    return get_conditional_response(request, etag=asset.etag, response=response)
+
+
+def manifest(request):
+    """Serve the PWA manifest."""
+    return _serve(request, "manifest.json")
+
+
+def service_worker(request):
+    """Serve the service worker JS."""
+    return _serve(request, "sw.js")
+
+
+def pwa_icon(request, size):
+    """Serve one of the SVG icons listed in the manifest."""
+    if size not in ICON_SIZES:
+        raise Http404
+    return _serve(request, f"pwa/icon-{size}.svg")
@@ -0,0 +1,157 @@
+"""
+Token-bucket rate limiting for inbound WebSocket frames.
+
+Each kind of frame (chat message, reaction, read cursor, resume, presence
+resync) has up to three buckets, all of which must have a token for the
+frame to go through:
+
+  connection -- in-process: a socket lives on one worker, so this needs no
+                Redis round-trip and stops a flooding tab before it costs
+                anything shared
+  user       -- in Redis, shared by all of a user's tabs on every worker
+  room       -- in Redis, caps the fan-out one room can generate
+
+The user and room buckets are checked and charged in a single Lua call, so
+a frame costs at most one round-trip, and a frame that one bucket rejects
+takes no token from the other.
+
+Even one round-trip is more than the 100 µs per-frame budget (a bare PING
+from redis.asyncio takes about that), so a connection leases several tokens
+from the shared buckets at once and spends the rest locally. A lease is
+LEASE_FRACTION of the smallest burst (at most LEASE_MAX), held for up to
+LEASE_SECONDS. Leased tokens a connection hasn't used by then are lost, so
+a user's tabs together can fall short of the configured rate by about one
+lease each; they can never exceed it.
+"""
+
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+_redis = get_redis()
+
+# Most tokens one connection leases from the shared buckets at a time, and
+# how long it may hold on to them
+LEASE_MAX = 10
+LEASE_SECONDS = 1.0
+LEASE_FRACTION = 0.2
+
+# KEYS: bucket hashes. ARGV[1]: tokens wanted. ARGV[2..]: rate (tokens/s)
+# and burst for each key, in order. Refills every bucket from Redis server
+# time, then takes the same number of tokens from each -- as many as
+# wanted, or as every bucket has whole -- only if all of them have one.
+# Returns {tokens taken, 0}, or {0, milliseconds until the emptiest bucket
+# has a token again}.
+_TAKE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local take = tonumber(ARGV[1])
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(state[1]) or burst
+    local elapsed = now - (tonumber(state[2]) or now)
+    available = math.min(burst, available + elapsed * rate / 1000)
+    tokens[i] = available
+    if available < 1 then
+        wait = math.max(wait, math.ceil((1 - available) * 1000 / rate))
+    end
+    take = math.min(take, math.floor(available))
+end
+if wait > 0 then
+    return {0, wait}
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    redis.call('HSET', key, 'tokens', tostring(tokens[i] - take), 'ts', now)
+    -- A bucket that has had time to refill completely is the same as none
+    redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+end
+return {take, 0}
+"""
+
+_take = _redis.register_script(_TAKE_SCRIPT)
+
+
+class TokenBucket:
+    """In-process token bucket: ``rate`` tokens per second, up to ``burst``."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token. Returns 0 if one was available, otherwise the
+        number of seconds until there will be one."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        return 0.0
+
+
+class RateLimiter:
+    """The buckets for one WebSocket connection, per CHAT_RATE_LIMITS."""
+
+    def __init__(self, user_id: int, room_slug: str):
+        self.user_id = user_id
+        self.room_slug = room_slug
+        self._local = {
+            kind: TokenBucket(*scopes["connection"])
+            for kind, scopes in settings.CHAT_RATE_LIMITS.items()
+            if scopes.get("connection")
+        }
+        # kind -> (tokens left from the last lease, monotonic expiry)
+        self._leases: dict[str, tuple[int, float]] = {}
+
+    async def check(self, kind: str) -> float:
+        """Charge one ``kind`` frame. Returns 0 if it may proceed, otherwise
+        the number of seconds the client should wait before retrying."""
+        limits = settings.CHAT_RATE_LIMITS.get(kind)
+        if not limits:
+            return 0.0
+
+        bucket = self._local.get(kind)
+        if bucket is not None:
+            wait = bucket.take()
+            if wait:
+                return wait
+
+        leased, expires = self._leases.get(kind, (0, 0.0))
+        if leased and time.monotonic() < expires:
+            self._leases[kind] = (leased - 1, expires)
+            return 0.0
+
+        keys, args, lease = [], [], LEASE_MAX
+        for scope, owner in (("user", self.user_id), ("room", self.room_slug)):
+            if limits.get(scope):
+                rate, burst = limits[scope]
+                keys.append(f"ratelimit:{kind}:{scope}:{owner}")
+                args.extend((rate, burst))
+                lease = min(lease, max(1, int(burst * LEASE_FRACTION)))
+        if not keys:
+            return 0.0
+        try:
+            taken, wait_ms = await _take(keys=keys, args=[lease, *args])
+        except redis.RedisError:
+            # Fail open: the per-connection bucket above still applies
+            logger.warning("Rate limiter unavailable, allowing frame", exc_info=True)
+            return 0.0
+        if not taken:
+            return wait_ms / 1000
+        self._leases[kind] = (taken - 1, time.monotonic() + LEASE_SECONDS)
+        return 0.0
@@ -0,0 +1,96 @@
+from django.db import connection
+from django.db.models import F
+
+from .models import Message, Reaction, ReactionCount
+
+_MESSAGE = Message._meta.db_table
+_REACTION = Reaction._meta.db_table
+_COUNTER = ReactionCount._meta.db_table
+
+# Toggle a reaction and maintain its ReactionCount in one statement:
+#   msg  - the target message, scoped to the consumer's room
+#   del  - remove the user's reaction if it exists
+#   ins  - otherwise add it (ON CONFLICT makes concurrent double-clicks safe)
+#   up   - count an add: upsert the per-(message, emoji) counter
+#   down - count a remove: update-only, since an INSERT row of -1 would fail
+#          the count >= 0 check before ON CONFLICT got to merge it
+# Returns (message_found, delta, count). delta is 0 when a concurrent
+# toggle already did the work.
+_TOGGLE_SQL = f"""
+WITH msg AS (
+    SELECT id FROM {_MESSAGE} WHERE id = %(message_id)s AND room_id = %(room_id)s
+), del AS (
+    DELETE FROM {_REACTION}
+    WHERE message_id IN (SELECT id FROM msg)
+      AND user_id = %(user_id)s AND emoji = %(emoji)s
+    RETURNING 1
+), ins AS (
+    INSERT INTO {_REACTION} (message_id, user_id, emoji, created_at)
+    SELECT id, %(user_id)s, %(emoji)s, now() FROM msg
+    WHERE NOT EXISTS (SELECT 1 FROM del)
+    ON CONFLICT ON CONSTRAINT unique_user_reaction_per_emoji DO NOTHING
+    RETURNING 1
+), up AS (
+    INSERT INTO {_COUNTER} (message_id, emoji, count)
+    SELECT id, %(emoji)s, 1 FROM msg WHERE EXISTS (SELECT 1 FROM ins)
+    ON CONFLICT ON CONSTRAINT unique_reaction_count_per_emoji
+    DO UPDATE SET count = {_COUNTER}.count + 1
+    RETURNING count
+), down AS (
+    UPDATE {_COUNTER} SET count = count - 1
+    WHERE message_id IN (SELECT id FROM msg) AND emoji = %(emoji)s
+      AND count > 0 AND EXISTS (SELECT 1 FROM del)
+    RETURNING count
+)
+SELECT
+    (SELECT count(*) FROM msg),
+    (SELECT count(*) FROM ins) - (SELECT count(*) FROM del),
+    COALESCE((SELECT count FROM up), (SELECT count FROM down), 0)
+"""
+
+_INCREMENT_SQL = f"""
+INSERT INTO {_COUNTER} (message_id, emoji, count)
+VALUES (%(message_id)s, %(emoji)s, 1)
+ON CONFLICT ON CONSTRAINT unique_reaction_count_per_emoji
+DO UPDATE SET count = {_COUNTER}.count + 1
+"""
+
+
+def toggle_reaction(room_id: int, message_id: int, user_id: int, emoji: str):
+    """Add or remove a user's reaction atomically, in a single statement.
+
+    Returns {"action": "add"|"remove", "count": n}, or None when the message
+    isn't in this room or a concurrent click already toggled the same
+    reaction (nothing changed, so there is nothing to broadcast).
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            _TOGGLE_SQL,
+            {
+                "room_id": room_id,
+                "message_id": message_id,
+                "user_id": user_id,
+                "emoji": emoji,
+            },
+        )
+        found, delta, count = cursor.fetchone()
+    if not found or not delta:
+        return None
+    return {"action": "add" if delta > 0 else "remove", "count": count}
+
+
+def increment_count(message_id: int, emoji: str) -> None:
+    """Count a reaction created through the ORM (admin, shell, fixtures)."""
+    with connection.cursor() as cursor:
+        cursor.execute(_INCREMENT_SQL, {"message_id": message_id, "emoji": emoji})
+
+
+def decrement_count(message_id: int, emoji: str) -> None:
+    """Uncount a reaction deleted through the ORM.
+
+    Update-only: when the message itself is being deleted the counter row
+    may already be gone, and re-inserting it would break the FK.
+    """
+    ReactionCount.objects.filter(
+        message_id=message_id, emoji=emoji, count__gt=0
+    ).update(count=F("count") - 1)
@@ -0,0 +1,256 @@
+"""
+Per-room snapshot of recent messages in Redis: what room_detail renders and
+what a reconnecting client replays.
+
+Each room keeps its last RECENT_SIZE chat frames in a Redis sorted set,
+scored by message id and holding the exact encoded text that was broadcast
+(a sorted set rather than a list because ids are allocated before the
+broadcast, so two concurrent senders can push out of id order). Reaction
+counts for those messages live next to it in a hash, message id ->
+[[emoji, count], ...]. The consumer's write path keeps both up to date as
+messages and reactions come in, so once a room has been seeded from the
+database a page load is one Redis read plus a small query for the viewer's
+own reactions.
+
+Keys:
+  recent:{room_id}            sorted set of chat frames, score = message id
+  recent_reactions:{room_id}  hash of reaction counts per buffered message
+  recent_seeded:{room_id}     set once the buffer was filled from Postgres;
+                              "1" if older messages exist beyond it
+"""
+
+import orjson
+
+from . import frames
+from .db import database_sync_to_async
+from .history import (
+    PAGE_SIZE,
+    attach_reaction_summaries,
+    fetch_messages,
+    fetch_messages_after,
+    serialize_message,
+)
+from .models import Reaction
+from .redis_pool import get_redis, get_sync_redis
+
+_redis = get_redis()
+
+RECENT_SIZE = 200
+REPLAY_LIMIT = 200
+RECENT_TTL = 7 * 24 * 60 * 60
+
+
+def buffer_key(room_id: int) -> str:
+    """Redis key of a room's sorted set of recent chat frames."""
+    return f"recent:{room_id}"
+
+
+def _reactions_key(room_id: int) -> str:
+    return f"recent_reactions:{room_id}"
+
+
+def _seeded_key(room_id: int) -> str:
+    return f"recent_seeded:{room_id}"
+
+
+def _keys(room_id: int) -> list[str]:
+    return [buffer_key(room_id), _reactions_key(room_id), _seeded_key(room_id)]
+
+
+# Add a frame, evict the oldest beyond ARGV[3] along with their reaction
+# counts, and refresh the TTL on all three keys.
+_ADD_SCRIPT = """
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+local evicted = redis.call('ZRANGE', KEYS[1], 0, -tonumber(ARGV[3]) - 1, 'WITHSCORES')
+for i = 2, #evicted, 2 do
+    redis.call('HDEL', KEYS[2], evicted[i])
+end
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+for _, key in ipairs(KEYS) do
+    redis.call('EXPIRE', key, ARGV[4])
+end
+return 1
+"""
+
+# Set one emoji's count on a buffered message (dropping it at 0). Messages
+# that have already left the buffer are ignored.
+_REACTION_SCRIPT = """
+if #redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[1], 'LIMIT', 0, 1) == 0 then
+    return 0
+end
+local raw = redis.call('HGET', KEYS[2], ARGV[1])
+local counts = raw and cjson.decode(raw) or {}
+local count = tonumber(ARGV[3])
+local found = false
+for i, pair in ipairs(counts) do
+    if pair[1] == ARGV[2] then
+        found = true
+        if count > 0 then pair[2] = count else table.remove(counts, i) end
+        break
+    end
+end
+if not found and count > 0 then
+    table.insert(counts, {ARGV[2], count})
+end
+if #counts == 0 then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    redis.call('HSET', KEYS[2], ARGV[1], cjson.encode(counts))
+end
+return 1
+"""
+
+_add = _redis.register_script(_ADD_SCRIPT)
+_set_reaction = _redis.register_script(_REACTION_SCRIPT)
+
+
+async def add(room_id: int, message_id: int, text: str) -> None:
+    """Record a broadcast chat frame, keeping only the newest RECENT_SIZE."""
+    await _add(keys=_keys(room_id), args=[message_id, text, RECENT_SIZE, RECENT_TTL])
+
+
+async def set_reaction_count(
+    room_id: int, message_id: int, emoji: str, count: int
+) -> None:
+    """Record a message's new count for one emoji after a toggle."""
+    await _set_reaction(
+        keys=[buffer_key(room_id), _reactions_key(room_id)],
+        args=[message_id, emoji, count],
+    )
+
+
+async def page(room_id: int, user_id: int) -> tuple[list[dict], bool]:
+    """Return (messages, has_more) for rendering a room: the newest
+    PAGE_SIZE messages as serialized dicts, oldest first, with reaction
+    summaries for ``user_id``.
+
+    Read from the snapshot, seeding it from Postgres first if this room
+    hasn't been loaded since the keys expired (or Redis restarted).
+    """
+    async with _redis.pipeline(transaction=True) as pipe:
+        pipe.get(_seeded_key(room_id))
+        pipe.zrevrange(buffer_key(room_id), 0, PAGE_SIZE - 1, withscores=True)
+        pipe.zcard(buffer_key(room_id))
+        seeded, newest, buffered = await pipe.execute()
+    if seeded is None:
+        return await database_sync_to_async(_seed)(room_id, user_id)
+
+    by_id = {int(message_id): text for text, message_id in newest}
+    ids = sorted(by_id)
+    counts = await _redis.hmget(_reactions_key(room_id), ids) if ids else []
+    mine = await database_sync_to_async(_my_reactions)(user_id, ids)
+
+    messages = []
+    for message_id, raw_counts in zip(ids, counts):
+        data = orjson.loads(by_id[message_id])
+        del data["type"]
+        data["reactions"] = [
+            {
+                "emoji": emoji,
+                "count": count,
+                "reacted_by_me": (message_id, emoji) in mine,
+            }
+            for emoji, count in (orjson.loads(raw_counts) if raw_counts else [])
+        ]
+        messages.append(data)
+    return messages, buffered > PAGE_SIZE or seeded == "1"
+
+
+def _my_reactions(user_id: int, message_ids: list[int]) -> set[tuple[int, str]]:
+    # Served by the (message, user, emoji) unique index
+    if not message_ids:
+        return set()
+    return set(
+        Reaction.objects.filter(
+            user_id=user_id, message_id__in=message_ids
+        ).values_list("message_id", "emoji")
+    )
+
+
+def _seed(room_id: int, user_id: int) -> tuple[list[dict], bool]:
+    """Fill a room's snapshot from Postgres and return its first page."""
+    messages, has_more = fetch_messages(room_id)
+    attach_reaction_summaries(messages, user_id)
+    serialized = [serialize_message(msg) for msg in messages]
+
+    client = get_sync_redis()
+    with client.pipeline(transaction=True) as pipe:
+        if serialized:
+            pipe.zadd(
+                buffer_key(room_id),
+                {
+                    frames.encode(_chat_frame(data)): data["message_id"]
+                    for data in serialized
+                },
+            )
+        for data in serialized:
+            if data["reactions"]:
+                # NX: a live toggle that got there first is newer
+                pipe.hsetnx(
+                    _reactions_key(room_id),
+                    data["message_id"],
+                    orjson.dumps([[r["emoji"], r["count"]] for r in data["reactions"]]),
+                )
+        pipe.set(_seeded_key(room_id), "1" if has_more else "0")
+        for key in _keys(room_id):
+            pipe.expire(key, RECENT_TTL)
+        pipe.execute()
+    return serialized, has_more
+
+
+def _chat_frame(data: dict) -> dict:
+    return frames.chat(
+        data["message_id"], data["username"], data["message"], data.get("reply_to")
+    )
+
+
+def invalidate(*room_ids: int) -> None:
+    """Drop rooms' snapshots so the next page load reseeds them from
+    Postgres.
+
+    Called from signal handlers (sync code), hence the blocking client.
+    """
+    keys = [key for room_id in room_ids for key in _keys(room_id)]
+    if keys:
+        get_sync_redis().delete(*keys)
+
+
+async def missed(room_id: int, after: int, user_id: int) -> tuple[list[str], bool]:
+    """Return (frames, truncated): the encoded chat frames of every message
+    newer than ``after``, oldest first.
+
+    At most REPLAY_LIMIT are returned -- the newest ones -- and ``truncated``
+    says whether older missed messages were left out. If the buffer doesn't
+    reach back to ``after`` (a long outage, a room quiet since Redis
+    restarted), the gap comes from the history query instead, merged with
+    the buffer so write-behind messages not yet flushed aren't missed.
+    """
+    async with _redis.pipeline(transaction=False) as pipe:
+        pipe.zrange(buffer_key(room_id), 0, 0, withscores=True)
+        pipe.zrangebyscore(buffer_key(room_id), f"({after}", "+inf", withscores=True)
+        oldest, buffered = await pipe.execute()
+
+    if oldest and oldest[0][1] <= after:
+        # The buffer reaches back past the client's last message, so it
+        # holds the whole gap.
+        texts = [text for text, _ in buffered]
+        return texts[-REPLAY_LIMIT:], len(texts) > REPLAY_LIMIT
+
+    from_db, truncated = await database_sync_to_async(_load_missed)(
+        room_id, after, user_id
+    )
+    merged = dict(from_db)
+    for text, message_id in buffered:
+        merged.setdefault(int(message_id), text)
+    ids = sorted(merged)
+    truncated = truncated or len(ids) > REPLAY_LIMIT
+    return [merged[i] for i in ids[-REPLAY_LIMIT:]], truncated
+
+
+def _load_missed(room_id: int, after: int, user_id: int):
+    messages, truncated = fetch_messages_after(room_id, after, REPLAY_LIMIT)
+    attach_reaction_summaries(messages, user_id)
+    return [
+        (msg.id, frames.encode({"type": "chat", **serialize_message(msg)}))
+        for msg in messages
+    ], truncated
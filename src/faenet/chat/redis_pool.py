@@ -0,0 +1,33 @@
+import os
+
+import redis
+import redis.asyncio
+
+_redis_url = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+_max_connections = int(os.environ.get("REDIS_MAX_CONNECTIONS", "50"))
+
+# One pool per process, shared by every consumer. Connections are opened
+# lazily on first use, so importing this module never touches the network.
+# The blocking variant makes callers wait for a free connection instead of
+# failing with "Too many connections" during a reconnect storm.
+_pool = redis.asyncio.BlockingConnectionPool.from_url(
+    _redis_url, decode_responses=True, max_connections=_max_connections
+)
+# The same for blocking code; redis-py clients and pools are thread-safe
+_sync_client = redis.Redis(
+    connection_pool=redis.BlockingConnectionPool.from_url(
+        _redis_url, decode_responses=True, max_connections=_max_connections
+    )
+)
+
+
+def get_redis() -> redis.asyncio.Redis:
+    """Return an asyncio Redis client backed by the shared connection pool."""
+    return redis.asyncio.Redis(connection_pool=_pool)
+
+
+def get_sync_redis() -> redis.Redis:
+    """Return the process's shared blocking Redis client, for code that runs
+    outside the event loop (signal handlers, startup hooks, management
+    commands)."""
+    return _sync_client
@@ -0,0 +1,52 @@
+from .db import database_sync_to_async
+from .models import ChatRoom
+from .redis_pool import get_redis, get_sync_redis
+
+_redis = get_redis()
+
+# Process-wide slug -> ChatRoom.id cache. Consumers resolve their room once
+# on connect and write by room_id afterwards, so the hot message/reaction
+# path never looks the room up again. A rename or delete anywhere (the
+# ChatRoom post_save/post_delete signals, see signals.py) bumps a version
+# in Redis; every process compares it on connect and drops its whole cache
+# when it moved, so a deleted room stops accepting sockets on all replicas.
+_VERSION_KEY = "rooms:version"
+_room_ids: dict[str, int] = {}
+_version: str | None = None
+
+
+def group_name(slug: str) -> str:
+    """Channel layer group that every connection to a room is subscribed to."""
+    return f"chat_{slug}"
+
+
+async def get_room_id(slug: str) -> int | None:
+    """Return the id of the room with this slug, or None if it doesn't exist."""
+    global _version
+    # Read before the lookup: a change landing in between leaves a newer
+    # version behind, and the next connect clears the entry again
+    version = await _redis.get(_VERSION_KEY)
+    if version != _version:
+        _room_ids.clear()
+        _version = version
+    room_id = _room_ids.get(slug)
+    if room_id is None:
+        room_id = await database_sync_to_async(_load_room_id)(slug)
+    return room_id
+
+
+def _load_room_id(slug: str) -> int | None:
+    room_id = ChatRoom.objects.filter(slug=slug).values_list("id", flat=True).first()
+    if room_id is not None:
+        _room_ids[slug] = room_id
+    return room_id
+
+
+def invalidate_room(room_id: int) -> None:
+    """Forget every cached slug that maps to this room, in this process
+    right away and in the others on their next connect (sync, for signal
+    handlers)."""
+    for slug, cached_id in list(_room_ids.items()):
+        if cached_id == room_id:
+            _room_ids.pop(slug, None)
+    get_sync_redis().incr(_VERSION_KEY)
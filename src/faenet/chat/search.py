@@ -0,0 +1,119 @@
+"""
+Message search over Postgres full-text search.
+
+Message.search_vector is a stored generated column (to_tsvector over the
+content, SEARCH_CONFIG) with a GIN index, so Postgres keeps it current on
+every write -- ORM saves, write-behind's raw INSERTs, edits -- and a query
+never computes vectors on the fly.
+
+Two modes:
+
+  words      websearch_to_tsquery syntax ("quoted phrases", -exclusions,
+             or), ranked by ts_rank, keyset-paginated on (rank, id)
+  substring  case-insensitive substring match served by the pg_trgm index
+             on UPPER(content), newest first, keyset-paginated on id
+
+Headlines come back with matches wrapped in <mark>; the rest of the text
+is HTML-escaped here, so the page can insert them as HTML.
+"""
+
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+from django.db.models import F, Q
+from django.utils.html import escape
+
+from .models import SEARCH_CONFIG, Message
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+
+# ts_headline markers that can't occur in a chat message, swapped for
+# <mark> tags after escaping
+_START, _STOP = "\x01", "\x02"
+
+
+def search_messages(
+    text: str,
+    room_id: int | None = None,
+    cursor: str | None = None,
+    limit: int = PAGE_SIZE,
+    substring: bool = False,
+):
+    """Return (results, next_cursor): up to ``limit`` messages matching
+    ``text``, in one room or all of them, each a dict ready for JSON.
+
+    ``cursor`` is the ``next_cursor`` of the previous page (None for the
+    first); ``next_cursor`` is None on the last page. Raises ValueError
+    for a malformed cursor.
+    """
+    qs = Message.objects.all()
+    if room_id is not None:
+        qs = qs.filter(room_id=room_id)
+
+    if substring:
+        qs = qs.filter(content__icontains=text)
+        if cursor:
+            qs = qs.filter(id__lt=int(cursor))
+        qs = qs.order_by("-id")
+    else:
+        query = SearchQuery(text, search_type="websearch", config=SEARCH_CONFIG)
+        qs = qs.filter(search_vector=query).annotate(
+            rank=SearchRank(F("search_vector"), query)
+        )
+        if cursor:
+            rank, _, last_id = cursor.partition(":")
+            rank, last_id = float(rank), int(last_id)
+            qs = qs.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=last_id))
+        qs = qs.order_by("-rank", "-id").annotate(
+            headline=SearchHeadline(
+                "content",
+                query,
+                config=SEARCH_CONFIG,
+                start_sel=_START,
+                stop_sel=_STOP,
+                max_fragments=2,
+            )
+        )
+
+    page = list(qs.select_related("user", "room").defer("search_vector")[: limit + 1])
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        last = page[-1]
+        next_cursor = str(last.id) if substring else f"{last.rank!r}:{last.id}"
+    return [_serialize(msg, text if substring else None) for msg in page], next_cursor
+
+
+def _serialize(msg, substring: str | None) -> dict:
+    if substring is None:
+        headline = _marked(msg.headline)
+    else:
+        headline = _mark_substring(msg.content, substring)
+    return {
+        "message_id": msg.id,
+        "room": msg.room.slug,
+        "room_name": msg.room.name,
+        "username": msg.user.username,
+        "created_at": msg.created_at.isoformat(),
+        "headline": headline,
+    }
+
+
+def _marked(headline: str) -> str:
+    return escape(headline).replace(_START, "<mark>").replace(_STOP, "</mark>")
+
+
+def _mark_substring(content: str, text: str) -> str:
+    # ts_headline only highlights whole lexemes, so substring matches are
+    # marked here
+    lowered, needle = content.lower(), text.lower()
+    parts, start = [], 0
+    while (found := lowered.find(needle, start)) != -1:
+        parts += [
+            escape(content[start:found]),
+            "<mark>",
+            escape(content[found : found + len(needle)]),
+            "</mark>",
+        ]
+        start = found + len(needle)
+    parts.append(escape(content[start:]))
+    return "".join(parts)
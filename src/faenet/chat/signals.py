@@ -0,0 +1,105 @@
+import threading
+from collections import Counter
+
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import activity, metrics, recent
+from .models import ChatRoom, Message, Reaction
+from .reactions import decrement_count, increment_count
+from .rooms import invalidate_room
+
+
+@receiver(connection_created)
+def count_frame_queries(sender, connection, **kwargs):
+    """Count queries against the inbound WebSocket frame being handled, if
+    any (see metrics.py)."""
+    # Fires on every reconnect of the same thread's connection object
+    if metrics.count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(metrics.count_query)
+
+
+class _Cascade:
+    """What one delete() call removes, so its Redis cleanup runs once.
+
+    Django sends every pre_delete of a cascade before deleting anything,
+    and tags all of them with the same ``origin`` (the instance or queryset
+    delete() was called on). Deleting a room with 10k messages therefore
+    costs three Redis commands after it commits, not 20k during it.
+    """
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.room_ids = set()
+        self.message_ids = set()
+        self.messages_per_room = Counter()
+
+    def apply(self):
+        if getattr(_local, "cascade", None) is self:
+            _local.cascade = None
+        # A deleted room's keys go entirely; no point counting them down
+        for room_id in self.room_ids:
+            self.messages_per_room.pop(room_id, None)
+        recent.invalidate(*self.room_ids, *self.messages_per_room)
+        activity.forget_messages(self.messages_per_room)
+        activity.delete(*self.room_ids)
+
+
+_local = threading.local()
+
+
+def _cascade(origin, using) -> _Cascade:
+    cascade = getattr(_local, "cascade", None)
+    if cascade is None or cascade.origin is not origin:
+        cascade = _local.cascade = _Cascade(origin)
+        # robust: Redis being down mustn't fail a delete that has committed
+        transaction.on_commit(cascade.apply, using=using, robust=True)
+    return cascade
+
+
+def _deleted_with_message(message_id, origin) -> bool:
+    cascade = getattr(_local, "cascade", None)
+    return (
+        cascade is not None
+        and cascade.origin is origin
+        and message_id in cascade.message_ids
+    )
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def chatroom_changed(sender, instance, **kwargs):
+    """Drop the room's cached slug -> id mapping after a rename or delete."""
+    invalidate_room(instance.pk)
+
+
+@receiver(pre_delete, sender=ChatRoom)
+def chatroom_deleting(sender, instance, origin=None, using=None, **kwargs):
+    """Drop the room's activity summary and snapshot once it is gone."""
+    _cascade(origin, using).room_ids.add(instance.pk)
+
+
+@receiver(pre_delete, sender=Message)
+def message_deleting(sender, instance, origin=None, using=None, **kwargs):
+    """Reseed the room's recent-message snapshot without the deleted message
+    and take it off the room's message count, once per delete() call."""
+    cascade = _cascade(origin, using)
+    cascade.message_ids.add(instance.pk)
+    cascade.messages_per_room[instance.room_id] += 1
+
+
+# The consumer's toggle maintains ReactionCount in the same SQL statement
+# and bypasses these; they keep the counters right for ORM writes.
+@receiver(post_save, sender=Reaction)
+def reaction_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        increment_count(instance.message_id, instance.emoji)
+
+
+@receiver(post_delete, sender=Reaction)
+def reaction_deleted(sender, instance, origin=None, **kwargs):
+    # The counter row goes with its message; don't update it first
+    if not _deleted_with_message(instance.message_id, origin):
+        decrement_count(instance.message_id, instance.emoji)
@@ -0,0 +1,57 @@
+from django.test import TestCase
+
+from faenet.chat import activity
+
+from .helpers import RedisTestMixin, make_messages, make_room, make_user
+
+
+class RebuildTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("alice")
+        self.room = make_room()
+        self.messages = make_messages(self.room, self.user, 3)
+        self.key = activity.summary_key(self.room.id)
+
+    def _summary(self):
+        return self.redis.hgetall(self.key)
+
+    def test_rebuild_from_postgres(self):
+        empty = make_room("Empty")
+        self.assertEqual(activity.rebuild([self.room.id, empty.id]), 2)
+        summary = self._summary()
+        self.assertEqual((summary["messages"], summary["posted"]), ("3", "3"))
+        self.assertEqual(summary["last_id"], str(self.messages[-1].id))
+        self.assertEqual(summary["last_author"], "alice")
+        self.assertEqual(
+            self.redis.hgetall(activity.summary_key(empty.id)),
+            {"messages": "0", "posted": "0"},
+        )
+
+    def test_replace_keeps_posted_after_deletes(self):
+        activity.rebuild([self.room.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.messages[0].delete()
+        summary = self._summary()
+        self.assertEqual((summary["messages"], summary["posted"]), ("2", "3"))
+
+        activity.rebuild()
+        summary = self._summary()
+        self.assertEqual((summary["messages"], summary["posted"]), ("2", "3"))
+
+    def test_replace_takes_live_count_when_higher(self):
+        self.redis.hset(self.key, mapping={"messages": 1, "posted": 1})
+        activity.rebuild([self.room.id])
+        self.assertEqual(self._summary()["posted"], "3")
+
+    def test_missing_only_fills_gaps(self):
+        self.redis.hset(self.key, mapping={"messages": 7, "posted": 9})
+        self.assertEqual(activity.rebuild([self.room.id], replace=False), 0)
+        self.assertEqual(self._summary(), {"messages": "7", "posted": "9"})
+        self.assertEqual(activity.missing([self.room.id]), [])
+
+    def test_deleting_room_drops_summary(self):
+        activity.rebuild([self.room.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.delete()
+        self.assertFalse(self.redis.exists(self.key))
@@ -0,0 +1,205 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import httpx
+import redis
+from django.test import AsyncRequestFactory, SimpleTestCase, override_settings
+
+from faenet.chat import giphy, views
+
+API_URL = "https://giphy.test/v1/gifs"
+
+
+def _gif(gif_id):
+    return {
+        "id": gif_id,
+        "title": f"gif {gif_id}",
+        "images": {
+            "original": {"url": f"https://media.test/{gif_id}.gif"},
+            "fixed_height_small": {"url": f"https://media.test/{gif_id}-s.gif"},
+        },
+    }
+
+
+class FakeRedis:
+    """Just the get/set the cache uses, in memory."""
+
+    def __init__(self, fail=False):
+        self.data = {}
+        self.ttls = {}
+        self.gets = 0
+        self.fail = fail
+
+    async def get(self, key):
+        self.gets += 1
+        if self.fail:
+            raise redis.ConnectionError("down")
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        if self.fail:
+            raise redis.ConnectionError("down")
+        self.data[key] = value
+        self.ttls[key] = ex
+
+
+@override_settings(GIPHY_API_KEY="test-key", GIPHY_API_URL=API_URL)
+class GiphyProxyTests(SimpleTestCase):
+    def setUp(self):
+        self.requests = []
+        self.handler = self._ok
+        self.redis = FakeRedis()
+        giphy._lru.clear()
+        giphy._inflight.clear()
+        giphy._client = httpx.AsyncClient(transport=httpx.MockTransport(self._dispatch))
+        self._redis, giphy._redis = giphy._redis, self.redis
+        self.addCleanup(setattr, giphy, "_redis", self._redis)
+        self.addCleanup(setattr, giphy, "_client", None)
+
+    async def _dispatch(self, request):
+        self.requests.append(request)
+        return await self.handler(request)
+
+    async def _ok(self, request):
+        return httpx.Response(200, json={"data": [_gif("a"), _gif("b")]})
+
+    async def _view(self, q):
+        request = AsyncRequestFactory().get("/api/giphy/search/", {"q": q})
+        user = SimpleNamespace(is_authenticated=True)
+
+        async def auser():
+            return user
+
+        request.user, request.auser = user, auser
+        response = await views.giphy_search(request)
+        return response.status_code, json.loads(response.content)
+
+    async def test_search_fetches_and_shapes_results(self):
+        status, body = await self._view("cats")
+
+        self.assertEqual(status, 200)
+        self.assertEqual([g["id"] for g in body], ["a", "b"])
+        self.assertEqual(body[0]["preview_url"], "https://media.test/a-s.gif")
+        (request,) = self.requests
+        self.assertEqual(request.url.path, "/v1/gifs/search")
+        self.assertEqual(request.url.params["q"], "cats")
+
+    async def test_empty_query_uses_trending(self):
+        await giphy.search("   ")
+
+        self.assertEqual(self.requests[0].url.path, "/v1/gifs/trending")
+        self.assertEqual(self.redis.ttls["giphy:trending"], giphy.TRENDING_TTL)
+
+    async def test_in_process_cache_serves_repeats(self):
+        first = await giphy.search("Cats")
+        second = await giphy.search("  cats ")
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.requests), 1)
+        # The repeat never got as far as Redis
+        self.assertEqual(self.redis.gets, 1)
+
+    async def test_redis_cache_is_stored_with_ttl(self):
+        results = await giphy.search("cats")
+
+        key = "giphy:search:cats"
+        self.assertEqual(json.loads(self.redis.data[key]), results)
+        self.assertEqual(self.redis.ttls[key], giphy.SEARCH_TTL)
+
+    async def test_redis_cache_serves_other_workers(self):
+        cached = [{"id": "x", "title": "", "url": "u", "preview_url": "p"}]
+        self.redis.data["giphy:search:cats"] = json.dumps(cached)
+
+        self.assertEqual(await giphy.search("cats"), cached)
+        self.assertEqual(self.requests, [])
+        # ...and fills this worker's LRU on the way
+        self.assertEqual(giphy._lru_get("giphy:search:cats"), cached)
+
+    async def test_redis_outage_falls_back_to_upstream(self):
+        giphy._redis = FakeRedis(fail=True)
+
+        results = await giphy.search("cats")
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_concurrent_identical_queries_share_one_call(self):
+        release = asyncio.Event()
+
+        async def slow(request):
+            await release.wait()
+            return await self._ok(request)
+
+        self.handler = slow
+        searches = [
+            asyncio.ensure_future(giphy.search(q))
+            for q in ("cats", "Cats", " cats ", "CATS", "cats")
+        ]
+        await asyncio.sleep(0.01)
+        release.set()
+        results = await asyncio.gather(*searches)
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertTrue(all(r == results[0] for r in results))
+        self.assertEqual(giphy._inflight, {})
+
+    async def test_one_waiter_cancelling_does_not_cancel_the_others(self):
+        release = asyncio.Event()
+
+        async def slow(request):
+            await release.wait()
+            return await self._ok(request)
+
+        self.handler = slow
+        impatient = asyncio.ensure_future(giphy.search("cats"))
+        patient = asyncio.ensure_future(giphy.search("cats"))
+        await asyncio.sleep(0.01)
+        impatient.cancel()
+        release.set()
+
+        self.assertEqual(len(await patient), 2)
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_timeout_returns_504(self):
+        async def hang(request):
+            raise httpx.ReadTimeout("timed out", request=request)
+
+        self.handler = hang
+
+        status, body = await self._view("cats")
+
+        self.assertEqual(status, 504)
+        self.assertEqual(body, {"error": "Giphy timed out"})
+
+    async def test_upstream_error_returns_502(self):
+        async def broken(request):
+            return httpx.Response(500, json={"message": "oops"})
+
+        self.handler = broken
+
+        status, body = await self._view("cats")
+
+        self.assertEqual(status, 502)
+        self.assertEqual(body, {"error": "Giphy unavailable"})
+        # Failures aren't cached
+        self.assertEqual(self.redis.data, {})
+        await self._view("cats")
+        self.assertEqual(len(self.requests), 2)
+
+    async def test_unreachable_upstream_returns_502(self):
+        async def refused(request):
+            raise httpx.ConnectError("refused", request=request)
+
+        self.handler = refused
+
+        status, _ = await self._view("cats")
+
+        self.assertEqual(status, 502)
+
+    @override_settings(GIPHY_API_KEY="")
+    async def test_unconfigured_returns_503(self):
+        status, _ = await self._view("cats")
+
+        self.assertEqual(status, 503)
+        self.assertEqual(self.requests, [])
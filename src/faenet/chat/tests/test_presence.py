@@ -0,0 +1,63 @@
+from django.test import SimpleTestCase
+
+from faenet.chat import presence
+
+from .helpers import RedisTestMixin
+
+
+class PresenceTests(RedisTestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(presence._local.clear)
+
+    async def _join(self, username, channel_name):
+        return await presence.user_joined("general", username, channel_name)
+
+    async def _leave(self, username, channel_name):
+        return await presence.user_left("general", username, channel_name)
+
+    def _online(self):
+        return self.redis.hget(presence.ONLINE_COUNTS_KEY, "general")
+
+    async def test_join_and_leave(self):
+        users, version, changed, announce = await self._join("alice", "c.1")
+        self.assertEqual(
+            (users, version, changed, announce), (["alice"], 1, True, True)
+        )
+        users, version, changed, _ = await self._join("bob", "c.2")
+        self.assertEqual((users, version, changed), (["alice", "bob"], 2, True))
+        self.assertEqual(self._online(), "2")
+
+        self.assertEqual((await self._leave("alice", "c.1"))[:2], (3, True))
+        self.assertEqual(await presence.get_online_users("general"), ["bob"])
+        self.assertEqual(await presence.get_snapshot("general"), (["bob"], 3))
+        self.assertEqual(self._online(), "1")
+
+    async def test_user_counts_once_across_tabs(self):
+        await self._join("alice", "c.1")
+        users, version, changed, _ = await self._join("alice", "c.2")
+        self.assertEqual((users, version, changed), (["alice"], 1, False))
+        # A repeated join of the same connection doesn't count it twice
+        self.assertFalse((await self._join("alice", "c.2"))[2])
+
+        self.assertEqual((await self._leave("alice", "c.1"))[:2], (1, False))
+        self.assertEqual(await presence.get_online_users("general"), ["alice"])
+        self.assertEqual((await self._leave("alice", "c.2"))[:2], (2, True))
+        # Leaving twice is harmless
+        self.assertEqual((await self._leave("alice", "c.2"))[:2], (2, False))
+        self.assertEqual(await presence.get_online_users("general"), [])
+        self.assertIsNone(self._online())
+
+    async def test_rebuilds_user_counts_from_connections(self):
+        # A room whose connections were tracked before the per-user counts
+        self.redis.hset(
+            presence._key("general"), mapping={"c.1": "alice", "c.2": "alice"}
+        )
+        users, _, changed, _ = await self._join("bob", "c.3")
+        self.assertEqual((users, changed), (["alice", "bob"], True))
+        self.assertEqual(
+            self.redis.hgetall(presence._users_key("general")),
+            {"alice": "2", "bob": "1"},
+        )
+        self.assertFalse((await self._leave("alice", "c.1"))[1])
+        self.assertTrue((await self._leave("alice", "c.2"))[1])
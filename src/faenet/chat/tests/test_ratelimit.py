@@ -0,0 +1,72 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from faenet.chat import ratelimit
+from faenet.chat.ratelimit import RateLimiter
+
+from .helpers import RedisTestMixin
+
+# Next to no refill, so a test sees exactly the burst
+SLOW = 0.001
+
+
+class RateLimiterTests(RedisTestMixin, SimpleTestCase):
+    async def _allowed(self, limiter, n, kind="message"):
+        return [not await limiter.check(kind) for _ in range(n)].count(True)
+
+    @override_settings(CHAT_RATE_LIMITS={"message": {"connection": (SLOW, 3)}})
+    async def test_connection_bucket(self):
+        limiter = RateLimiter(1, "general")
+        self.assertEqual(await self._allowed(limiter, 5), 3)
+        self.assertGreater(await limiter.check("message"), 0)
+        self.assertEqual(self.redis.keys("ratelimit:*"), [])
+
+    @override_settings(CHAT_RATE_LIMITS={"message": {"user": (SLOW, 20)}})
+    async def test_lease_spends_locally(self):
+        limiter = RateLimiter(1, "general")
+        self.assertEqual(await self._allowed(limiter, 1), 1)
+        # One round-trip took a lease of a fifth of the burst
+        key = "ratelimit:message:user:1"
+        self.assertEqual(round(float(self.redis.hget(key, "tokens"))), 16)
+        with mock.patch.object(ratelimit, "_take") as take:
+            self.assertEqual(await self._allowed(limiter, 3), 3)
+        take.assert_not_called()
+
+    @override_settings(CHAT_RATE_LIMITS={"message": {"user": (SLOW, 10)}})
+    async def test_tabs_share_user_bucket(self):
+        tabs = [RateLimiter(1, "general") for _ in range(3)]
+        allowed = sum([await self._allowed(tab, 10) for tab in tabs])
+        self.assertEqual(allowed, 10)
+        wait = await RateLimiter(1, "general").check("message")
+        self.assertGreater(wait, 0)
+        # Another user has a bucket of their own
+        self.assertEqual(await self._allowed(RateLimiter(2, "general"), 1), 1)
+
+    @override_settings(
+        CHAT_RATE_LIMITS={"message": {"user": (SLOW, 100), "room": (SLOW, 5)}}
+    )
+    async def test_lease_is_limited_by_every_bucket(self):
+        limiter = RateLimiter(1, "general")
+        await limiter.check("message")
+        # The room's burst of 5 allows a lease of 1, so nothing is held back
+        self.assertEqual(limiter._leases["message"][0], 0)
+        self.assertEqual(await self._allowed(RateLimiter(2, "general"), 10), 4)
+
+    @override_settings(CHAT_RATE_LIMITS={"message": {"user": (SLOW, 20)}})
+    async def test_lease_expires(self):
+        limiter = RateLimiter(1, "general")
+        with mock.patch.object(ratelimit, "LEASE_SECONDS", 0):
+            await limiter.check("message")
+            await limiter.check("message")
+        # The second frame took a fresh lease; the first one's tokens are gone
+        key = "ratelimit:message:user:1"
+        self.assertEqual(round(float(self.redis.hget(key, "tokens"))), 12)
+
+    @override_settings(CHAT_RATE_LIMITS={"message": {"user": (SLOW, 10)}})
+    async def test_fails_open_without_redis(self):
+        limiter = RateLimiter(1, "general")
+        with mock.patch.object(
+            ratelimit, "_take", side_effect=ratelimit.redis.ConnectionError
+        ):
+            self.assertEqual(await limiter.check("message"), 0)
@@ -0,0 +1,83 @@
+from django.test import TestCase
+
+from faenet.chat.models import Reaction, ReactionCount
+from faenet.chat.reactions import toggle_reaction
+
+from .helpers import RedisTestMixin, make_messages, make_room, make_user
+
+
+class ToggleReactionTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user("alice")
+        self.bob = make_user("bob")
+        self.room = make_room()
+        (self.message,) = make_messages(self.room, self.alice, 1)
+
+    def _toggle(self, user, emoji="👍", room=None):
+        room = room or self.room
+        return toggle_reaction(room.id, self.message.id, user.id, emoji)
+
+    def _count(self, emoji="👍"):
+        row = ReactionCount.objects.filter(message=self.message, emoji=emoji).first()
+        return row and row.count
+
+    def test_add_remove_add(self):
+        self.assertEqual(self._toggle(self.alice), {"action": "add", "count": 1})
+        self.assertEqual(self._count(), 1)
+        self.assertEqual(self._toggle(self.alice), {"action": "remove", "count": 0})
+        self.assertEqual(self._count(), 0)
+        self.assertFalse(Reaction.objects.exists())
+        self.assertEqual(self._toggle(self.alice), {"action": "add", "count": 1})
+        self.assertEqual(self._count(), 1)
+
+    def test_counts_per_emoji_across_users(self):
+        self._toggle(self.alice)
+        self.assertEqual(self._toggle(self.bob), {"action": "add", "count": 2})
+        self.assertEqual(self._toggle(self.bob, "🔥"), {"action": "add", "count": 1})
+        self.assertEqual(self._toggle(self.alice), {"action": "remove", "count": 1})
+        self.assertEqual(self._count(), 1)
+        self.assertEqual(self._count("🔥"), 1)
+
+    def test_message_in_another_room(self):
+        other = make_room("Other")
+        self.assertIsNone(self._toggle(self.alice, room=other))
+        self.assertFalse(Reaction.objects.exists())
+        self.assertIsNone(self._count())
+
+    def test_remove_without_counter_row(self):
+        # e.g. counters lost to a bad migration: removing must not go below 0
+        self._toggle(self.alice)
+        ReactionCount.objects.all().delete()
+        self.assertEqual(self._toggle(self.alice), {"action": "remove", "count": 0})
+        self.assertIsNone(self._count())
+
+
+class ReactionSignalTests(RedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_user("alice")
+        self.bob = make_user("bob")
+        self.room = make_room()
+        (self.message,) = make_messages(self.room, self.alice, 1)
+
+    def _react(self, user):
+        return Reaction.objects.create(message=self.message, user=user, emoji="👍")
+
+    def _count(self):
+        return ReactionCount.objects.get(message=self.message, emoji="👍").count
+
+    def test_orm_create_and_delete_keep_counts(self):
+        mine = self._react(self.alice)
+        self._react(self.bob)
+        self.assertEqual(self._count(), 2)
+        mine.delete()
+        self.assertEqual(self._count(), 1)
+
+    def test_deleting_message_takes_reactions_and_counts(self):
+        self._react(self.alice)
+        self._react(self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.message.delete()
+        self.assertFalse(Reaction.objects.exists())
+        self.assertFalse(ReactionCount.objects.exists())
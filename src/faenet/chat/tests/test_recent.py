@@ -0,0 +1,94 @@
+import orjson
+from django.test import TransactionTestCase
+
+from faenet.chat import frames, recent
+from faenet.chat.models import Reaction
+
+from .helpers import RedisTestMixin, make_messages, make_room, make_user
+
+
+class RecentBufferTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("alice")
+        self.room = make_room()
+        self.messages = make_messages(self.room, self.user, 5)
+        self.ids = [m.id for m in self.messages]
+
+    async def _live(self, message_id, text="live"):
+        """Add a message the way the consumer's broadcast does."""
+        frame = frames.encode(frames.chat(message_id, "alice", text))
+        await recent.add(self.room.id, message_id, frame)
+        return frame
+
+    def _ids(self, texts):
+        return [orjson.loads(text)["message_id"] for text in texts]
+
+    async def test_page_seeds_from_postgres(self):
+        messages, has_more = await recent.page(self.room.id, self.user.id)
+        self.assertEqual([m["message_id"] for m in messages], self.ids)
+        self.assertFalse(has_more)
+        self.assertEqual(self.redis.zcard(recent.buffer_key(self.room.id)), 5)
+
+    async def test_page_reads_live_messages_and_reactions(self):
+        await recent.page(self.room.id, self.user.id)
+        live_id = self.ids[-1] + 1
+        await self._live(live_id)
+        await recent.set_reaction_count(self.room.id, live_id, "👍", 2)
+        await Reaction.objects.acreate(
+            message=self.messages[0], user=self.user, emoji="🔥"
+        )
+        await recent.set_reaction_count(self.room.id, self.ids[0], "🔥", 1)
+
+        messages, _ = await recent.page(self.room.id, self.user.id)
+        self.assertEqual([m["message_id"] for m in messages], [*self.ids, live_id])
+        self.assertEqual(messages[-1]["message"], "live")
+        self.assertEqual(
+            messages[-1]["reactions"],
+            [{"emoji": "👍", "count": 2, "reacted_by_me": False}],
+        )
+        self.assertEqual(
+            messages[0]["reactions"],
+            [{"emoji": "🔥", "count": 1, "reacted_by_me": True}],
+        )
+
+    async def test_buffer_keeps_newest(self):
+        await recent.page(self.room.id, self.user.id)
+        first = self.ids[-1] + 1
+        for message_id in range(first, first + recent.RECENT_SIZE):
+            await self._live(message_id)
+        key = recent.buffer_key(self.room.id)
+        self.assertEqual(self.redis.zcard(key), recent.RECENT_SIZE)
+        self.assertEqual(self.redis.zrange(key, 0, 0, withscores=True)[0][1], first)
+
+    async def test_missed_from_buffer(self):
+        await recent.page(self.room.id, self.user.id)
+        texts, truncated = await recent.missed(self.room.id, self.ids[1], self.user.id)
+        self.assertEqual(self._ids(texts), self.ids[2:])
+        self.assertFalse(truncated)
+
+    async def test_missed_beyond_buffer_merges_postgres(self):
+        # Only the newest message and an unflushed write-behind one buffered
+        await self._live(self.ids[-1])
+        pending = self.ids[-1] + 1
+        await self._live(pending)
+        texts, truncated = await recent.missed(self.room.id, self.ids[0], self.user.id)
+        self.assertEqual(self._ids(texts), [*self.ids[1:], pending])
+        self.assertFalse(truncated)
+
+    async def test_missed_truncates_to_newest(self):
+        await recent.page(self.room.id, self.user.id)
+        first = self.ids[-1] + 1
+        for message_id in range(first, first + recent.REPLAY_LIMIT):
+            await self._live(message_id)
+        texts, truncated = await recent.missed(self.room.id, self.ids[0], self.user.id)
+        self.assertTrue(truncated)
+        self.assertEqual(len(texts), recent.REPLAY_LIMIT)
+        self.assertEqual(self._ids(texts)[-1], first + recent.REPLAY_LIMIT - 1)
+
+    async def test_deleting_message_drops_snapshot(self):
+        await recent.page(self.room.id, self.user.id)
+        await self.messages[2].adelete()
+        self.assertFalse(self.redis.exists(recent.buffer_key(self.room.id)))
+        messages, _ = await recent.page(self.room.id, self.user.id)
+        self.assertNotIn(self.ids[2], [m["message_id"] for m in messages])
@@ -0,0 +1,81 @@
+from django.test import TransactionTestCase
+
+from faenet.chat import activity, recent, rooms
+from faenet.chat.models import ChatRoom, Message
+
+from .helpers import RedisTestMixin, make_messages, make_room, make_user
+
+
+class RoomCacheTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        rooms._room_ids.clear()
+        rooms._version = None
+        self.room = make_room("General")
+
+    async def test_caches_slug_lookup(self):
+        self.assertEqual(await rooms.get_room_id("general"), self.room.id)
+        self.assertEqual(rooms._room_ids, {"general": self.room.id})
+        self.assertIsNone(await rooms.get_room_id("nowhere"))
+
+    async def test_rename_here_drops_entry(self):
+        await rooms.get_room_id("general")
+        self.room.slug = "lobby"
+        await self.room.asave()
+        self.assertIsNone(await rooms.get_room_id("general"))
+        self.assertEqual(await rooms.get_room_id("lobby"), self.room.id)
+
+    async def test_change_in_another_process_clears_cache(self):
+        await rooms.get_room_id("general")
+        # update() sends no signals: only the stale cache answers now
+        await ChatRoom.objects.filter(id=self.room.id).aupdate(slug="lobby")
+        self.assertEqual(await rooms.get_room_id("general"), self.room.id)
+        # What the other process's post_save would do
+        self.redis.incr(rooms._VERSION_KEY)
+        self.assertIsNone(await rooms.get_room_id("general"))
+
+    async def test_delete_drops_entry(self):
+        await rooms.get_room_id("general")
+        await self.room.adelete()
+        self.assertIsNone(await rooms.get_room_id("general"))
+
+
+class DeleteCascadeTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("alice")
+        self.room = make_room("General")
+        self.other = make_room("Other")
+        self.messages = make_messages(self.room, self.user, 3)
+        make_messages(self.other, self.user, 3)
+        activity.rebuild()
+
+    async def _seed(self, room):
+        await recent.page(room.id, self.user.id)
+
+    def _summary(self, room):
+        return self.redis.hgetall(activity.summary_key(room.id))
+
+    async def test_deleting_room_drops_its_keys_only(self):
+        await self._seed(self.room)
+        await self._seed(self.other)
+        await self.room.adelete()
+        self.assertFalse(self.redis.exists(activity.summary_key(self.room.id)))
+        self.assertFalse(self.redis.exists(recent.buffer_key(self.room.id)))
+        self.assertEqual(self._summary(self.other)["messages"], "3")
+        self.assertTrue(self.redis.exists(recent.buffer_key(self.other.id)))
+
+    async def test_bulk_message_delete_counts_per_room(self):
+        await self._seed(self.other)
+        kept = self.messages[0].id
+        await Message.objects.filter(room=self.room).exclude(id=kept).adelete()
+        summary = self._summary(self.room)
+        self.assertEqual((summary["messages"], summary["posted"]), ("1", "3"))
+        self.assertEqual(self._summary(self.other)["messages"], "3")
+        self.assertTrue(self.redis.exists(recent.buffer_key(self.other.id)))
+
+    async def test_deleting_user_counts_down_every_room(self):
+        await self.user.adelete()
+        for room in (self.room, self.other):
+            summary = self._summary(room)
+            self.assertEqual((summary["messages"], summary["posted"]), ("0", "3"))
@@ -0,0 +1,83 @@
+from django.test import TransactionTestCase
+
+from faenet.chat import activity, recent, unread
+from faenet.chat.models import ChatRoom, ReadCursor
+
+from .helpers import RedisTestMixin, make_messages, make_room, make_user
+
+
+class UnreadTests(RedisTestMixin, TransactionTestCase):
+    # Async code reaches Postgres from the chat-db threads, on their own
+    # connections, so the fixtures have to be committed
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user("alice")
+        self.room = make_room()
+        self.messages = make_messages(self.room, self.user, 5)
+        self.ids = [m.id for m in self.messages]
+        activity.rebuild([self.room.id])
+        # The buffer only reaches back to the fourth message
+        for message_id in self.ids[3:]:
+            self.redis.zadd(
+                recent.buffer_key(self.room.id), {f"m{message_id}": message_id}
+            )
+
+    async def _mark(self, message_id):
+        return await unread.mark_read(self.user.id, self.room.id, message_id)
+
+    async def _summaries(self):
+        rooms = [room async for room in ChatRoom.objects.all()]
+        return await activity.summaries(rooms)
+
+    async def test_read_to_newest(self):
+        self.assertEqual(await self._mark(self.ids[-1]), 0)
+        counts = await unread.unread_counts(self.user.id, await self._summaries())
+        self.assertEqual(counts, {self.room.id: 0})
+
+    async def test_read_within_buffer(self):
+        self.assertEqual(await self._mark(self.ids[3]), 1)
+        counts = await unread.unread_counts(self.user.id, await self._summaries())
+        self.assertEqual(counts, {self.room.id: 1})
+
+    async def test_read_older_than_buffer_counts_in_postgres(self):
+        self.assertEqual(await self._mark(self.ids[1]), 3)
+        # Plus a write-behind message the table doesn't have yet
+        pending = self.ids[-1] + 1
+        await activity.record_message(self.room.id, pending, "alice")
+        await recent.add(self.room.id, pending, "pending")
+        self.assertEqual(await unread.all_unread(self.user.id), {self.room.id: 4})
+
+    async def test_cursor_never_moves_back(self):
+        await self._mark(self.ids[3])
+        self.assertEqual(await self._mark(self.ids[0]), 1)
+
+    async def test_id_past_newest_is_clamped(self):
+        self.assertEqual(await self._mark(10**9), 0)
+        await activity.record_message(self.room.id, self.ids[-1] + 1, "alice")
+        self.assertEqual(await unread.all_unread(self.user.id), {self.room.id: 1})
+
+    async def test_new_messages_count_as_unread(self):
+        await self._mark(self.ids[-1])
+        await activity.record_message(self.room.id, self.ids[-1] + 1, "alice")
+        await activity.record_message(self.room.id, self.ids[-1] + 2, "alice")
+        counts = await unread.unread_counts(self.user.id, await self._summaries())
+        self.assertEqual(counts, {self.room.id: 2})
+
+    async def test_rebuilds_lost_summary(self):
+        self.redis.delete(activity.summary_key(self.room.id))
+        self.assertEqual(await self._mark(self.ids[3]), 1)
+
+    async def test_flush_writes_cursor_to_postgres(self):
+        await self._mark(self.ids[3])
+        self.assertEqual(await unread.flush(), 1)
+        cursor = await ReadCursor.objects.aget(user=self.user, room=self.room)
+        self.assertEqual(
+            (cursor.last_read_message_id, cursor.read_count), (self.ids[3], 4)
+        )
+
+    async def test_cursors_reload_from_postgres(self):
+        await self._mark(self.ids[3])
+        await unread.flush()
+        self.redis.delete(unread._key(self.user.id))
+        self.assertEqual(await unread.all_unread(self.user.id), {self.room.id: 1})
@@ -0,0 +1,98 @@
+import asyncio
+import time
+import uuid
+
+from django.db import IntegrityError
+from django.test import TransactionTestCase, override_settings
+
+from faenet.chat import writebehind
+from faenet.chat.models import Message
+
+from .helpers import RedisTestMixin, make_messages, make_room, make_user
+
+
+# A long interval keeps the background flusher out of the way; tests flush
+# when they want to
+@override_settings(CHAT_WRITE_BEHIND_FLUSH_MS=60_000)
+class WriteBehindTests(RedisTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        # Bound to the event loop of whichever test waited on it last
+        writebehind._flush_now = asyncio.Event()
+        self.user = make_user("alice")
+        self.room = make_room()
+
+    async def _enqueue(self, content, **kwargs):
+        return await writebehind.enqueue(self.room.id, self.user.id, content, **kwargs)
+
+    async def _contents(self):
+        return [m.content async for m in Message.objects.order_by("id")]
+
+    async def test_enqueue_then_flush(self):
+        ids = [await self._enqueue(f"message {i}") for i in range(3)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(await self._contents(), [])
+
+        await writebehind.flush()
+        self.assertEqual(
+            await self._contents(), ["message 0", "message 1", "message 2"]
+        )
+        self.assertEqual([m.id async for m in Message.objects.order_by("id")], ids)
+        self.assertEqual(self.redis.llen(writebehind._PENDING_KEY), 0)
+
+    async def test_ids_never_collide_with_orm_inserts(self):
+        queued = await self._enqueue("queued")
+        direct = await Message.objects.acreate(
+            room=self.room, user=self.user, content="direct"
+        )
+        self.assertNotEqual(direct.id, queued)
+        await writebehind.flush()
+        self.assertEqual(await Message.objects.acount(), 2)
+
+    async def test_refills_reserved_ids(self):
+        first = await self._enqueue("first")
+        # Use up the block, as other workers would
+        self.redis.delete(writebehind._IDS_KEY)
+        second = await self._enqueue("second")
+        self.assertGreater(second, first)
+
+    async def test_resend_with_same_client_id_is_skipped(self):
+        client_id = str(uuid.uuid4())
+        kept = await self._enqueue("once", client_id=client_id)
+        await self._enqueue("once", client_id=client_id)
+        await writebehind.flush()
+        self.assertEqual([m.id async for m in Message.objects.all()], [kept])
+
+    async def test_wait_flushed(self):
+        message_id = await self._enqueue("parent")
+        self.assertTrue(await writebehind.wait_flushed(message_id))
+        self.assertTrue(await Message.objects.filter(id=message_id).aexists())
+        self.assertFalse(await writebehind.wait_flushed(message_id))
+
+    def test_reflushing_the_same_batch_is_harmless(self):
+        row = self._row(10**9)
+        writebehind._persist([row])
+        writebehind._persist([row])
+        self.assertEqual(Message.objects.filter(id=row["id"]).count(), 1)
+
+    def test_id_held_by_another_message_fails_the_flush(self):
+        (existing,) = make_messages(self.room, self.user, 1)
+        with self.assertRaises(IntegrityError):
+            writebehind._persist([self._row(existing.id)])
+        self.assertEqual(Message.objects.get(id=existing.id).content, "message 0")
+
+    def test_skips_messages_whose_room_is_gone(self):
+        row = {**self._row(10**9), "room_id": self.room.id + 1}
+        writebehind._persist([row])
+        self.assertFalse(Message.objects.exists())
+
+    def _row(self, message_id):
+        return {
+            "id": message_id,
+            "room_id": self.room.id,
+            "user_id": self.user.id,
+            "content": "queued",
+            "parent_id": None,
+            "client_id": None,
+            "created_at": time.time(),
+        }
@@ -0,0 +1,272 @@
+"""
+Per-user read cursors and unread counts.
+
+A cursor is (last read message id, the room's posted count at that
+point). The posted count is the high-water mark kept in the room's activity
+summary (activity.py); deleting a message never lowers it, so
+
+    unread = messages posted in the room now - read_count
+
+costs two hash reads however busy the room is; nothing counts rows in the
+message table. Marking a room read up to a message that isn't the newest
+subtracts the newer ones: from the recent-message buffer (one ZCOUNT) when
+it reaches back that far, otherwise with a COUNT in Postgres plus whatever
+the buffer holds beyond the table (write-behind messages not flushed yet).
+A summary Redis has lost is rebuilt from Postgres before counting.
+
+Cursors live in one Redis hash per user, ``read_cursors:{user_id}``, room
+id -> "last_read_id:read_count", loaded from the ReadCursor table the first
+time a user needs it. Moves are marked dirty and written to Postgres in
+batches every CHAT_READ_CURSOR_FLUSH_SECONDS, so scrolling costs one Redis
+call and no database write.
+"""
+
+import asyncio
+import logging
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Count, Max
+
+from .activity import rebuild_missing, summary_key
+from .db import database_sync_to_async
+from .models import ChatRoom, Message, ReadCursor
+from .recent import buffer_key
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+_redis = get_redis()
+
+_DIRTY_KEY = "read_cursors_dirty"
+# Present in every loaded cursor hash, so a user with no cursors yet isn't
+# looked up in Postgres again on every call
+_LOADED_FIELD = "loaded"
+CURSOR_TTL = 30 * 24 * 60 * 60
+_BATCH = 1000
+
+_flusher: asyncio.Task | None = None
+
+
+def _key(user_id: int) -> str:
+    return f"read_cursors:{user_id}"
+
+
+# Returned by _MARK_SCRIPT when it can't count without Postgres
+_NO_SUMMARY = -1
+_NEEDS_COUNT = -2
+
+# Move a cursor forward (never back) and return the room's unread count.
+# An id past the room's newest message is clamped to it. When the buffer
+# doesn't reach back to the cursor, the caller passes the messages newer
+# than it in Postgres as ARGV[5] and the newest of those as ARGV[6].
+_MARK_SCRIPT = """
+local posted = redis.call('HGET', KEYS[2], 'posted')
+if not posted then
+    return -1
+end
+posted = tonumber(posted)
+local last_id = tonumber(redis.call('HGET', KEYS[2], 'last_id') or '0')
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if current then
+    local last_read, read_count = string.match(current, '^(%d+):(%d+)$')
+    if tonumber(ARGV[2]) <= tonumber(last_read) then
+        return math.max(posted - tonumber(read_count), 0)
+    end
+end
+local read_id = math.min(tonumber(ARGV[2]), last_id)
+local read_count = posted
+if read_id < last_id then
+    local newer
+    if ARGV[5] then
+        newer = tonumber(ARGV[5])
+            + redis.call('ZCOUNT', KEYS[3], '(' .. ARGV[6], '+inf')
+    else
+        local oldest = redis.call('ZRANGE', KEYS[3], 0, 0, 'WITHSCORES')
+        if not oldest[2] or tonumber(oldest[2]) > read_id then
+            return -2
+        end
+        newer = redis.call('ZCOUNT', KEYS[3], '(' .. read_id, '+inf')
+    end
+    read_count = math.max(posted - newer, 0)
+end
+redis.call('HSET', KEYS[1], ARGV[1], read_id .. ':' .. read_count)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('SADD', KEYS[4], ARGV[3])
+return math.max(posted - read_count, 0)
+"""
+
+_mark = _redis.register_script(_MARK_SCRIPT)
+
+
+async def mark_read(user_id: int, room_id: int, message_id: int) -> int:
+    """Record that a user has read a room up to ``message_id`` and return
+    how many messages they still have unread there."""
+    await _cursors(user_id)
+    _ensure_flusher()
+    keys = [_key(user_id), summary_key(room_id), buffer_key(room_id), _DIRTY_KEY]
+    args = [room_id, message_id, f"{user_id}:{room_id}", CURSOR_TTL]
+    unread = await _mark(keys=keys, args=args)
+    if unread == _NO_SUMMARY:
+        await rebuild_missing([room_id])
+        unread = await _mark(keys=keys, args=args)
+    if unread == _NEEDS_COUNT:
+        newer, newest = await database_sync_to_async(_count_newer)(room_id, message_id)
+        unread = await _mark(keys=keys, args=[*args, newer, newest])
+    return max(unread, 0)
+
+
+def _count_newer(room_id: int, message_id: int) -> tuple[int, int]:
+    """Return (how many messages in the room are newer than message_id,
+    the newest one's id) from Postgres."""
+    found = Message.objects.filter(room_id=room_id, id__gt=message_id).aggregate(
+        newer=Count("id"), newest=Max("id")
+    )
+    return found["newer"], found["newest"] or message_id
+
+
+async def unread_counts(user_id: int, summaries: dict[int, dict]) -> dict[int, int]:
+    """Return {room_id: unread} for the rooms in ``summaries`` (as returned
+    by activity.summaries()) that the user has a cursor in."""
+    cursors = await _cursors(user_id)
+    return {
+        room_id: max(summary["posted"] - cursors[room_id][1], 0)
+        for room_id, summary in summaries.items()
+        if room_id in cursors
+    }
+
+
+async def all_unread(user_id: int) -> dict[int, int]:
+    """Return {room_id: unread} for every room the user has a cursor in,
+    in one pipeline after the cursors themselves."""
+    cursors = await _cursors(user_id)
+    room_ids = list(cursors)
+    if not room_ids:
+        return {}
+    counts = await _posted(room_ids)
+    missing = [room_id for room_id, posted in zip(room_ids, counts) if posted is None]
+    if missing:
+        await rebuild_missing(missing)
+        counts = await _posted(room_ids)
+        # Still none: the room was deleted, so forget the cursor too
+        gone = [room_id for room_id, posted in zip(room_ids, counts) if posted is None]
+        if gone:
+            await _redis.hdel(_key(user_id), *gone)
+    return {
+        room_id: max(int(posted) - cursors[room_id][1], 0)
+        for room_id, posted in zip(room_ids, counts)
+        if posted is not None
+    }
+
+
+async def _posted(room_ids: list[int]) -> list[str | None]:
+    async with _redis.pipeline(transaction=False) as pipe:
+        for room_id in room_ids:
+            pipe.hget(summary_key(room_id), "posted")
+        return await pipe.execute()
+
+
+async def _cursors(user_id: int) -> dict[int, tuple[int, int]]:
+    """Return {room_id: (last_read_id, read_count)}, loading the user's
+    cursors from Postgres into Redis if they aren't there."""
+    data = await _redis.hgetall(_key(user_id))
+    if not data:
+        rows = await database_sync_to_async(_load)(user_id)
+        data = {str(room_id): value for room_id, value in rows.items()}
+        async with _redis.pipeline(transaction=True) as pipe:
+            # HSETNX: a cursor moved by another tab meanwhile is newer
+            for field, value in data.items():
+                pipe.hsetnx(_key(user_id), field, value)
+            pipe.hset(_key(user_id), _LOADED_FIELD, "1")
+            pipe.expire(_key(user_id), CURSOR_TTL)
+            await pipe.execute()
+    cursors = {}
+    for field, value in data.items():
+        if field == _LOADED_FIELD:
+            continue
+        last_read, read_count = value.split(":")
+        cursors[int(field)] = (int(last_read), int(read_count))
+    return cursors
+
+
+def _load(user_id: int) -> dict[int, str]:
+    return {
+        room_id: f"{last_read}:{read_count}"
+        for room_id, last_read, read_count in ReadCursor.objects.filter(
+            user_id=user_id
+        ).values_list("room_id", "last_read_message_id", "read_count")
+    }
+
+
+async def flush() -> int:
+    """Write every dirty cursor to Postgres. Returns the number written."""
+    written = 0
+    while True:
+        members = await _redis.spop(_DIRTY_KEY, _BATCH)
+        if not members:
+            return written
+        pairs = [tuple(map(int, member.split(":"))) for member in members]
+        async with _redis.pipeline(transaction=False) as pipe:
+            for user_id, room_id in pairs:
+                pipe.hget(_key(user_id), room_id)
+            values = await pipe.execute()
+        rows = [
+            (user_id, room_id, *map(int, value.split(":")))
+            for (user_id, room_id), value in zip(pairs, values)
+            if value is not None
+        ]
+        try:
+            await database_sync_to_async(_persist)(rows)
+        except Exception:
+            # Put them back for the next tick
+            await _redis.sadd(_DIRTY_KEY, *members)
+            raise
+        written += len(rows)
+        if len(members) < _BATCH:
+            return written
+
+
+def _persist(rows: list[tuple[int, int, int, int]]) -> None:
+    """Upsert a batch of cursors in one statement, skipping any whose user
+    or room was deleted since."""
+    rooms = set(
+        ChatRoom.objects.filter(id__in={row[1] for row in rows}).values_list(
+            "id", flat=True
+        )
+    )
+    users = set(
+        get_user_model()
+        .objects.filter(id__in={row[0] for row in rows})
+        .values_list("id", flat=True)
+    )
+    ReadCursor.objects.bulk_create(
+        [
+            ReadCursor(
+                user_id=user_id,
+                room_id=room_id,
+                last_read_message_id=last_read,
+                read_count=read_count,
+            )
+            for user_id, room_id, last_read, read_count in rows
+            if user_id in users and room_id in rooms
+        ],
+        update_conflicts=True,
+        unique_fields=["user", "room"],
+        update_fields=["last_read_message_id", "read_count", "updated_at"],
+    )
+
+
+def _ensure_flusher() -> None:
+    global _flusher
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.get_running_loop().create_task(_flush_loop())
+
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(settings.CHAT_READ_CURSOR_FLUSH_SECONDS)
+        try:
+            await flush()
+        except Exception:
+            # Cursors stay dirty in Redis; the next tick retries them
+            logger.exception("Read cursor flush failed")
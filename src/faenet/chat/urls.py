@@ -1,6 +1,7 @@
 from django.urls import path
 
 from . import views
+from .metrics import metrics
 from .pwa import manifest, pwa_icon, service_worker
 
 urlpatterns = [
@@ -10,5 +11,17 @@ urlpatterns = [
     path("", views.room_list, name="room_list"),
     path("rooms/new/", views.room_create, name="room_create"),
     path("rooms/<slug:slug>/", views.room_detail, name="room_detail"),
+    path(
+        "api/rooms/<slug:slug>/messages/",
+        views.message_history,
+        name="message_history",
+    ),
+    path(
+        "api/rooms/<slug:slug>/search/",
+        views.message_search,
+        name="room_message_search",
+    ),
+    path("api/search/", views.message_search, name="message_search"),
     path("api/giphy/search/", views.giphy_search, name="giphy_search"),
+    path("metrics", metrics, name="metrics"),
 ]
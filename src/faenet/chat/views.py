@@ -1,56 +1,104 @@
-from collections import defaultdict
-
 import httpx
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.db.models import Prefetch
 from django.http import JsonResponse
-from django.shortcuts import get_object_or_404, redirect, render
+from django.shortcuts import aget_object_or_404, get_object_or_404, redirect, render
 
+from . import activity, giphy, recent, search, unread
 from .forms import ChatRoomForm
-from .models import ChatRoom, Reaction
+from .history import (
+    MAX_PAGE_SIZE,
+    PAGE_SIZE,
+    attach_reaction_summaries,
+    fetch_messages,
+    serialize_message,
+)
+from .models import ChatRoom
+
+ROOM_SORTS = ("name", "activity")
 
 
 @login_required
-def room_list(request):
-    rooms = ChatRoom.objects.all()
-    return render(request, "chat/room_list.html", {"rooms": rooms})
+async def room_list(request):
+    sort = request.GET.get("sort")
+    if sort not in ROOM_SORTS:
+        sort = "name"
+    rooms = [room async for room in ChatRoom.objects.select_related("created_by")]
+    # Activity and online counts come from Redis (see activity.py), so this
+    # page never reads the message table
+    summaries = await activity.summaries(rooms)
+    user = await request.auser()
+    unread_counts = await unread.unread_counts(user.id, summaries)
+    for room in rooms:
+        room.activity = summaries[room.id]
+        room.unread = unread_counts.get(room.id, 0)
+    if sort == "activity":
+        rooms.sort(key=lambda room: room.activity["last_id"], reverse=True)
+
+    return await sync_to_async(render)(
+        request, "chat/room_list.html", {"rooms": rooms, "sort": sort}
+    )
 
 
 @login_required
-def room_detail(request, slug):
-    room = get_object_or_404(ChatRoom, slug=slug)
-    chat_messages = (
-        room.messages.select_related("user", "parent", "parent__user")
-        .prefetch_related(
-            Prefetch(
-                "reactions",
-                queryset=Reaction.objects.select_related("user"),
-            )
-        )
-        .order_by("-created_at")[:50]
+async def room_detail(request, slug):
+    room = await aget_object_or_404(ChatRoom, slug=slug)
+    user = await request.auser()
+    # Served from the room's Redis snapshot (see recent.py)
+    chat_messages, has_more = await recent.page(room.id, user.id)
+
+    # The template reaches the lazy request.user, which can't be loaded
+    # from async code
+    return await sync_to_async(render)(
+        request,
+        "chat/room_detail.html",
+        {"room": room, "chat_messages": chat_messages, "has_more": has_more},
     )
-    # Reverse so oldest is first in the template
-    chat_messages = list(reversed(chat_messages))
-
-    # Build reaction summaries per message
-    current_username = request.user.username
-    for msg in chat_messages:
-        emoji_data = defaultdict(lambda: {"count": 0, "reacted_by_me": False})
-        for r in msg.reactions.all():
-            emoji_data[r.emoji]["count"] += 1
-            if r.user.username == current_username:
-                emoji_data[r.emoji]["reacted_by_me"] = True
-        msg.reaction_list = [
-            {"emoji": emoji, "count": d["count"], "reacted_by_me": d["reacted_by_me"]}
-            for emoji, d in emoji_data.items()
-        ]
-
-    return render(
-        request, "chat/room_detail.html", {"room": room, "chat_messages": chat_messages}
+
+
+@login_required
+def message_history(request, slug):
+    """Keyset-paginated message history: ?before=<message id>&limit=<n>."""
+    room = get_object_or_404(ChatRoom, slug=slug)
+    try:
+        before = int(request.GET["before"]) if request.GET.get("before") else None
+        limit = int(request.GET.get("limit", PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({"error": "before and limit must be integers"}, status=400)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    page, has_more = fetch_messages(room.id, before=before, limit=limit)
+    attach_reaction_summaries(page, request.user.id)
+    return JsonResponse(
+        {"messages": [serialize_message(m) for m in page], "has_more": has_more}
     )
 
 
+@login_required
+def message_search(request, slug=None):
+    """Search messages in one room (or every room, without a slug):
+    ?q=<text>&match=words|substring&cursor=<next_cursor>&limit=<n>."""
+    room_id = None
+    if slug is not None:
+        room_id = get_object_or_404(ChatRoom, slug=slug).id
+    text = request.GET.get("q", "").strip()
+    if not text:
+        return JsonResponse({"error": "q is required"}, status=400)
+    try:
+        limit = int(request.GET.get("limit", search.PAGE_SIZE))
+        results, next_cursor = search.search_messages(
+            text,
+            room_id=room_id,
+            cursor=request.GET.get("cursor") or None,
+            limit=max(1, min(limit, search.MAX_PAGE_SIZE)),
+            substring=request.GET.get("match") == "substring",
+        )
+    except ValueError:
+        return JsonResponse({"error": "malformed limit or cursor"}, status=400)
+    return JsonResponse({"results": results, "next_cursor": next_cursor})
+
+
 @login_required
 def room_create(request):
     if request.method == "POST":
@@ -66,24 +114,14 @@ def room_create(request):
 
 
 @login_required
-def giphy_search(request):
+async def giphy_search(request):
     api_key = getattr(settings, "GIPHY_API_KEY", "")
     if not api_key:
         return JsonResponse({"error": "Giphy not configured"}, status=503)
-    q = request.GET.get("q", "").strip()
-    endpoint = "search" if q else "trending"
-    params = {"api_key": api_key, "limit": 20, "rating": "pg-13"}
-    if q:
-        params["q"] = q
-    resp = httpx.get(f"https://api.giphy.com/v1/gifs/{endpoint}", params=params)
-    data = resp.json().get("data", [])
-    results = [
-        {
-            "id": g["id"],
-            "title": g.get("title", ""),
-            "url": g["images"]["original"]["url"],
-            "preview_url": g["images"]["fixed_height_small"]["url"],
-        }
-        for g in data
-    ]
+    try:
+        results = await giphy.search(request.GET.get("q", ""))
+    except httpx.TimeoutException:
+        return JsonResponse({"error": "Giphy timed out"}, status=504)
+    except httpx.HTTPError:
+        return JsonResponse({"error": "Giphy unavailable"}, status=502)
     return JsonResponse(results, safe=False)
@@ -0,0 +1,102 @@
+"""
+Event-loop lag monitor and blocking-call detector (opt-in: CHAT_WATCHDOG).
+
+Everything in a Daphne process -- every socket's consumer, every async view
+-- shares one event loop, so one blocking call (a sync Redis client, a
+requests.get, a forgotten sync ORM query) stalls all of them, and nothing
+in a profile of the slow request points at the culprit.
+
+Two parts:
+
+  ticker   a task on the loop that sleeps CHAT_WATCHDOG_INTERVAL_MS and
+           records how late it woke up in chat_event_loop_lag_seconds
+           (see metrics.py)
+  monitor  a daemon thread that checks the ticker's last wake-up. If the
+           loop has gone CHAT_WATCHDOG_THRESHOLD_MS past it without
+           ticking, a callback is blocking right now: the monitor takes the
+           loop thread's stack from sys._current_frames() -- the offending
+           code is on it -- logs it once per stall and counts the stall in
+           chat_event_loop_blocked
+
+The monitor needs the GIL to look, which pure-Python CPU work hands over
+every few milliseconds and blocking I/O releases, so both are caught.
+Meant for staging and load tests; the cost is one wake-up per interval.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_watchdog: "_Watchdog | None" = None
+
+
+class _Watchdog:
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        # start() runs on the loop thread
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.ticker = asyncio.get_running_loop().create_task(self._tick())
+        threading.Thread(
+            target=self._monitor, name="loop-watchdog", daemon=True
+        ).start()
+
+    async def _tick(self) -> None:
+        while True:
+            due = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            metrics.LOOP_LAG.observe(max(now - due, 0.0))
+            self.last_tick = now
+
+    def _monitor(self) -> None:
+        reported = None
+        while True:
+            time.sleep(self.threshold / 2)
+            last_tick = self.last_tick
+            stalled = time.monotonic() - last_tick - self.interval
+            if stalled < self.threshold or reported == last_tick:
+                continue
+            reported = last_tick
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                return  # the loop thread is gone
+            metrics.LOOP_BLOCKED.inc()
+            logger.warning(
+                "Event loop blocked for %.0f ms so far, in:\n%s",
+                stalled * 1000,
+                "".join(traceback.format_stack(frame)),
+            )
+
+
+def start() -> None:
+    """Start watching the running event loop, once per process."""
+    global _watchdog
+    if _watchdog is None:
+        _watchdog = _Watchdog(
+            settings.CHAT_WATCHDOG_INTERVAL_MS / 1000,
+            settings.CHAT_WATCHDOG_THRESHOLD_MS / 1000,
+        )
+
+
+class WatchdogMiddleware:
+    """ASGI middleware that starts the watchdog on the server's loop with
+    the first request or connection (there is no loop at import time).
+    asgi.py only installs it with CHAT_WATCHDOG on."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        start()
+        return await self.app(scope, receive, send)
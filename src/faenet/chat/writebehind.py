@@ -0,0 +1,327 @@
+"""
+Write-behind message persistence.
+
+With CHAT_WRITE_BEHIND enabled, the consumer no longer waits for an INSERT
+before broadcasting. Instead a message is:
+
+  1. given an id reserved ahead of time from the Postgres sequence and
+     appended to a Redis list in the same Lua call -- once that returns,
+     the message is as durable as Redis (run it with appendonly),
+  2. broadcast immediately,
+  3. flushed to Postgres in batches every CHAT_WRITE_BEHIND_FLUSH_MS, or as
+     soon as CHAT_WRITE_BEHIND_BATCH_SIZE messages are waiting.
+
+Ids are taken with nextval() in blocks of ID_BLOCK and kept in a Redis list
+that every worker pops from, so an ORM insert (admin, seeds, the shell, the
+synchronous path) can never be given an id a queued message already has,
+and ids still come out in send order across workers. Unused ids after a
+Redis restart are just gaps.
+
+A flush only trims the list after the batch has committed, and inserts use
+ON CONFLICT (id) DO NOTHING, so a worker dying mid-flush just means the next
+flush (from any worker, or `manage.py flush_messages` at startup) writes
+the same rows again harmlessly. A row already under that id that isn't the
+same message fails the flush instead of being skipped. A resend from a
+page's outbox that got past the Redis check in idempotency.py is skipped:
+its (user, client_id) is already taken.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from datetime import UTC, datetime
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connection, transaction
+
+from .db import database_sync_to_async
+from .models import ChatRoom, Message
+from .redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+_redis = get_redis()
+
+_IDS_KEY = "chat:writebehind:ids"
+_PENDING_KEY = "chat:writebehind:pending"
+_LOCK_KEY = "chat:writebehind:lock"
+_RESERVE_LOCK_KEY = "chat:writebehind:reserve_lock"
+_LOCK_TTL_MS = 30_000
+
+# Ids reserved from the Postgres sequence per refill; a refill starts once
+# fewer than half are left
+ID_BLOCK = 1000
+# How long a reply or reaction waits for its target to be flushed
+_WAIT_FLUSHED_TRIES = 20
+
+# Take the next reserved id and append the message in one atomic step, so
+# an id is never handed out without its message being queued, and the
+# queue stays in id order. Returns id 0 when no ids are reserved.
+_ENQUEUE_SCRIPT = """
+local id = redis.call('LPOP', KEYS[1])
+if not id then
+    return {0, 0, 0}
+end
+local msg = cjson.decode(ARGV[1])
+msg['id'] = tonumber(id)
+local pending = redis.call('RPUSH', KEYS[2], cjson.encode(msg))
+return {tonumber(id), pending, redis.call('LLEN', KEYS[1])}
+"""
+
+# Add a reserved block, but only while we still hold the reserve lock: two
+# refills interleaving would put the ids out of order.
+_RESERVE_SCRIPT = """
+if redis.call('GET', KEYS[2]) == ARGV[1] then
+    return redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+end
+return 0
+"""
+
+# Trim a flushed batch, but only while we still hold the flush lock. If the
+# lock expired and another worker took over, leave the list alone; it will
+# re-insert the same rows (a no-op) and trim them itself.
+_TRIM_SCRIPT = """
+if redis.call('GET', KEYS[2]) == ARGV[1] then
+    redis.call('LTRIM', KEYS[1], ARGV[2], -1)
+    return 1
+end
+return 0
+"""
+
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_enqueue = _redis.register_script(_ENQUEUE_SCRIPT)
+_reserve = _redis.register_script(_RESERVE_SCRIPT)
+_trim = _redis.register_script(_TRIM_SCRIPT)
+_release = _redis.register_script(_RELEASE_SCRIPT)
+
+_INSERT_SQL = """
+INSERT INTO {message}
+    (id, room_id, user_id, content, parent_id, created_at, client_id)
+SELECT %(id)s, %(room_id)s, %(user_id)s, %(content)s,
+       (SELECT id FROM {message} WHERE id = %(parent_id)s),
+       %(created_at)s, %(client_id)s::uuid
+WHERE EXISTS (SELECT 1 FROM {room} WHERE id = %(room_id)s)
+  AND EXISTS (SELECT 1 FROM {user} WHERE id = %(user_id)s)
+  AND NOT EXISTS (
+      SELECT 1 FROM {message}
+      WHERE user_id = %(user_id)s AND client_id = %(client_id)s::uuid
+  )
+ON CONFLICT (id) DO NOTHING
+"""
+
+_NEXT_IDS_SQL = """
+SELECT nextval(pg_get_serial_sequence(%s, 'id')) AS id
+FROM generate_series(1, %s)
+ORDER BY id
+"""
+
+_flusher: asyncio.Task | None = None
+_reserver: asyncio.Task | None = None
+_flush_now = asyncio.Event()
+
+
+async def enqueue(
+    room_id: int, user_id: int, content: str, parent_id=None, client_id=None
+) -> int:
+    """Queue a message for persistence and return its id."""
+    _ensure_flusher()
+
+    payload = json.dumps(
+        {
+            "room_id": room_id,
+            "user_id": user_id,
+            "content": content,
+            "parent_id": parent_id,
+            "client_id": client_id,
+            "created_at": time.time(),
+        }
+    )
+    while True:
+        message_id, pending, reserved = await _enqueue(
+            keys=[_IDS_KEY, _PENDING_KEY], args=[payload]
+        )
+        if reserved < ID_BLOCK // 2:
+            _ensure_reserver()
+        if message_id:
+            break
+        # Out of ids: wait for the refill (ours or another worker's)
+        if not await reserve_ids():
+            await asyncio.sleep(0.01)
+    if pending >= settings.CHAT_WRITE_BEHIND_BATCH_SIZE:
+        _flush_now.set()
+    return message_id
+
+
+async def reserve_ids() -> bool:
+    """Top up the reserved ids from the Postgres sequence.
+
+    Returns False without doing anything when another worker is already
+    refilling, so the caller knows to wait for it.
+    """
+    token = uuid.uuid4().hex
+    if not await _redis.set(_RESERVE_LOCK_KEY, token, nx=True, px=_LOCK_TTL_MS):
+        return False
+    try:
+        if await _redis.llen(_IDS_KEY) >= ID_BLOCK // 2:
+            return True
+        ids = await database_sync_to_async(_next_ids)(ID_BLOCK)
+        reserved = await _reserve(
+            keys=[_IDS_KEY, _RESERVE_LOCK_KEY], args=[token, *ids]
+        )
+        return bool(reserved)
+    finally:
+        await _release(keys=[_RESERVE_LOCK_KEY], args=[token])
+
+
+async def wait_flushed(message_id: int) -> bool:
+    """Flush now if message_id is still queued, so a reply or reaction to
+    it can find it in Postgres.
+
+    Returns whether it was queued. Gives up (returning True) if another
+    worker's flush holds the lock for longer than a second.
+    """
+    if not await _is_pending(message_id):
+        return False
+    for _ in range(_WAIT_FLUSHED_TRIES):
+        if not await flush():
+            # Another worker is flushing; it will get there first
+            await asyncio.sleep(0.05)
+        if not await _is_pending(message_id):
+            break
+    return True
+
+
+async def _is_pending(message_id: int) -> bool:
+    # The queue is in id order, so its ends bound every id still in it
+    async with _redis.pipeline(transaction=False) as pipe:
+        pipe.lindex(_PENDING_KEY, 0)
+        pipe.lindex(_PENDING_KEY, -1)
+        first, last = await pipe.execute()
+    if first is None:
+        return False
+    return json.loads(first)["id"] <= message_id <= json.loads(last)["id"]
+
+
+async def flush() -> int:
+    """Write every queued message to Postgres. Returns the number flushed.
+
+    Safe to call from any worker at any time: a Redis lock makes sure only
+    one flush runs at once.
+    """
+    token = uuid.uuid4().hex
+    if not await _redis.set(_LOCK_KEY, token, nx=True, px=_LOCK_TTL_MS):
+        return 0
+
+    batch_size = settings.CHAT_WRITE_BEHIND_BATCH_SIZE
+    flushed = 0
+    try:
+        while True:
+            batch = await _redis.lrange(_PENDING_KEY, 0, batch_size - 1)
+            if not batch:
+                break
+            await database_sync_to_async(_persist)([json.loads(m) for m in batch])
+            if not await _trim(
+                keys=[_PENDING_KEY, _LOCK_KEY], args=[token, len(batch)]
+            ):
+                break
+            flushed += len(batch)
+            if len(batch) < batch_size:
+                break
+    finally:
+        await _release(keys=[_LOCK_KEY], args=[token])
+    return flushed
+
+
+def _persist(messages: list[dict]) -> None:
+    """Insert a batch of queued messages in one transaction.
+
+    Raw SQL rather than bulk_create: auto_now_add would overwrite the
+    send-time created_at, and the INSERT ... SELECT lets a message whose
+    room or user was deleted in the meantime be skipped instead of failing
+    the whole batch forever.
+    """
+    sql = _INSERT_SQL.format(
+        message=Message._meta.db_table,
+        room=ChatRoom._meta.db_table,
+        user=get_user_model()._meta.db_table,
+    )
+    rows = [
+        {
+            **m,
+            "created_at": datetime.fromtimestamp(m["created_at"], tz=UTC),
+            # Absent from messages queued before client ids existed
+            "client_id": m.get("client_id"),
+        }
+        for m in messages
+    ]
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+        _check_conflicts(rows)
+
+
+def _check_conflicts(rows: list[dict]) -> None:
+    """Fail the batch if an id is taken by a different message.
+
+    ON CONFLICT (id) is only there for re-flushing the same message after a
+    crash. Ids come from the sequence, so anything else means the queue and
+    the table disagree, and dropping an already broadcast message quietly
+    would be worse than a flush error.
+    """
+    stored = {
+        m["id"]: (m["user_id"], m["created_at"])
+        for m in Message.objects.filter(id__in=[r["id"] for r in rows]).values(
+            "id", "user_id", "created_at"
+        )
+    }
+    clashes = [
+        r["id"]
+        for r in rows
+        if r["id"] in stored and stored[r["id"]] != (r["user_id"], r["created_at"])
+    ]
+    if clashes:
+        raise IntegrityError(
+            f"Queued message ids already used by other messages: {clashes}"
+        )
+
+
+def _next_ids(count: int) -> list[int]:
+    with connection.cursor() as cursor:
+        cursor.execute(_NEXT_IDS_SQL, [Message._meta.db_table, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _ensure_flusher() -> None:
+    global _flusher
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.get_running_loop().create_task(_flush_loop())
+
+
+def _ensure_reserver() -> None:
+    global _reserver
+    if _reserver is None or _reserver.done():
+        _reserver = asyncio.get_running_loop().create_task(reserve_ids())
+
+
+async def _flush_loop() -> None:
+    interval = settings.CHAT_WRITE_BEHIND_FLUSH_MS / 1000
+    while True:
+        try:
+            await asyncio.wait_for(_flush_now.wait(), timeout=interval)
+        except TimeoutError:
+            pass
+        _flush_now.clear()
+        try:
+            await flush()
+        except Exception:
+            # Messages stay queued in Redis; the next tick retries them
+            logger.exception("Write-behind flush failed")
@@ -155,18 +155,120 @@ ASGI_APPLICATION = "faenet.asgi.application"
 # Channel layer backed by Redis. This is what enables real-time messaging:
 # when one WebSocket consumer sends a message, it goes through Redis to
 # all other consumers in the same "group" (chat room).
+#
+# CHANNEL_LAYER_BACKEND=streams swaps in chat/layers.py, which fans a group
+# message out through one Redis stream per room read once per worker,
+# instead of one Redis push per connected socket.
+CHANNEL_LAYER_BACKENDS = {
+    "redis": "channels_redis.core.RedisChannelLayer",
+    "streams": "faenet.chat.layers.RedisStreamChannelLayer",
+}
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": CHANNEL_LAYER_BACKENDS[
+            os.environ.get("CHANNEL_LAYER_BACKEND", "redis")
+        ],
         "CONFIG": {
             "hosts": [os.environ.get("REDIS_URL", "redis://localhost:6379/0")],
         },
     },
 }
 
+# ---------------------------------------------------------------------------
+# CHAT PRESENCE
+# ---------------------------------------------------------------------------
+# Each worker re-stamps its connections in the presence_seen sorted set every
+# HEARTBEAT_INTERVAL seconds. A connection not seen for TTL seconds (its
+# worker crashed, was SIGKILLed or lost its node) is removed by whichever
+# worker's reaper gets to it first (see chat/presence.py).
+CHAT_PRESENCE_HEARTBEAT_INTERVAL = int(
+    os.environ.get("CHAT_PRESENCE_HEARTBEAT_INTERVAL", "10")
+)
+CHAT_PRESENCE_TTL = int(os.environ.get("CHAT_PRESENCE_TTL", "30"))
+
+# ---------------------------------------------------------------------------
+# CHAT PERSISTENCE
+# ---------------------------------------------------------------------------
+# Write-behind mode: chat messages take an id reserved from the Postgres
+# sequence and are broadcast immediately, then flushed to PostgreSQL in
+# batches every FLUSH_MS or as soon as BATCH_SIZE messages are waiting (see chat/writebehind.py). Queued
+# messages live in Redis until flushed, so run Redis with appendonly enabled.
+CHAT_WRITE_BEHIND = os.environ.get("CHAT_WRITE_BEHIND", "False").lower() in (
+    "true",
+    "1",
+    "yes",
+)
+CHAT_WRITE_BEHIND_FLUSH_MS = int(os.environ.get("CHAT_WRITE_BEHIND_FLUSH_MS", "200"))
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(
+    os.environ.get("CHAT_WRITE_BEHIND_BATCH_SIZE", "500")
+)
+
+# Read cursors are kept in Redis and upserted into the ReadCursor table in
+# batches every READ_CURSOR_FLUSH_SECONDS (see chat/unread.py).
+CHAT_READ_CURSOR_FLUSH_SECONDS = int(
+    os.environ.get("CHAT_READ_CURSOR_FLUSH_SECONDS", "5")
+)
+
+# ---------------------------------------------------------------------------
+# CHAT FAN-OUT
+# ---------------------------------------------------------------------------
+# Opt-in frame coalescing: with a window (e.g. 20-50 ms), events reaching a
+# socket within it are sent as one {"type": "batch", "events": [...]} frame,
+# which the page renders with a single DOM insert. 0 sends every event as
+# its own frame.
+CHAT_BATCH_WINDOW_MS = int(os.environ.get("CHAT_BATCH_WINDOW_MS", "0"))
+
+# ---------------------------------------------------------------------------
+# CHAT RATE LIMITS
+# ---------------------------------------------------------------------------
+# Token buckets for inbound WebSocket frames, as (tokens per second, burst).
+# A frame needs a token from every bucket of its kind: the connection's (in
+# process), the user's (all tabs, all workers) and the room's (in Redis, see
+# chat/ratelimit.py). Set a scope to None to disable it. Frames over the
+# limit are dropped and the client gets a "rate_limited" error frame. The
+# page sends "read" at most every 500 ms, "resume" once per socket and
+# "presence_sync" only after a gap, so their limits just stop a script
+# from turning them into Postgres counts, replays or snapshots on repeat.
+# "resume" has no room bucket: after a deploy every socket in a room
+# reconnects and resumes at once.
+CHAT_RATE_LIMITS = {
+    "message": {"connection": (2, 10), "user": (3, 15), "room": (50, 200)},
+    "reaction": {"connection": (5, 20), "user": (8, 30), "room": (100, 400)},
+    "read": {"connection": (4, 10), "user": (10, 30), "room": None},
+    "resume": {"connection": None, "user": (1, 10), "room": None},
+    "presence_sync": {"connection": (1, 5), "user": (2, 10), "room": None},
+}
+
+# ---------------------------------------------------------------------------
+# CHAT EVENT-LOOP WATCHDOG
+# ---------------------------------------------------------------------------
+# Opt-in (staging, load tests): measures event-loop lag every INTERVAL_MS and
+# logs the stack of whatever blocks the loop for more than THRESHOLD_MS
+# (see chat/watchdog.py). Exported as chat_event_loop_* metrics.
+CHAT_WATCHDOG = os.environ.get("CHAT_WATCHDOG", "False").lower() in (
+    "true",
+    "1",
+    "yes",
+)
+CHAT_WATCHDOG_INTERVAL_MS = int(os.environ.get("CHAT_WATCHDOG_INTERVAL_MS", "50"))
+CHAT_WATCHDOG_THRESHOLD_MS = int(os.environ.get("CHAT_WATCHDOG_THRESHOLD_MS", "100"))
+
 # ---------------------------------------------------------------------------
 # DATABASE
 # ---------------------------------------------------------------------------
+# Chat code's database_sync_to_async calls run on CHAT_DB_THREADS threads
+# (chat/db.py) instead of the one thread asgiref otherwise funnels every
+# call through. 0 keeps that single thread.
+CHAT_DB_THREADS = int(os.environ.get("CHAT_DB_THREADS", "8"))
+
+# psycopg 3 connection pool, per process. Connections aren't persistent
+# (CONN_MAX_AGE = 0, which pooling requires), so without a pool every
+# database_sync_to_async call opens and closes a Postgres connection; with
+# one, it borrows an open connection and hands it back. Size it above
+# CHAT_DB_THREADS to leave room for HTTP views, and keep replicas x size
+# under Postgres' max_connections (100 by default). 0 disables pooling.
+CHAT_DB_POOL_SIZE = int(os.environ.get("CHAT_DB_POOL_SIZE", "16"))
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
@@ -175,6 +277,11 @@ DATABASES = {
         "PASSWORD": os.environ.get("POSTGRES_PASSWORD", "faenet_secret"),
         "HOST": os.environ.get("POSTGRES_HOST", "db"),
         "PORT": os.environ.get("POSTGRES_PORT", "5432"),
+        "OPTIONS": (
+            {"pool": {"min_size": 2, "max_size": CHAT_DB_POOL_SIZE, "timeout": 10}}
+            if CHAT_DB_POOL_SIZE
+            else {}
+        ),
     }
 }
 
@@ -216,3 +323,7 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # GIPHY API
 # ---------------------------------------------------------------------------
 GIPHY_API_KEY = os.environ.get("GIPHY_API_KEY", "")
+# Overridable so local tests can point the proxy at a stub server
+GIPHY_API_URL = os.environ.get("GIPHY_API_URL", "https://api.giphy.com/v1/gifs")
+# Seconds to wait on Giphy before the proxy gives up with a 504
+GIPHY_TIMEOUT = float(os.environ.get("GIPHY_TIMEOUT", "3"))